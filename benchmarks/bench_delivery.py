@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""bench_delivery.py
+
+End-to-end delivery benchmark through a real OS serial path (linux only).
+
+Starts smallsocc/fakedevice.py in a separate process, connects HWSOC to its pseudo-terminal, and delivers a
+synthetic plan with the TreatmentManager, once per delivery mode. Reports end-to-end plan time and the
+per-segment overhead on top of planned beam-on time and modeled leaflet travel.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'smallsocc')
+sys.path.insert(0, SRC_DIR)
+from PyQt5.QtCore import QCoreApplication
+import soclog
+import hwmodel
+from hardware import HWSOC
+from sequence import SequenceItem, SequenceListModel
+from treatmentmanager import TreatmentManager
+from scheduler import summarize_timing
+from motionmodel import MotionModel
+
+def synthetic_plan(nsegments, timecode_ms, max_extension, seed=0):
+    rng = random.Random(seed)
+    items = []
+    for ii in range(nsegments):
+        # keep opposing pairs clear of the firmware collision limits
+        ext = [rng.randint(0, max_extension) for jj in range(hwmodel.NLEAFLETS)]
+        items.append(SequenceItem(extension_list=ext, timecode_ms=timecode_ms))
+    return items
+
+def modeled_move_time(items, time_scale):
+    motion = MotionModel()
+    steps = [0]*hwmodel.NLEAFLETS
+    total = 0
+    for item in items:
+        new = hwmodel.to_steps(item._members['extension_list'].value)
+        total += motion.move_time(steps, new)
+        steps = new
+    return total*time_scale
+
+def deliver(app, tms, timeout, reports):
+    """ start all managers at once; returns each one's delivery time (None if it did not complete) and
+    collects their timing reports into reports """
+    done = {}
+    def connect(tm):
+        tm.onTimingReport.connect(lambda report: reports.__setitem__(tm, report))
+        tm.onTreatmentCompleted.connect(lambda idx: done.setdefault(tm, time.perf_counter()))
+        tm.onTreatmentAborted.connect(lambda idx: done.setdefault(tm, None))
+    for tm in tms:
+        connect(tm)
+    t1 = time.perf_counter()
+    for tm in tms:
+        tm.startTreatment.emit(0)
+    while len(done) < len(tms) and time.perf_counter()-t1 < timeout:
+        app.processEvents()
+        time.sleep(0.001)
+    for tm in tms:
+        tm.onTimingReport.disconnect()
+        tm.onTreatmentCompleted.disconnect()
+        tm.onTreatmentAborted.disconnect()
+    return [None if done.get(tm) is None else done[tm]-t1 for tm in tms]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='end-to-end delivery benchmark against pty fake devices',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--segments', type=int, default=200, help='number of plan segments')
+    parser.add_argument('--timecode-ms', type=float, default=5, help='beam-on time per segment')
+    parser.add_argument('--max-extension', type=int, default=100, help='largest random leaflet extension')
+    parser.add_argument('--time-scale', type=float, default=0.0, help='fake device move-time multiplier')
+    parser.add_argument('--devices', type=int, default=1, help='number of devices delivering the plan in parallel')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for each delivery')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='socbench')
+    fakes = []
+    try:
+        for ii in range(args.devices):
+            link = os.path.join(tmpdir, 'tty{:d}'.format(ii))
+            fakes.append((link, subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'fakedevice.py'), '--link', link,
+                                                  '--time-scale', str(args.time_scale), '--batch-size', '32'],
+                                                 stdout=subprocess.PIPE)))
+        for link, fake in fakes:
+            fake.stdout.readline() # pty path, printed once the link exists
+        app = QCoreApplication(sys.argv[:1])
+        items = synthetic_plan(args.segments, args.timecode_ms, args.max_extension)
+        devices, tms = [], []
+        for ii, (link, fake) in enumerate(fakes):
+            hwsoc = HWSOC(hwmodel.NLEAFLETS, PORT=link, device='soc{:d}'.format(ii))
+            devices.append(hwsoc)
+            tms.append(TreatmentManager(SequenceListModel(elements=items), device=hwsoc.device))
+
+        planned = args.segments*args.timecode_ms*0.001
+        moves = modeled_move_time(items, args.time_scale)
+        print('segments: {:d}; devices: {:d}; planned beam-on: {:.3f}s; modeled leaflet travel: {:.3f}s'.format(
+            args.segments, args.devices, planned, moves))
+        print('{:>10s} {:>8s} {:>12s} {:>16s} {:>14s} {:>14s} {:>16s}'.format(
+            'mode', 'device', 'total (s)', 'overhead/seg', 'ack rtt p50', 'ack rtt p99', 'timing |err| p50'))
+        for mode, use_batch, use_deadlines, hist in [('per-frame', False, False, 'rtt_move'),
+                                                     ('deadline', False, True, 'rtt_move'),
+                                                     ('batch', True, False, 'rtt_batch')]:
+            for hwsoc, tm in zip(devices, tms):
+                hwsoc.use_batch = use_batch
+                tm.use_deadlines = use_deadlines
+                hwsoc.telemetry.reset()
+            reports = {}
+            totals = deliver(app, tms, args.timeout, reports)
+            for hwsoc, tm, total in zip(devices, tms, totals):
+                if total is None:
+                    print('{:>10s} {:>8s} delivery did not complete'.format(mode, hwsoc.device))
+                    continue
+                rtt = hwsoc.telemetry.snapshot()['histograms'][hist]
+                # batch dwell is timed by the device, whose model does not apply at --time-scale 0
+                timing = summarize_timing(None if use_batch else reports.get(tm))
+                print('{:>10s} {:>8s} {:>12.3f} {:>14.2f}ms {:>12s}ms {:>12s}ms {:>14s}ms'.format(
+                    mode, hwsoc.device, total, 1000*(total-planned-moves)/args.segments,
+                    '{:.2f}'.format(1000*rtt['p50']) if rtt['count'] else '-',
+                    '{:.2f}'.format(1000*rtt['p99']) if rtt['count'] else '-',
+                    '{:.3f}'.format(timing['p50_abs_error_ms']) if timing['count'] else '-'))
+        HWSOC.close_all()
+    finally:
+        for link, fake in fakes:
+            fake.terminate()
+            fake.wait()
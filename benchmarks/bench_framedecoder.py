@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""bench_framedecoder.py
+
+Throughput benchmark for smallsocc.framedecoder.FrameDecoder
+
+Feeds an MB-scale stream (synthetic firmware DEBUG output by default, or a raw capture of the serial
+line given with --capture) to the decoder in fixed-size chunks and reports decode rate relative to the
+serial line rate.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'smallsocc'))
+from framedecoder import FrameDecoder
+
+def synthetic_stream(nbytes):
+    """ imitate the firmware's DEBUG output for one PRE_ABSPOS_ALL command, repeated until nbytes """
+    block = b'Leaf positions received\r\n' + \
+            b''.join(b'%d\r\n' % (1234*(ii+1)) for ii in range(8)) + \
+            b'New encoder positions:\r\n' + \
+            b''.join(b'%d\r\n' % (1230*(ii+1)) for ii in range(8)) + \
+            b'\xA0\x00' + \
+            b'Wooh, leaves moved successfully!\r\n'
+    reps = nbytes // len(block) + 1
+    return (block*reps)[:nbytes]
+
+def run(stream, chunksize):
+    decoder = FrameDecoder()
+    nframes = 0
+    t1 = time.perf_counter()
+    for ii in range(0, len(stream), chunksize):
+        nframes += len(decoder.feed(stream[ii:ii+chunksize]))
+    elapsed = time.perf_counter() - t1
+    return elapsed, nframes, decoder.high_water
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FrameDecoder throughput benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--capture', type=str, default=None, help='raw serial capture to replay instead of synthetic data')
+    parser.add_argument('--size-mb', type=float, default=4, help='size of synthetic stream')
+    parser.add_argument('--baud', type=int, default=115200, help='serial line rate to compare against')
+    parser.add_argument('--chunks', type=int, nargs='+', default=[1, 16, 256, 4096, 65536], help='read sizes to simulate')
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = synthetic_stream(int(args.size_mb*1024*1024))
+
+    line_rate = args.baud / 10 # 8N1 framing: 10 bits on the wire per byte
+    print('stream: {:d} bytes; line rate at {:d} baud: {:.0f} B/s'.format(len(stream), args.baud, line_rate))
+    print('{:>8s} {:>10s} {:>10s} {:>12s} {:>10s} {:>10s}'.format('chunk', 'time (s)', 'MB/s', 'x line rate', 'frames', 'high water'))
+    for chunksize in args.chunks:
+        elapsed, nframes, high_water = run(stream, chunksize)
+        rate = len(stream)/elapsed
+        print('{:>8d} {:>10.3f} {:>10.2f} {:>12.0f} {:>10d} {:>10d}'.format(
+            chunksize, elapsed, rate/1e6, rate/line_rate, nframes, high_water))
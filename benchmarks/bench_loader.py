@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""bench_loader.py
+
+Plan loading benchmark over synthetic plan files.
+
+Writes plans of each requested size in the format of SequenceListModel.writeToJson(), then loads each one
+in a fresh interpreter (one subprocess per file, so peak RSS is not inherited from earlier runs) and reports
+wall time and peak RSS (ru_maxrss) of SequenceListModel.readFromJson(). With --legacy, also reports the old
+loader (json.load() and one SequenceItem per segment) for comparison.
+
+Plans are written by a subprocess as well: linux keeps ru_maxrss across fork/exec, so the parent must stay
+small for the children's peak RSS to be their own.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'smallsocc')
+sys.path.insert(0, SRC_DIR)
+
+def write_plan(fname, nsegments, seed=0):
+    rng = random.Random(seed)
+    date = datetime(2020, 1, 1).strftime('%Y %b %d %H:%M:%S')
+    items = [{'extension_list': [rng.randint(0, 500) for jj in range(8)],
+              'rot_gantry_deg': rng.choice([0, 90, 180, 270]),
+              'rot_couch_deg': 0,
+              'timecode_ms': rng.choice([100, 250, 500]),
+              'description': 'segment {:d}'.format(ii),
+              'date_created': date,
+              'type': 'Auto'} for ii in range(nsegments)]
+    d = {'metadata': {'generated_on': date}, 'SequenceList': items}
+    with open(fname, 'w') as f:
+        f.write(json.dumps(d, indent=2, separators=(',', ':'), sort_keys=True))
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux, bytes on macos
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024*1024 if sys.platform == 'darwin' else 1024)
+
+def child(fname, loader):
+    """ load fname once; prints {'time', 'rss_before', 'rss_after', 'segments'} as json """
+    from PyQt5.QtCore import QCoreApplication
+    import soclog
+    from sequence import SequenceItem, SequenceListModel
+    app = QCoreApplication(sys.argv[:1])
+    rss_before = peak_rss_mb()
+    t1 = time.perf_counter()
+    if loader == 'legacy':
+        with open(fname, 'r') as f:
+            d = json.load(f)
+        plan = [SequenceItem(**itemdict) for itemdict in d['SequenceList']]
+    else:
+        plan = SequenceListModel()
+        if not plan.readFromJson(fname):
+            raise RuntimeError('failed to read "{}"'.format(fname))
+    elapsed = time.perf_counter() - t1
+    print(json.dumps({'time': elapsed, 'rss_before': rss_before, 'rss_after': peak_rss_mb(), 'segments': len(plan)}))
+
+def make_plan(fname, nsegments):
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), '--write', fname, '--sizes', str(nsegments)])
+
+def run(fname, loader):
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', fname, '--loader', loader])
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='plan loading benchmark over synthetic plan files',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='plan sizes (segments)')
+    parser.add_argument('--legacy', action='store_true', help='also time json.load() + one SequenceItem per segment')
+    parser.add_argument('--write', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--child', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--loader', type=str, default='stream', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.write:
+        write_plan(args.write, args.sizes[0])
+        sys.exit(0)
+    if args.child:
+        child(args.child, args.loader)
+        sys.exit(0)
+
+    tmpdir = tempfile.mkdtemp(prefix='socbench')
+    loaders = ['stream', 'legacy'] if args.legacy else ['stream']
+    print('{:>10s} {:>10s} {:>8s} {:>10s} {:>12s} {:>14s}'.format(
+        'segments', 'file (MB)', 'loader', 'time (s)', 'peak RSS MB', 'RSS growth MB'))
+    try:
+        for nsegments in args.sizes:
+            fname = os.path.join(tmpdir, 'plan_{:d}.json'.format(nsegments))
+            make_plan(fname, nsegments)
+            for loader in loaders:
+                r = run(fname, loader)
+                print('{:>10d} {:>10.1f} {:>8s} {:>10.3f} {:>12.1f} {:>14.1f}'.format(
+                    r['segments'], os.path.getsize(fname)/1e6, loader, r['time'], r['rss_after'],
+                    r['rss_after']-r['rss_before']))
+    finally:
+        for fname in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, fname))
+        os.rmdir(tmpdir)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""bench_planio.py
+
+Plan file format benchmark: json against the binary (.socplan) container.
+
+For synthetic plans of each requested size, reports file size and the best-of-N wall time of
+SequenceListModel.writeToJson()/writeToBinary() and of readFromJson() on either file.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'smallsocc')
+sys.path.insert(0, SRC_DIR)
+from PyQt5.QtCore import QCoreApplication
+import soclog
+from sequence import SequenceListModel
+from bench_loader import write_plan
+
+def best_of(repeat, func, *args):
+    best = None
+    for ii in range(repeat):
+        t1 = time.perf_counter()
+        if func(*args) is False:
+            raise RuntimeError('{}{!r} failed'.format(func.__name__, args))
+        elapsed = time.perf_counter() - t1
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='json vs binary plan file benchmark',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='plan sizes (segments)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement (best is reported)')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv[:1])
+    tmpdir = tempfile.mkdtemp(prefix='socbench')
+    print('{:>10s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('segments', 'format', 'file (MB)', 'write (s)', 'read (s)', 'speedup'))
+    try:
+        for nsegments in args.sizes:
+            src = os.path.join(tmpdir, 'src_{:d}.json'.format(nsegments))
+            write_plan(src, nsegments)
+            model = SequenceListModel()
+            model.readFromJson(src)
+            json_read = None
+            for fmt, write in [('json', model.writeToJson), ('binary', model.writeToBinary)]:
+                fname = os.path.join(tmpdir, 'plan_{:d}.{}'.format(nsegments, 'json' if fmt == 'json' else 'socplan'))
+                t_write = best_of(args.repeat, write, fname)
+                t_read = best_of(args.repeat, SequenceListModel().readFromJson, fname)
+                json_read = json_read or t_read
+                print('{:>10d} {:>8s} {:>10.2f} {:>10.3f} {:>10.4f} {:>9.1f}x'.format(
+                    nsegments, fmt, os.path.getsize(fname)/1e6, t_write, t_read, json_read/t_read))
+    finally:
+        for fname in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, fname))
+        os.rmdir(tmpdir)
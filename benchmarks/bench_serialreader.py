@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""bench_serialreader.py
+
+Compares the SerialThread reader against the previous timeout=0 polling reader on a Linux pseudo-terminal:
+  - process CPU use while the port is idle
+  - latency of SerialThread.write() while the device is streaming data back to the host
+"""
+import os
+import sys
+import pty
+import tty
+import time
+import threading
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'smallsocc'))
+from PyQt5.QtCore import QCoreApplication
+from serial.threaded import Protocol
+from serialthread import SerialThread
+
+
+class PollingSerialThread(SerialThread):
+    """ the read loop as it was before the selector-based reader, kept here for comparison """
+    def _read_loop(self):
+        self.serial.timeout = 0
+        while self.alive and self.serial and self.serial.readable():
+            self._lock.lock()
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+                if data:
+                    self.protocol.data_received(data)
+            except Exception as err:
+                self.serial = None
+            self._lock.unlock()
+
+
+class CountingProtocol(Protocol):
+    def __init__(self):
+        self.nbytes = 0
+
+    def data_received(self, data):
+        self.nbytes += len(data)
+
+
+def drain(fd, stop):
+    """ consume everything the host writes so the pty never fills up """
+    while not stop.is_set():
+        try: os.read(fd, 4096)
+        except OSError: break
+
+def flood(fd, stop, chunk, interval):
+    """ imitate the device streaming DEBUG text back to the host """
+    data = (b'New encoder positions:\r\n' * (chunk//24+1))[:chunk]
+    while not stop.is_set():
+        try: os.write(fd, data)
+        except OSError: break
+        time.sleep(interval)
+
+def bench(cls, args):
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    stop = threading.Event()
+    threading.Thread(target=drain, args=(master, stop), daemon=True).start()
+
+    st = cls(CountingProtocol, PORT=os.ttyname(slave))
+    time.sleep(0.2)
+
+    c1, t1 = time.process_time(), time.perf_counter()
+    time.sleep(args.idle)
+    idle_cpu = (time.process_time()-c1) / (time.perf_counter()-t1)
+
+    threading.Thread(target=flood, args=(master, stop, args.flood_chunk, args.flood_interval), daemon=True).start()
+    frame = b'\xFF\xD7\xB2' + bytes(16)
+    latencies = []
+    for ii in range(args.nwrites):
+        t = time.perf_counter()
+        st.write(frame)
+        latencies.append(time.perf_counter()-t)
+        time.sleep(0.001)
+    received = st.protocol.nbytes
+
+    stop.set()
+    st.close()
+    os.close(master)
+    os.close(slave)
+    latencies.sort()
+    return idle_cpu, latencies, received
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serial reader CPU/latency benchmark (Linux only)',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--idle', type=float, default=3, help='seconds to measure idle CPU use')
+    parser.add_argument('--nwrites', type=int, default=2000, help='number of frames written under load')
+    parser.add_argument('--flood-chunk', type=int, default=256, help='bytes per device burst')
+    parser.add_argument('--flood-interval', type=float, default=0.0005, help='seconds between device bursts')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv[:1])
+    print('{:>10s} {:>10s} {:>12s} {:>12s} {:>12s} {:>12s}'.format('reader', 'idle CPU', 'write p50', 'write p99', 'write max', 'bytes recvd'))
+    for name, cls in [('polling', PollingSerialThread), ('select', SerialThread)]:
+        idle_cpu, lat, received = bench(cls, args)
+        print('{:>10s} {:>9.1f}% {:>10.1f}us {:>10.1f}us {:>10.1f}us {:>12d}'.format(
+            name, 100*idle_cpu, 1e6*statistics.median(lat), 1e6*lat[int(0.99*(len(lat)-1))], 1e6*lat[-1], received))
@@ -16,6 +16,7 @@ setup(name='SmallSOCC',
       packages=[package_name,],
       entry_points={
           'gui_scripts': ['{0} = {0}.gui:start_gui'.format(package_name)],
+          'console_scripts': ['{0}-run = {0}.run:start_run'.format(package_name)],
       },
       package_data={
           package_name: [
@@ -27,6 +28,7 @@ setup(name='SmallSOCC',
       install_requires=[
           'PyOpenGL>=3.1.0',
           'PyQt5 >=5.12',
-          'pyserial>=3.4'
+          'pyserial>=3.4',
+          'numpy>=1.13'
       ],
 )
@@ -5,7 +5,7 @@ FileDialog {
   property string intent: "load"
   function isLoad() { return (intent=="load"); }
   title: isLoad() ? "Select a file to load" : "Select a location to save the file"
-  nameFilters: ["json files (*.json)", "All files (*)"]
+  nameFilters: ["json files (*.json)", "binary plans (*.socplan)", "All files (*)"]
   selectMultiple: false
   selectExisting: isLoad() ? true : false;
 
@@ -8,6 +8,34 @@ RowLayout {
   id: root
   property alias lvseq: lvseq
 
+  function offerResume() {
+    // a journaled treatment of the loaded plan was interrupted (e.g. crash or power loss); call after loading a plan
+    var resume = TreatmentManager.resumePoint();
+    if (resume.index === undefined) { return; }
+    var text = "The previous treatment of this plan did not complete. Resume from segment #" + (resume.index+1) +
+               " (" + (resume.remaining_ms/1000).toFixed(1) + " s of beam-on time remaining)?";
+    if (resume.partial_ms > 0) {
+      text += "\nSegment #" + (resume.index+1) + " already received " + (resume.partial_ms/1000).toFixed(1) +
+              " s of beam-on time and is delivered for the remaining " + (resume.first_ms/1000).toFixed(1) + " s only.";
+    }
+    if (resume.unknown !== null && resume.unknown !== undefined) {
+      text += "\nWARNING: the beam-on of segment #" + (resume.unknown+1) + " was interrupted after an unknown time " +
+              "(partial dose); it is not delivered again.";
+    }
+    var d = DynamicQML.createDynamicObject(mainwindow, "QMessageDialog.qml", {
+      'title': 'Resume Interrupted Treatment?',
+      'text': text,
+      'standardButtons': 0x14000 /* StandardButton.Yes | StandardButton.No */
+    })
+    d.onYes.connect( function() {
+      lvseq.select(resume.index);
+      treat_control_group.startTreatment(resume.first_ms);
+      d.destroy(); /* cleanup */
+    });
+    d.onNo.connect( function() { d.destroy(); /* cleanup */ });
+    d.open()
+  }
+
   Pane { /* Sequence List */
     id: seq_list_border
     clip: true
@@ -31,9 +59,14 @@ RowLayout {
       highlightMoveVelocity: -1
       enabled: !isTreating
 
+      function select(idx) {
+        // rows past those fetched so far cannot be selected until the view holds them
+        if (idx >= 0) { model.fetchThrough(idx); }
+        currentIndex = idx;
+      }
       function next() {
         if (currentIndex >= 0 && currentIndex < model.size-1) {
-          currentIndex += 1;
+          select(currentIndex+1);
         }
       }
       function previous() {
@@ -143,6 +176,56 @@ RowLayout {
         Layout.fillWidth: true
         color: "transparent"
       }
+      QStylizedButton { /* reorder to minimize leaflet travel */
+        enabled: !isTreating
+        Layout.preferredHeight: root.btn_height
+        Layout.fillWidth: true
+        text: "Optimize"
+        font.pointSize: root.fontsize
+        onClicked: {
+          var saved = SequenceListModel.proposeOrder();
+          if (saved <= 0) {
+            footer_status.text = "Segment order is already optimal";
+            return;
+          }
+          var d = DynamicQML.createDynamicObject(mainwindow, "QMessageDialog.qml", {
+            'title': 'Reorder Segments?',
+            'text': "Reordering the segments (Manual segments stay in place) is predicted to save " + saved.toFixed(1) +
+                    " s of leaflet travel. Apply the new order?",
+            'standardButtons': 4195328 /* StandardButton.Ok | StandardButton.Cancel */
+          })
+          d.onAccepted.connect( function() {
+            if (SequenceListModel.applyProposedOrder()) {
+              footer_status.text = "Reordered segments, saving " + saved.toFixed(1) + " s";
+            }
+            d.destroy(); /* cleanup */
+          });
+          d.onRejected.connect( function() { d.destroy(); /* cleanup */ });
+          d.open()
+        }
+      }
+      QStylizedButton { /* merge consecutive segments with identical leaflet positions */
+        enabled: !isTreating
+        Layout.preferredHeight: root.btn_height
+        Layout.fillWidth: true
+        text: "Merge"
+        font.pointSize: root.fontsize
+        onClicked: {
+          var d = DynamicQML.createDynamicObject(mainwindow, "QMessageDialog.qml", {
+            'title': 'Merge Redundant Segments?',
+            'text': "Consecutive segments with identical leaflet positions will be merged into one segment with their " +
+                    "combined beam-on time. Gantry/couch annotations of the merged segments are dropped.",
+            'standardButtons': 4195328 /* StandardButton.Ok | StandardButton.Cancel */
+          })
+          d.onAccepted.connect( function() {
+            var removed = SequenceListModel.mergeStationary();
+            footer_status.text = removed > 0 ? "Merged " + removed + " redundant segments" : "No redundant segments found";
+            d.destroy(); /* cleanup */
+          });
+          d.onRejected.connect( function() { d.destroy(); /* cleanup */ });
+          d.open()
+        }
+      }
       QStylizedButton { /* clear list */
         enabled: !isTreating
         Layout.preferredHeight: root.btn_height
@@ -183,13 +266,15 @@ RowLayout {
         }
         return true;
       }
-      function startTreatment() {
+      function startTreatment(first_ms) {
+        // first_ms: beam-on time (ms) left for the first segment when resuming an interrupted treatment
         if (!canStartTreatment()) { return; }
         connectUItoHW(false);
         if (lvseq.currentIndex < 0) { lvseq.currentIndex = 0; }
         footer_status.text = "Treatment started";
         isTreating = true;
-        TreatmentManager.startTreatment(lvseq.currentIndex);
+        if (first_ms === undefined) { TreatmentManager.startTreatment(lvseq.currentIndex); }
+        else { TreatmentManager.resumeTreatment(lvseq.currentIndex, first_ms); }
         timer_elapsed.restart()
         // timer_treat.start()
       }
@@ -221,7 +306,7 @@ RowLayout {
           footer_status.text = "Treatment stopped";
           isTreating = false;
           // timer_treat.stop();
-          lvseq.currentIndex = idx;
+          lvseq.select(idx);
           connectUItoHW(true);
           timer_elapsed.stop();
       }
@@ -229,7 +314,7 @@ RowLayout {
           footer_status.text = "Treatment aborted";
           isTreating = false;
           // timer_treat.stop();
-          lvseq.currentIndex = idx;
+          lvseq.select(idx);
           connectUItoHW(true);
           error_overlay.visible = true;
       }
@@ -249,7 +334,7 @@ RowLayout {
         TreatmentManager.onTreatmentAborted.connect(treatmentAborted)
         TreatmentManager.onTreatmentCompleted.connect(treatmentCompleted);
         TreatmentManager.onTreatmentAdvance.connect(function(idx) {
-          lvseq.currentIndex = idx;
+          lvseq.select(idx);
           updateSOCConfig(false);
         });
         TreatmentManager.onTreatmentSkip.connect(function(idx, duration) {
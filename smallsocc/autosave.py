@@ -0,0 +1,320 @@
+""" autosave.py
+
+Crash-safe background autosave of the plan being edited.
+
+Edits of a SequenceListModel (its planEdited signal) are collected on the GUI thread and flushed once no
+edit arrived for delay_ms, so a burst of edits (typing, dragging a leaflet) costs one write. A flush either
+queues a full snapshot of the plan or appends the collected edits to a journal; both are written by an
+AutosaveWriter thread, so autosaving never blocks the UI on disk I/O.
+
+Files in the autosave directory:
+    autosave.<gen>.socplan   snapshot <gen> of the plan, in the binary plan format (see planio.py)
+    autosave.journal         json lines: a header {"snapshot": <gen>, "unsaved": [<row>, ...], ...}, then one
+                             record per edit made after snapshot <gen> was taken
+
+Snapshots and the journal header are written to a temporary file, fsynced and moved into place with
+os.replace(), so either the old or the new file is found after a crash, never a partial one. A snapshot is
+written before the journal that refers to it, and older snapshots are only removed after that, so the
+journal always names a complete snapshot. Journal records are appended and fsynced after each flush; a
+record torn by a crash (and everything after it) is ignored by recover().
+
+Loading a plan file is not an edit: it drops the autosave, which is written again at the next edit.
+"""
+import os
+import re
+import json
+import logging
+import numpy as np
+from PyQt5.QtCore import QObject, QThread, QMutex, QWaitCondition, QTimer, pyqtSlot
+
+import hwmodel
+import planio
+
+logger = logging.getLogger(__name__)
+
+JOURNAL = 'autosave.journal'
+SNAPSHOT = 'autosave.{:d}' + planio.BINARY_EXT
+_SNAPSHOT_RE = re.compile(r'^autosave\.(\d+)' + re.escape(planio.BINARY_EXT) + '$')
+
+def default_dir():
+    return os.path.join(os.path.expanduser('~'), '.smallsocc', 'autosave')
+
+def _snapshots(directory):
+    """ {gen: path} of the snapshot files in directory """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+    return {int(m.group(1)): os.path.join(directory, name) for m, name in
+            ((_SNAPSHOT_RE.match(name), name) for name in names) if m}
+
+def _fsync_dir(directory):
+    # make the os.replace() durable too (not possible on every platform)
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _replay(store, record):
+    op, row = record['op'], record['row']
+    if op == 'set':
+        for k, v in record['values'].items():
+            store.set(row, k, v)
+    elif op == 'insert':
+        store.insert(row, record['rows'])
+        store.unsaved[row:row+len(record['rows'])] = True
+    elif op == 'remove':
+        store.remove(row, record['count'])
+    elif op == 'move':
+        store.move(row, record['dst'])
+    else:
+        raise ValueError('unknown autosave record "{}"'.format(op))
+
+def recover(directory, nleaflets=hwmodel.NLEAFLETS):
+    """ rebuild the autosaved plan: the journal's snapshot with the journaled edits replayed
+
+    Falls back to the newest snapshot if the journal is missing or unreadable.
+
+    Returns:
+        SequenceStore, or None if there is nothing to recover
+    """
+    snapshots = _snapshots(directory)
+    lines = []
+    try:
+        with open(os.path.join(directory, JOURNAL), 'rb') as f:
+            lines = f.read().split(b'\n')
+    except FileNotFoundError:
+        pass
+    gen = None
+    unsaved = None
+    if lines:
+        try:
+            header = json.loads(lines[0].decode('utf-8'))
+            gen, unsaved = int(header['snapshot']), header.get('unsaved')
+        except Exception:
+            logger.warning('autosave journal in "{}" is unreadable; using the newest snapshot'.format(directory))
+    if gen not in snapshots:
+        if not snapshots:
+            return None
+        gen, lines, unsaved = max(snapshots), [], None
+    try:
+        store = planio.load_binary(snapshots[gen], nleaflets)
+    except Exception:
+        logger.exception('failed to read autosave snapshot "{}"'.format(snapshots[gen]))
+        return None
+    # without the header's list, which rows were unsaved is unknown: show all of them as unsaved
+    if unsaved is None:
+        store.unsaved[:] = True
+    else:
+        store.unsaved[[row for row in unsaved if 0 <= row < len(store)]] = True
+    # the last element is what follows the final newline: b'' unless that line was torn
+    records = 0
+    for line in lines[1:-1]:
+        try:
+            _replay(store, json.loads(line.decode('utf-8')))
+        except Exception:
+            logger.warning('autosave journal in "{}" is corrupt after record {:d}; ignoring the rest'.format(directory, records))
+            break
+        records += 1
+    logger.info('recovered {:d} segments from autosave snapshot {:d} and {:d} journaled edits'.format(len(store), gen, records))
+    return store
+
+def discard(directory):
+    """ remove all autosave files from directory """
+    for path in list(_snapshots(directory).values()) + [os.path.join(directory, JOURNAL)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class AutosaveWriter(QThread):
+    """ writes queued snapshots and journal records, in order """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.alive = True
+        self._pending = [] # ('snapshot', gen, store) | ('append', lines) | ('discard',)
+        self._lock = QMutex()
+        self._wait_tasks = QWaitCondition()
+
+    def put(self, task):
+        self._lock.lock()
+        self._pending.append(task)
+        self._wait_tasks.wakeAll()
+        self._lock.unlock()
+
+    def close(self):
+        """ write everything still queued and stop """
+        self._lock.lock()
+        self.alive = False
+        self._wait_tasks.wakeAll()
+        self._lock.unlock()
+
+    def _replace(self, path, write):
+        tmp = path + '.tmp'
+        write(tmp)
+        with open(tmp, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _snapshot(self, gen, store):
+        path = os.path.join(self.directory, SNAPSHOT.format(gen))
+        self._replace(path, lambda tmp: planio.save_binary(store, tmp))
+        header = json.dumps({'snapshot': gen, 'nleaflets': store.nleaflets, 'segments': len(store),
+                             'unsaved': np.flatnonzero(store.unsaved).tolist()}) + '\n'
+        def write_header(tmp):
+            with open(tmp, 'w') as f:
+                f.write(header)
+        self._replace(os.path.join(self.directory, JOURNAL), write_header)
+        _fsync_dir(self.directory)
+        for old, oldpath in _snapshots(self.directory).items():
+            if old != gen:
+                os.remove(oldpath)
+        logger.debug('autosaved snapshot {:d} of {:d} segments'.format(gen, len(store)))
+
+    def _append(self, lines):
+        fd = os.open(os.path.join(self.directory, JOURNAL), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, ''.join(lines).encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, task):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if task[0] == 'snapshot':
+                self._snapshot(*task[1:])
+            elif task[0] == 'append':
+                self._append(*task[1:])
+            elif task[0] == 'discard':
+                discard(self.directory)
+        except Exception:
+            logger.exception('autosave to "{}" failed'.format(self.directory))
+
+    def run(self):
+        while True:
+            self._lock.lock()
+            while self.alive and not self._pending:
+                self._wait_tasks.wait(self._lock)
+            batch, self._pending = self._pending, []
+            alive = self.alive
+            self._lock.unlock()
+            for task in batch:
+                self._write(task)
+            if not alive:
+                break
+
+
+class Autosave(QObject):
+    """ autosaves the plan of a SequenceListModel to directory (see the module docstring) """
+
+    def __init__(self, model, directory, delay_ms=1000, snapshot_every=500, parent=None):
+        """
+        Args:
+            delay_ms (int): flush once no edit arrived for this long
+            snapshot_every (int): journaled edits after which the next flush writes a new snapshot instead
+        """
+        super().__init__(parent)
+        self.model = model
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self._records = [] # journal records collected since the last flush
+        self._journaled = 0 # records in the journal since its snapshot
+        self._snapshot_needed = True # no snapshot of the current plan was written yet
+        self._gen = max(_snapshots(directory), default=0) # never overwrite a snapshot left by an earlier session
+        self._edited = False
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay_ms)
+        self._timer.timeout.connect(self.flush)
+        self._writer = AutosaveWriter(directory)
+        self._writer.start()
+        self.model.planEdited.connect(self._onPlanEdited)
+
+    def _onPlanEdited(self, op, row, arg):
+        # rows are packed now: later edits would change what a record at flush time holds
+        store = self.model._store
+        if op == 'load':
+            # the plan equals its file again: nothing to recover until the next edit
+            self.discard()
+            return
+        self._edited = True
+        if op == 'reset':
+            self._snapshot_needed = True
+            self._records = []
+        elif self._snapshot_needed:
+            pass # the snapshot will hold this edit
+        elif op == 'set':
+            record = {'op': 'set', 'row': row, 'values': store.packRow(row)}
+            if self._records and self._records[-1]['op'] == 'set' and self._records[-1]['row'] == row:
+                self._records[-1] = record
+            else:
+                self._records.append(record)
+        elif op == 'insert':
+            self._records.append({'op': 'insert', 'row': row, 'rows': [store.packRow(r) for r in range(row, row+arg)]})
+        elif op == 'remove':
+            self._records.append({'op': 'remove', 'row': row, 'count': arg})
+        elif op == 'move':
+            self._records.append({'op': 'move', 'row': row, 'dst': arg})
+        self._timer.start()
+
+    @pyqtSlot()
+    def flush(self):
+        """ queue everything edited since the last flush for writing """
+        self._timer.stop()
+        if not self._edited:
+            return
+        self._edited = False
+        if self._snapshot_needed or self._journaled + len(self._records) > self.snapshot_every:
+            self._gen += 1
+            self._writer.put(('snapshot', self._gen, self.model._store.copy()))
+            self._snapshot_needed = False
+            self._journaled = 0
+        elif self._records:
+            self._writer.put(('append', [json.dumps(r, sort_keys=True) + '\n' for r in self._records]))
+            self._journaled += len(self._records)
+        self._records = []
+
+    @pyqtSlot(result=bool)
+    def recoverable(self):
+        """ True if an earlier session left an autosaved plan """
+        return bool(_snapshots(self.directory))
+
+    @pyqtSlot(result=bool)
+    def restore(self):
+        """ replace the plan with the autosaved one (it stays marked as modified until saved, and its edited
+        rows as unsaved) """
+        store = recover(self.directory, self.model._store.nleaflets)
+        if store is None:
+            return False
+        self.model.loadStore(store)
+        return True
+
+    @pyqtSlot()
+    def discard(self):
+        """ drop the autosaved plan """
+        self._timer.stop()
+        self._records = []
+        self._edited = False
+        self._snapshot_needed = True
+        self._writer.put(('discard',))
+
+    @pyqtSlot()
+    def close(self):
+        """ write everything still pending and stop; the autosave is dropped if the plan has no unsaved edits """
+        self.model.planEdited.disconnect(self._onPlanEdited)
+        if self.model.isModified():
+            self.flush()
+        else:
+            self.discard()
+        self._writer.close()
+        self._writer.wait()
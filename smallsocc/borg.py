@@ -14,3 +14,9 @@ class Borg():
     _shared_state = {}
     def __init__(self):
         self.__dict__ = self._shared_state
+
+class KeyedBorg():
+    """ Borg whose instances share state only with instances created with the same key """
+    _shared_states = {}
+    def __init__(self, key=None):
+        self.__dict__ = self._shared_states.setdefault(key, {})
@@ -0,0 +1,91 @@
+""" constraints.py
+
+Host-side mirror of the firmware's leaflet travel limits, vectorized with NumPy.
+
+The firmware rejects (with SIG_HWERROR) any move in which an opposing leaflet pair would exceed its
+combined travel after step scaling (see hwmodel.COLLISION_PAIRS, hwmodel.STEP_SCALE). These helpers apply
+the same model to a whole plan at once, reporting every violating row, and clamp interactive leaflet
+changes so that invalid positions are never sent.
+"""
+from collections import namedtuple
+import numpy as np
+
+import hwmodel
+
+STEP_SCALE = np.array(hwmodel.STEP_SCALE, dtype=np.float64)
+PAIR_A     = np.array([a for a, b, limit in hwmodel.COLLISION_PAIRS], dtype=np.intp)
+PAIR_B     = np.array([b for a, b, limit in hwmodel.COLLISION_PAIRS], dtype=np.intp)
+PAIR_LIMIT = np.array([limit for a, b, limit in hwmodel.COLLISION_PAIRS], dtype=np.int64)
+
+# leaflet -> (opposing leaflet, limit) for clamping single-leaflet changes
+_partner = {}
+for a, b, limit in hwmodel.COLLISION_PAIRS:
+    _partner[a] = (b, limit)
+    _partner[b] = (a, limit)
+
+Violation = namedtuple('Violation', ['row', 'kind', 'leaflets', 'value', 'limit'])
+Violation.__doc__ = """ one constraint violation; kind is 'collision' (value: combined motor steps of the pair)
+or 'range' (value: leaflet extension) """
+
+def to_steps(positions):
+    """ leaflet extensions (..., NLEAFLETS) -> firmware motor steps, truncated like hwmodel.to_steps() """
+    return np.trunc(np.asarray(positions, dtype=np.float64)*STEP_SCALE).astype(np.int64)
+
+def pair_steps(positions):
+    """ combined motor steps of every opposing pair, shape (..., len(COLLISION_PAIRS)) """
+    steps = to_steps(positions)
+    return steps[..., PAIR_A] + steps[..., PAIR_B]
+
+def collision_mask(positions):
+    """ boolean mask (..., len(COLLISION_PAIRS)) of pairs exceeding their limit """
+    return pair_steps(positions) > PAIR_LIMIT
+
+def check_plan(positions, min_ext=hwmodel.MIN_EXTENSION, max_ext=hwmodel.MAX_EXTENSION):
+    """ check every row of an (nrows, nleaflets) array of leaflet extensions in one pass; collision limits
+    are only known for NLEAFLETS leaflets
+
+    Returns:
+        list of Violation, ordered by row
+    """
+    positions = np.atleast_2d(np.asarray(positions, dtype=np.int64))
+    violations = []
+    rows, leaflets = np.nonzero((positions < min_ext) | (positions > max_ext))
+    for row, leaflet in zip(rows.tolist(), leaflets.tolist()):
+        value = int(positions[row, leaflet])
+        violations.append(Violation(row, 'range', (leaflet,), value, min_ext if value < min_ext else max_ext))
+    if positions.shape[-1] == hwmodel.NLEAFLETS:
+        sums = pair_steps(positions)
+        rows, pairs = np.nonzero(sums > PAIR_LIMIT)
+        for row, pair in zip(rows.tolist(), pairs.tolist()):
+            violations.append(Violation(row, 'collision', (int(PAIR_A[pair]), int(PAIR_B[pair])),
+                                        int(sums[row, pair]), int(PAIR_LIMIT[pair])))
+    violations.sort(key=lambda v: v.row)
+    return violations
+
+def describe(violation, min_ext=hwmodel.MIN_EXTENSION, max_ext=hwmodel.MAX_EXTENSION):
+    if violation.kind == 'collision':
+        return 'leaflets #{:d} and #{:d} would collide ({:d} combined steps, limit {:d})'.format(
+            violation.leaflets[0]+1, violation.leaflets[1]+1, violation.value, violation.limit)
+    return 'extension of leaflet #{:d} ({:d}) is outside [{:d}, {:d}]'.format(
+        violation.leaflets[0]+1, violation.value, min_ext, max_ext)
+
+def max_extension(idx, partner_extension):
+    """ largest extension of leaflet idx that does not collide with its opposing leaflet """
+    partner, limit = _partner[idx]
+    remaining = limit - int(partner_extension*hwmodel.STEP_SCALE[partner])
+    scale = hwmodel.STEP_SCALE[idx]
+    ext = int(remaining/scale)
+    # step truncation makes the bound inexact by one; settle it against the exact model
+    while int((ext+1)*scale) <= remaining:
+        ext += 1
+    while ext > 0 and int(ext*scale) > remaining:
+        ext -= 1
+    return max(0, min(ext, hwmodel.MAX_EXTENSION))
+
+def clamp_extension(idx, value, positions):
+    """ clamp a new extension for leaflet idx so that it respects the travel range and the collision
+    limit against its opposing leaflet's extension in positions """
+    value = min(max(value, hwmodel.MIN_EXTENSION), hwmodel.MAX_EXTENSION)
+    if idx in _partner:
+        value = min(value, max_extension(idx, positions[_partner[idx][0]]))
+    return value
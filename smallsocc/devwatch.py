@@ -0,0 +1,54 @@
+""" devwatch.py
+
+Minimal inotify wrapper (through ctypes, Linux only) that makes the appearance of device nodes in /dev
+selectable, so that the serial thread can react to a re-plugged device immediately instead of polling.
+"""
+import os
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger(__name__)
+
+IN_ATTRIB   = 0x00000004 # udev fixes permissions after creating the node
+IN_CREATE   = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC  = 0o2000000
+
+class DeviceWatcher():
+    """ readable file descriptor that becomes ready when entries in a directory are created or changed """
+
+    def __init__(self, path='/dev'):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self._fd, os.fsencode(path), IN_CREATE | IN_ATTRIB) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, 'inotify_add_watch failed for "{}"'.format(path))
+
+    @classmethod
+    def create(cls, path='/dev'):
+        """ returns a DeviceWatcher, or None where inotify is unavailable """
+        try:
+            return cls(path)
+        except (OSError, AttributeError, TypeError) as e:
+            logger.debug('device hotplug watching unavailable: {!s}'.format(e))
+            return None
+
+    def fileno(self):
+        return self._fd
+
+    def drain(self):
+        """ discard pending events (their content is irrelevant, any change triggers a retry) """
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -0,0 +1,202 @@
+""" emulator.py
+
+In-process stand-in for the SOC hardware, used by SerialThread when no serial device is available.
+
+EmulatedDevice accepts the same byte frames that are written to the serial port, interprets them the way
+the firmware does, and answers through Protocol.data_received() with the firmware's 2-byte signals after
+a delay modeled on the firmware's stepping cadence. It is driven by SerialThread.run() and sleeps on a
+wait condition whenever there is nothing to do.
+"""
+import time
+import logging
+from PyQt5.QtCore import QMutex, QWaitCondition
+
+import hwmodel
+from motionmodel import MotionModel
+from hwmodel import MAGIC_BYTES, PRE_ABSPOS_ALL, PRE_CALIBRATE, SIG_MOVE_OK, SIG_HWERROR, \
+                    PRE_QUERY_CAPS, PRE_ABSPOS_BATCH, PRE_FLUSH_BATCH, SIG_CAPS, SIG_MOVE_OK_SEQ, SIG_HWERROR_SEQ, \
+                    SEQ_MODULUS, encode_seq
+
+logger = logging.getLogger(__name__)
+
+class EmulatedDevice():
+    """ Emulates the firmware command loop behind the write()/Protocol interface of SerialThread """
+
+    def __init__(self, protocol, nleaflets=hwmodel.NLEAFLETS, debug_text=True, time_scale=1.0, batch_size=0,
+                 step_period=hwmodel.STEP_PERIOD_S):
+        """
+        Args:
+            protocol:          Protocol instance that receives the device's output through data_received()
+            debug_text (bool): also send the firmware's DEBUG text lines
+            time_scale (float): multiplier applied to modeled move durations (0 to answer immediately)
+            batch_size (int):  batch records advertised through SIG_CAPS (0, the default, to emulate stock
+                               firmware without the pipelined-upload extension, which never answers PRE_QUERY_CAPS)
+            step_period (float): seconds per motor step used to model move durations
+        """
+        self.protocol = protocol
+        self.nleaflets = nleaflets
+        self.debug_text = debug_text
+        self.time_scale = time_scale
+        self.batch_size = batch_size
+        self.step_period = step_period
+        self._motion = MotionModel(step_period_s=step_period)
+        self.alive = True
+        self._generation = 0 # incremented by PRE_FLUSH_BATCH to cancel queued/dwelling batch records
+        self._steps = [0]*nleaflets
+        self._inbuf = bytearray()
+        self._commands = []
+        self._lock = QMutex()
+        self._wait_command = QWaitCondition()
+
+    def write(self, data):
+        """ receive bytes from the host (thread safe, never blocks on a move) """
+        self._lock.lock()
+        self._inbuf += data
+        self._parse()
+        self._wait_command.wakeAll()
+        self._lock.unlock()
+
+    def stop(self):
+        """ abort any move in progress and return from serve() """
+        self._lock.lock()
+        self.alive = False
+        self._wait_command.wakeAll()
+        self._lock.unlock()
+
+    def _parse(self):
+        """ split buffered input into commands, mirroring the firmware's readBytes() sequence (lock held) """
+        buf = self._inbuf
+        payload_size = 2*self.nleaflets
+        while True:
+            idx = buf.find(MAGIC_BYTES)
+            if idx < 0:
+                # keep a trailing partial magic sequence
+                del buf[:-1 if buf[-1:] == MAGIC_BYTES[:1] else len(buf)]
+                return
+            del buf[:idx]
+            if len(buf) < 3:
+                return
+            pre = bytes(buf[2:3])
+            if pre == PRE_ABSPOS_ALL:
+                if len(buf) < 3+payload_size:
+                    return
+                payload = bytes(buf[3:3+payload_size])
+                del buf[:3+payload_size]
+                # (uint16_t) cast into a 16-bit AVR int: effectively signed
+                poslist = [int.from_bytes(payload[ii:ii+2], byteorder='big', signed=True)
+                           for ii in range(0, payload_size, 2)]
+                self._commands.append((PRE_ABSPOS_ALL, poslist))
+            elif pre == PRE_CALIBRATE:
+                del buf[:3]
+                self._commands.append((PRE_CALIBRATE, None))
+            elif pre == PRE_QUERY_CAPS and self.batch_size:
+                del buf[:3]
+                self._commands.append((PRE_QUERY_CAPS, None))
+            elif pre == PRE_ABSPOS_BATCH and self.batch_size:
+                record_size = payload_size+4
+                if len(buf) < 6 or len(buf) < 6+buf[3]*record_size:
+                    return
+                count, seq = buf[3], int.from_bytes(buf[4:6], byteorder='big')
+                for ii in range(count):
+                    record = bytes(buf[6+ii*record_size:6+(ii+1)*record_size])
+                    poslist = [int.from_bytes(record[jj:jj+2], byteorder='big', signed=True)
+                               for jj in range(0, payload_size, 2)]
+                    dwell_ms = int.from_bytes(record[payload_size:], byteorder='big')
+                    self._commands.append((PRE_ABSPOS_BATCH, ((seq+ii)%SEQ_MODULUS, poslist, dwell_ms, self._generation)))
+                del buf[:6+count*record_size]
+            elif pre == PRE_FLUSH_BATCH and self.batch_size:
+                # handled on receipt so that it overtakes queued records
+                del buf[:3]
+                self._generation += 1
+                self._commands = [c for c in self._commands if c[0] != PRE_ABSPOS_BATCH]
+            else:
+                # firmware silently ignores anything else (including PRE_ABSPOS_ONE)
+                logger.debug('emulator ignoring command 0x{}'.format(pre.hex()))
+                del buf[:3]
+
+    def _send(self, data):
+        try:
+            self.protocol.data_received(data)
+        except Exception:
+            logger.exception("Error in Protocol.data_received()")
+
+    def _println(self, text):
+        if self.debug_text:
+            self._send(text.encode('ascii') + b'\r\n')
+
+    def _sleep(self, seconds, generation=None):
+        """ wait for a duration, returning early on stop() or when a batch generation is flushed """
+        deadline = time.perf_counter() + seconds
+        self._lock.lock()
+        while self.alive and (generation is None or generation == self._generation):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self._wait_command.wait(self._lock, max(1, int(remaining*1000)))
+        self._lock.unlock()
+
+    def _move(self, poslist, generation=None):
+        """ emulate MoveLeavesToPosition(); returns False if the move was rejected or interrupted """
+        steps = hwmodel.to_steps(poslist)
+        if not hwmodel.is_collision_free(steps):
+            self._println("Oops, those new leaf positions may cause a collision.")
+            return False
+        duration = float(self._motion.move_time(self._steps, steps))
+        logger.debug('emulating leaflet move lasting {:.1f}ms'.format(duration*1000))
+        self._sleep(duration*self.time_scale, generation)
+        if not self.alive or (generation is not None and generation != self._generation):
+            return False
+        self._steps = steps
+        return True
+
+    def _execute(self, pre, args):
+        """ run one command, replying through the protocol """
+        if pre == PRE_QUERY_CAPS:
+            self._send(SIG_CAPS + bytes([0x80 | min(self.batch_size, 0x7F)]) + b'\x00')
+            return
+
+        if pre == PRE_ABSPOS_BATCH:
+            seq, poslist, dwell_ms, generation = args
+            if generation != self._generation:
+                return
+            if not self._move(poslist, generation):
+                if self.alive and generation == self._generation:
+                    self._send(SIG_HWERROR_SEQ + encode_seq(seq) + b'\x00')
+                    # drop the rest of the batch, like a flush
+                    self._lock.lock()
+                    self._generation += 1
+                    self._commands = [c for c in self._commands if c[0] != PRE_ABSPOS_BATCH]
+                    self._lock.unlock()
+                return
+            self._send(SIG_MOVE_OK_SEQ + encode_seq(seq) + b'\x00')
+            self._sleep(dwell_ms*0.001, generation)
+            return
+
+        if pre == PRE_CALIBRATE:
+            self._steps = [0]*self.nleaflets
+            self._send(SIG_MOVE_OK + b'\x00')
+            self._println("Wooh, leaves calibrated successfully!")
+            return
+
+        self._println("Leaf positions received")
+        if not self._move(args):
+            if self.alive:
+                self._send(SIG_HWERROR + b'\x00')
+            return
+        self._send(SIG_MOVE_OK + b'\x00')
+        self._println("Wooh, leaves moved successfully!")
+
+    def serve(self):
+        """ process commands until stop() is called; sleeps while idle """
+        logger.info('emulated device ready')
+        while True:
+            self._lock.lock()
+            while self.alive and not self._commands:
+                self._wait_command.wait(self._lock)
+            if not self.alive:
+                self._lock.unlock()
+                break
+            pre, args = self._commands.pop(0)
+            self._lock.unlock()
+            # reply without holding the lock so slots connected to the protocol may write() again
+            self._execute(pre, args)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+""" fakedevice.py
+
+Out-of-process stand-in for the SOC hardware. Opens a Linux pseudo-terminal and speaks the firmware's
+exact byte protocol on it (interpreted by emulator.EmulatedDevice), so that SerialThread, HWSOC and the
+TreatmentManager can be exercised through a real OS serial path without an Arduino attached.
+
+Move timing and faults (dropped acks, spurious HWERRORs, disconnects) are configurable.
+
+usage:
+    python smallsocc/fakedevice.py --link /tmp/soc_fake
+    smallsocc --port /tmp/soc_fake
+"""
+import os
+import sys
+import pty
+import tty
+import time
+import random
+import select
+import argparse
+import logging
+import threading
+
+FILE_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, FILE_DIR)
+
+import hwmodel
+from emulator import EmulatedDevice
+
+logger = logging.getLogger(__name__)
+
+class PtyLink():
+    """ Protocol stand-in receiving EmulatedDevice output; writes it to the pty with optional fault injection """
+
+    def __init__(self, fd, drop_ack=0.0, hwerror=0.0, disconnect_after=None, seed=None):
+        """
+        Args:
+            drop_ack (float):       probability that a MOVE_OK is never sent
+            hwerror (float):        probability that a MOVE_OK is replaced by HWERROR
+            disconnect_after (int): hang up after this many acks
+        """
+        self.fd = fd
+        self.drop_ack = drop_ack
+        self.hwerror = hwerror
+        self.disconnect_after = disconnect_after
+        self.nacks = 0
+        self.hangup = threading.Event()
+        self._rng = random.Random(seed)
+
+    def data_received(self, data):
+        sig = data[:1]
+        if data[-1:] == b'\x00' and sig in (hwmodel.SIG_MOVE_OK, hwmodel.SIG_MOVE_OK_SEQ):
+            self.nacks += 1
+            if self._rng.random() < self.drop_ack:
+                logger.warning('fault injection: dropping ack #{:d}'.format(self.nacks))
+                return
+            if self._rng.random() < self.hwerror:
+                logger.warning('fault injection: replacing ack #{:d} with HWERROR'.format(self.nacks))
+                data = (hwmodel.SIG_HWERROR if sig == hwmodel.SIG_MOVE_OK else hwmodel.SIG_HWERROR_SEQ) + data[1:]
+        if self.hangup.is_set():
+            return
+        try:
+            os.write(self.fd, data)
+        except OSError:
+            self.hangup.set()
+            return
+        if self.disconnect_after and self.nacks >= self.disconnect_after:
+            logger.warning('fault injection: disconnecting after {:d} acks'.format(self.nacks))
+            self.hangup.set()
+
+
+class FakeDevice():
+    """ serves the firmware protocol on a pty until interrupted, optionally re-appearing after a hangup """
+
+    def __init__(self, link=None, reconnect_delay=None, device_options={}, link_options={}):
+        """
+        Args:
+            link (str):              maintain a symlink at this path pointing to the current pty
+            reconnect_delay (float): after a hangup, open a new pty after this many seconds (exit if None)
+        """
+        self.link = link
+        self.reconnect_delay = reconnect_delay
+        self.device_options = device_options
+        self.link_options = link_options
+        self.path = None
+
+    def _open(self):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        if self.link:
+            tmp = self.link + '.tmp'
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            os.symlink(self.path, tmp)
+            os.replace(tmp, self.link)
+        print(self.path, flush=True)
+        logger.info('fake device listening on {}'.format(self.link or self.path))
+        return master, slave
+
+    def serve_session(self):
+        """ run one connection lifetime; returns when the link hangs up """
+        master, slave = self._open()
+        link = PtyLink(master, **self.link_options)
+        device = EmulatedDevice(link, **self.device_options)
+        thread = threading.Thread(target=device.serve, daemon=True)
+        thread.start()
+        try:
+            while not link.hangup.is_set():
+                ready, _, _ = select.select([master], [], [], 0.1)
+                if ready:
+                    try:
+                        data = os.read(master, 4096)
+                    except OSError:
+                        # EIO while no host has the port open
+                        time.sleep(0.05)
+                        continue
+                    device.write(data)
+        finally:
+            device.stop()
+            thread.join()
+            os.close(master)
+            os.close(slave)
+
+    def serve_forever(self):
+        try:
+            while True:
+                self.serve_session()
+                if self.reconnect_delay is None:
+                    break
+                time.sleep(self.reconnect_delay)
+        finally:
+            if self.link and os.path.lexists(self.link):
+                os.remove(self.link)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='pseudo-terminal SOC hardware emulator (linux only)',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--link', type=str, default=None, help='symlink to (re)point at the current pty')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='multiplier on modeled move durations')
+    parser.add_argument('--step-period', type=float, default=hwmodel.STEP_PERIOD_S, help='seconds per motor step')
+    parser.add_argument('--batch-size', type=int, default=0, help='batch records advertised (0: stock firmware without the batch extension)')
+    parser.add_argument('--no-debug-text', action='store_true', help='do not send the firmware DEBUG text lines')
+    parser.add_argument('--drop-ack', type=float, default=0.0, help='probability of dropping each MOVE_OK')
+    parser.add_argument('--hwerror', type=float, default=0.0, help='probability of answering HWERROR instead of MOVE_OK')
+    parser.add_argument('--disconnect-after', type=int, default=None, help='hang up after this many acks')
+    parser.add_argument('--reconnect-delay', type=float, default=None, help='re-appear this many seconds after a hang up')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for fault injection')
+    parser.add_argument('-L', '--loglevel', type=str, default='WARNING', help='set the loglevel')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.loglevel)
+
+    fake = FakeDevice(link=args.link, reconnect_delay=args.reconnect_delay,
+                      device_options={'time_scale': args.time_scale,
+                                      'step_period': args.step_period,
+                                      'batch_size': args.batch_size,
+                                      'debug_text': not args.no_debug_text},
+                      link_options={'drop_ack': args.drop_ack,
+                                    'hwerror': args.hwerror,
+                                    'disconnect_after': args.disconnect_after,
+                                    'seed': args.seed})
+    try:
+        fake.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    sys.exit(main())
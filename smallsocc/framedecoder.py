@@ -0,0 +1,84 @@
+""" framedecoder.py
+
+Incremental decoder for the byte stream returned by the SOC hardware.
+
+The firmware emits two kinds of frames on the same serial line:
+  - binary signals, terminated by b'\\x00' (see SendSignal() in the firmware)
+  - DEBUG text lines, terminated by b'\\n' (Serial.println())
+
+FrameDecoder keeps a single growable bytearray and a scan cursor so that every received byte is
+inspected exactly once, no matter how the stream is chunked by the serial driver.
+"""
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEP_SIGNAL = b'\x00'
+SEP_TEXT   = b'\n'
+
+class FrameDecoder():
+    """ Stateful, linear-time splitter producing (separator, frame) events from a chunked byte stream """
+    _re_sep = re.compile(b'[\x00\n]')
+
+    def __init__(self, max_frame_size=65536):
+        """
+        Args:
+            max_frame_size (int): discard buffered bytes if this many accumulate without any separator
+        """
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+        self._scan = 0          # offset into _buf where searching for the next separator resumes
+        self.high_water = 0     # largest number of bytes ever held in _buf
+        self.bytes_in = 0       # total bytes fed
+        self.frames_out = 0     # total frames produced
+        self.bytes_dropped = 0  # bytes discarded by overflow protection
+
+    def __len__(self):
+        """ number of buffered bytes not yet part of a complete frame """
+        return len(self._buf)
+
+    def reset(self):
+        """ discard any partially received frame """
+        self._buf.clear()
+        self._scan = 0
+
+    def feed(self, data):
+        """ append data to the stream and return the list of all frames it completed
+
+        Returns:
+            list of (sep, frame) tuples where sep is SEP_SIGNAL or SEP_TEXT and frame is bytes excluding sep
+        """
+        buf = self._buf
+        buf += data
+        self.bytes_in += len(data)
+        if len(buf) > self.high_water:
+            self.high_water = len(buf)
+
+        events = []
+        start = 0
+        for m in self._re_sep.finditer(buf, self._scan):
+            end = m.start()
+            events.append((SEP_SIGNAL if buf[end] == 0 else SEP_TEXT, bytes(buf[start:end])))
+            start = end+1
+
+        if start:
+            # consume completed frames; deleting from the front of a bytearray is amortized O(1)
+            del buf[:start]
+        self._scan = len(buf)
+
+        if self._scan > self.max_frame_size:
+            logger.warning('discarding {:d} bytes received without a frame separator'.format(self._scan))
+            self.bytes_dropped += self._scan
+            self.reset()
+
+        self.frames_out += len(events)
+        return events
+
+    def stats(self):
+        """ dict of decoder counters, suitable for logging """
+        return {'bytes_in': self.bytes_in,
+                'frames_out': self.frames_out,
+                'bytes_dropped': self.bytes_dropped,
+                'buffered': len(self._buf),
+                'high_water': self.high_water}
@@ -29,6 +29,10 @@ import leaflet
 import leafletassembly
 import sequence
 from treatmentmanager import TreatmentManager, TreatmentManagerProxy
+from journal import DeliveryJournal
+import journal
+from autosave import Autosave
+import autosave
 import pathhandler
 
 logger = logging.getLogger(__name__)
@@ -82,12 +86,16 @@ def start_gui():
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-L', '--loglevel', type=str, choices=sorted([*logging._nameToLevel.keys()], key=lambda x: logging._nameToLevel[x], reverse=True), default='WARNING', help='set the loglevel')
     parser.add_argument('--logconf', type=str, default=os.path.join(LIB_DIR, 'logging.conf.json'), help='path to log configuration')
+    parser.add_argument('--port', type=str, default=None, help='serial port path to open instead of discovering devices')
+    parser.add_argument('--emulator-batch', type=int, default=0, help='batch records the emulated device advertises when no HW is found (0: stock firmware)')
+    parser.add_argument('--journal', type=str, default=journal.default_path(), help='delivery journal for crash recovery (empty to disable)')
+    parser.add_argument('--autosave', type=str, default=autosave.default_dir(), help='directory for autosaving the edited plan (empty to disable)')
     args = parser.parse_args()
 
     # initialize logger
     soclog.init_logging(level=logging._nameToLevel.get(args.loglevel, None), config_path=args.logconf)
 
-    hwsoc = HWSOC(8, HID=None, BAUD=None) # init singleton instance for controlling hardware
+    hwsoc = HWSOC(8, HID=None, BAUD=None, PORT=args.port, emulator_batch=args.emulator_batch) # init singleton instance for controlling hardware
 
     listmodel = sequence.SequenceListModel()
     if args.loglevel is not 'NOTSET' and logging._nameToLevel[args.loglevel] <= logging.DEBUG:
@@ -143,10 +151,14 @@ def start_gui():
     fratio = min(_h*refDpi/(dpi*refHeight), _w*refDpi/(dpi*refWidth)) # font pointSize scaling
     logger.debug('Setting scaling ratios - general: {}; font: {}'.format(sratio, fratio))
 
-    treatman = TreatmentManager(listmodel)
-    hwsoc.tserialinterface.protocol.sigRecvdMoveOK.connect(treatman.setHWOK)
-    hwsoc.tserialinterface.protocol.sigRecvdHWError.connect(treatman.abortTreatment)
+    deliveryjournal = DeliveryJournal(args.journal) if args.journal else None
+    treatman = TreatmentManager(listmodel, device=hwsoc.device, journal=deliveryjournal) # connects itself to HW responses
+    if deliveryjournal is not None:
+        app.aboutToQuit.connect(deliveryjournal.close)
     treatmanproxy = TreatmentManagerProxy(treatman)
+    planautosave = Autosave(listmodel, args.autosave) if args.autosave else None
+    if planautosave is not None:
+        app.aboutToQuit.connect(planautosave.close)
 
     ## Set accessible properties/objects in QML Root Context
     rootContext.setContextProperty("mainwindow_title", 'SOC Controller - {!s}'.format(VERSION_FULL))
@@ -156,6 +168,7 @@ def start_gui():
     rootContext.setContextProperty("PathHandler", pathhandler_instance)
     rootContext.setContextProperty("HWSOC", hwsoc)
     rootContext.setContextProperty("TreatmentManager", treatmanproxy)
+    rootContext.setContextProperty("Autosave", planautosave)
     rootContext.setContextProperty("sratio", sratio)
     rootContext.setContextProperty("fratio", fratio)
     rootContext.setContextProperty("debug_mode", logging._nameToLevel[args.loglevel]<=logging.DEBUG)
@@ -4,67 +4,97 @@ import time
 import binascii
 import serial
 from serial.threaded import Protocol
-from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, pyqtProperty, QThread
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, pyqtProperty, QThread, QMutex, QWaitCondition
 
 from serialthread import SerialThread
-from borg import Borg
+from framedecoder import FrameDecoder, SEP_SIGNAL, SEP_TEXT
+from borg import KeyedBorg
+import hwmodel
 
 logger = logging.getLogger(__name__)
 
+CAPS_TIMEOUT_MS = 250 # how long to wait for firmware with the pipelined-upload extension to answer PRE_QUERY_CAPS
+
 class TSerialProtocol(Protocol, QObject):
     sigRecvdHWError   = pyqtSignal()
-    sigRecvdMoveOK    = pyqtSignal()
+    sigRecvdMoveOK    = pyqtSignal(int) # number of the frame it answers (see OutboundQueue.put()), 0 if none
+    # pipelined-upload extension
+    sigRecvdMoveOKSeq  = pyqtSignal(int)
+    sigRecvdHWErrorSeq = pyqtSignal(int)
+    sigRecvdCapabilities = pyqtSignal(int)
 
     def __init__(self):
         Protocol.__init__(self)
         QObject.__init__(self, None)
-        self._buf = b''
-
-    def split_bytes(self, data):
-        """split at '\n' or b'\x00' and return list of bytes with identifier as string or bytes"""
-        tokens = []
-        idx_null = data.find(b'\x00')
-        idx_nl = data.find(b'\n')
-        if idx_null>=0 and (idx_nl<0 or idx_null<idx_nl):
-            sep = b'\x00'
-        elif idx_nl>=0:
-            sep = b'\n'
-        else:
-            return tokens
+        self.decoder = FrameDecoder()
+        self.telemetry = None # SerialTelemetry, assigned by SerialThread
+        self.outbound = None  # OutboundQueue of the frames that SIG_MOVE_OK/SIG_HWERROR answer, assigned by SerialThread
+        self.batch_size = None # unknown until HW answers PRE_QUERY_CAPS; 0 if it did not (stock firmware)
+        self._lock_caps = QMutex()
+        self._wait_caps = QWaitCondition()
 
-        part = data.partition(sep)
-        tokens.append((part[1], part[0]))
-        if len(part[2]):
-            tokens += self.split_bytes(part[2])
+    def wait_capabilities(self, timeout_ms):
+        """ block until the HW has answered a capability query or timeout_ms elapsed
+
+        Stock firmware never answers; after a timeout the connection is taken to not support batch upload,
+        so that later treatments do not query (and wait) again until the connection is lost.
+        """
+        self._lock_caps.lock()
+        if self.batch_size is None:
+            if not self._wait_caps.wait(self._lock_caps, timeout_ms) and self.batch_size is None:
+                logger.info('HW did not answer the capability query; batch upload is not supported')
+                self.batch_size = 0
+        self._lock_caps.unlock()
+        return self.batch_size
 
-        return tokens
+    def _reply(self):
+        """ count a SIG_MOVE_OK/SIG_HWERROR, the reply to one PRE_ABSPOS_ALL/PRE_CALIBRATE frame (see
+        hwmodel.expects_reply()); returns the number of the frame it answers """
+        return self.outbound.release() if self.outbound is not None else 0
 
     def data_received(self, data):
         try:
-            # only process freshest signal if more are buffered
-            if not (b'\x00' in data or '\n'.encode() in data):
-                self._buf += data
-                return
-
-            data = self._buf + data
-            self._buf = b''
-
             logger.debug2('rawdata: {!s}'.format(data))
-            tokens = self.split_bytes(data)
+            if self.telemetry:
+                self.telemetry.bytes_received(len(data))
+            tokens = self.decoder.feed(data)
+            if not tokens:
+                return
             logger.debug2('tokens: {!s}'.format(tokens))
 
             for sep, bt in tokens:
-                if sep == b'\x00':
-                    if bytes([bt[0]]) == HWSOC.SIG_MOVE_OK:
+                if sep == SEP_SIGNAL:
+                    if bt[:1] == HWSOC.SIG_MOVE_OK:
                         logger.monitor("Recv: SIGNAL:MOVE_OK")
-                        self.sigRecvdMoveOK.emit()
-                    elif bytes([bt[0]]) == HWSOC.SIG_HWERROR:
+                        if self.telemetry: self.telemetry.signal_received(HWSOC.SIG_MOVE_OK)
+                        self.sigRecvdMoveOK.emit(self._reply())
+                    elif bt[:1] == HWSOC.SIG_HWERROR:
                         logger.monitor("Recv: SIGNAL:HWERROR")
+                        if self.telemetry: self.telemetry.signal_received(HWSOC.SIG_HWERROR)
+                        self._reply()
                         self.sigRecvdHWError.emit()
+                    elif bt[:1] == HWSOC.SIG_MOVE_OK_SEQ and len(bt) == 3:
+                        seq = hwmodel.decode_seq(bt[1:])
+                        logger.monitor("Recv: SIGNAL:MOVE_OK seq={:d}".format(seq))
+                        if self.telemetry: self.telemetry.signal_received(HWSOC.SIG_MOVE_OK_SEQ, seq)
+                        self.sigRecvdMoveOKSeq.emit(seq)
+                    elif bt[:1] == HWSOC.SIG_HWERROR_SEQ and len(bt) == 3:
+                        seq = hwmodel.decode_seq(bt[1:])
+                        logger.monitor("Recv: SIGNAL:HWERROR seq={:d}".format(seq))
+                        if self.telemetry: self.telemetry.signal_received(HWSOC.SIG_HWERROR_SEQ, seq)
+                        self.sigRecvdHWErrorSeq.emit(seq)
+                        self.sigRecvdHWError.emit()
+                    elif bt[:1] == HWSOC.SIG_CAPS and len(bt) == 2:
+                        logger.monitor("Recv: SIGNAL:CAPS batch_size={:d}".format(bt[1]&0x7F))
+                        self._lock_caps.lock()
+                        self.batch_size = bt[1]&0x7F
+                        self._wait_caps.wakeAll()
+                        self._lock_caps.unlock()
+                        self.sigRecvdCapabilities.emit(self.batch_size)
                     else:
                         logger.monitor("Recv (bin): {}".format(binascii.hexlify(bt)))
 
-                elif sep == b'\n':
+                elif sep == SEP_TEXT:
                         try:
                             str_rep = bt.decode('ascii').rstrip('\r\n')
                             logger.monitor("Recv (text): \"{}\"".format(str_rep))
@@ -75,43 +105,91 @@ class TSerialProtocol(Protocol, QObject):
 
     def connection_lost(self, error):
         logger.exception('Serial connection to hardware was broken')
+        self.decoder.reset()
+        if self.telemetry:
+            self.telemetry.connection_lost()
+        # the HW may come back with different firmware
+        self.batch_size = None
         self.sigRecvdHWError.emit()
 
 
-class HWSOC(Borg, QObject):
-    """ Singleton/Borg class that handles interfacing with hardware leaflet controller """
-    MAGIC_BYTES    = b'\xFF\xD7' # use before every signal sent to HW
-    PRE_ABSPOS_ONE = b'\xB1'     # use before updating a single leaflet position
-    PRE_ABSPOS_ALL = b'\xB2'     # use before updating all leaflet positions
-    PRE_CALIBRATE  = b'\xB3'     # send without payload to reset HW encoder position state
-    SIG_MOVE_OK    = b'\xA0'     # receive from HW after successful leaflet repositioning
-    SIG_HWERROR    = b'\xA1'     # receive from HW after error occurs (at any time)
+class HWSOC(KeyedBorg, QObject):
+    """ Borg class that handles interfacing with a hardware leaflet controller
+
+    Instances share state per device name: every HWSOC(device=name) drives the same serial connection, while
+    differently named devices each have their own serial thread, outbound queue and telemetry.
+    """
+    DEFAULT_DEVICE = 'default'
+    MAGIC_BYTES    = hwmodel.MAGIC_BYTES    # use before every signal sent to HW
+    PRE_ABSPOS_ONE = hwmodel.PRE_ABSPOS_ONE # use before updating a single leaflet position
+    PRE_ABSPOS_ALL = hwmodel.PRE_ABSPOS_ALL # use before updating all leaflet positions
+    PRE_CALIBRATE  = hwmodel.PRE_CALIBRATE  # send without payload to reset HW encoder position state
+    SIG_MOVE_OK    = hwmodel.SIG_MOVE_OK    # receive from HW after successful leaflet repositioning
+    SIG_HWERROR    = hwmodel.SIG_HWERROR    # receive from HW after error occurs (at any time)
+    # optional pipelined-upload extension (see hwmodel.py)
+    PRE_QUERY_CAPS   = hwmodel.PRE_QUERY_CAPS
+    PRE_ABSPOS_BATCH = hwmodel.PRE_ABSPOS_BATCH
+    PRE_FLUSH_BATCH  = hwmodel.PRE_FLUSH_BATCH
+    SIG_CAPS         = hwmodel.SIG_CAPS
+    SIG_MOVE_OK_SEQ  = hwmodel.SIG_MOVE_OK_SEQ
+    SIG_HWERROR_SEQ  = hwmodel.SIG_HWERROR_SEQ
 
-    def __init__(self, nleaflets=None, HID=None, BAUD=None):
+    def __init__(self, nleaflets=None, HID=None, BAUD=None, PORT=None, device=None, emulator_batch=0):
         """
         Args:
             HID (str):  USB hardware id, if present: only match exactly and fallback to EMULATOR_MODE otherwise
             BAUD (int): Serial baud rate - must match serial device baud exactly
+            PORT (str): Serial port path to open directly (e.g. a pty created by fakedevice.py)
+            device (str): name of the device to connect to or share state with (default: DEFAULT_DEVICE)
+            emulator_batch (int): batch records the EMULATOR_MODE device advertises (0: stock firmware, which
+                                  does not answer PRE_QUERY_CAPS)
         """
-        Borg.__init__(self)
+        device = device or self.DEFAULT_DEVICE
+        KeyedBorg.__init__(self, device)
         QObject.__init__(self)
         if self.__dict__.get('initialized', False):
             return
+        if nleaflets is None:
+            raise RuntimeError('hardware device "{}" has not been initialized'.format(device))
 
+        self.device = device
         self._tserial = None
         self.nleaflets = nleaflets
-        self.init_serial_interface(HID, BAUD)
+        self.use_batch = True # set False to always deliver with one PRE_ABSPOS_ALL per segment
+        self.init_serial_interface(HID, BAUD, PORT, emulator_batch)
         self.initialized = True
 
+    @classmethod
+    def devices(cls):
+        """ names of all initialized devices """
+        return [k for k, state in cls._shared_states.items() if state.get('initialized', False)]
+
+    @pyqtProperty(str, constant=True)
+    def deviceName(self):
+        return self.device
+
     @pyqtProperty(QThread, constant=True)
     def tserialinterface(self):
         return self._tserial
 
+    @pyqtProperty(QObject, constant=True)
+    def telemetry(self):
+        """ SerialTelemetry of the serial link (latency histograms and byte counters) """
+        return self._tserial.telemetry
+
 ######################################
-    def send_structured_signal(self, pre_bytes, payload):
+    def send_structured_signal(self, pre_bytes, payload, coalesce=False):
+        """queue a frame for the HW
+
+        Args:
+            coalesce (bool): frame may be superseded by a later coalescable frame before it is sent
+
+        Returns:
+            number of the SIG_MOVE_OK that answers the frame (see OutboundQueue.put()), or None
+        """
         full_payload = self.MAGIC_BYTES + pre_bytes + payload
         if self._tserial:
-            self._tserial.write(full_payload)
+            return self._tserial.write(full_payload, coalesce)
         else:
             self._fserial.write(full_payload)
             self._fserial.reset_input_buffer()
@@ -119,15 +197,26 @@ class HWSOC(Borg, QObject):
     def is_valid_idx(self, idx):
         return idx<self.nleaflets and idx>=0
 
-    def init_serial_interface(self, HID=None, BAUD=None):
-        self._tserial = SerialThread(TSerialProtocol, HID, BAUD)
+    def init_serial_interface(self, HID=None, BAUD=None, PORT=None, emulator_batch=0):
+        self._tserial = SerialThread(TSerialProtocol, HID, BAUD, PORT, emulator_batch)
+        # resolved once here, so that starting a treatment never waits for it; asked before the first move,
+        # which the HW finishes before it answers anything else
+        self.query_capabilities(timeout_ms=CAPS_TIMEOUT_MS)
         # set to all open leaflets
         self.set_all_positions([0]*self.nleaflets)
 
     def close_serial_interface(self):
         self._tserial.close()
-        self._tserial.join()
+        self._tserial.wait()
         self._tserial = None
+
+    @classmethod
+    def close_all(cls):
+        """ close the serial interfaces of all devices """
+        for device in cls.devices():
+            hwsoc = cls(device=device)
+            if hwsoc.tserialinterface is not None:
+                hwsoc.close_serial_interface()
 ######################################
     def set_position(self, idx, pos):
         """send extension for a single leaflet"""
@@ -135,12 +224,72 @@ class HWSOC(Borg, QObject):
             raise IndexError('index specified is out of bounds')
         self.send_structured_signal(self.PRE_ABSPOS_ONE, bytes([idx]) + pos.to_bytes(2, byteorder='big', signed=True))
 
-    def set_all_positions(self, poslist):
-        """send all leaflet extensions in one bytestring"""
+    def set_all_positions(self, poslist, coalesce=False):
+        """send all leaflet extensions in one bytestring
+
+        Args:
+            coalesce (bool): allow newer positions to replace this frame while it is still queued (for
+                             interactive updates where only the latest position matters)
+        """
         if not poslist or len(poslist) != self.nleaflets:
             raise AttributeError('list of leaflet extensions must be len={} not len={}'.format(self.nleaflets, len(poslist)))
-        self.send_structured_signal(self.PRE_ABSPOS_ALL, b''.join([pos.to_bytes(2, byteorder='big', signed=True) for pos in poslist]))
+        return self.send_structured_signal(self.PRE_ABSPOS_ALL, hwmodel.encode_positions(poslist), coalesce)
+
+    def send_positions_frame(self, frame):
+        """send a complete PRE_ABSPOS_ALL frame prepared ahead of time (see DeliveryProgram.frames)"""
+        if len(frame) != len(self.MAGIC_BYTES)+1+2*self.nleaflets:
+            raise AttributeError('frame must encode {} leaflet extensions'.format(self.nleaflets))
+        return self._tserial.write(frame)
+
+    def moves_pending(self):
+        """ queued PRE_ABSPOS_ALL/PRE_CALIBRATE frames the HW has not answered yet (e.g. the initial move) """
+        return self._tserial.outbound.pending_replies()
 
     def set_calibration(self):
         self.send_structured_signal(self.PRE_CALIBRATE, b'')
+
+    def query_capabilities(self, timeout_ms=None):
+        """ ask the HW whether it supports batch upload
+
+        Returns:
+            number of batch records the HW can queue (0 if unsupported), or None if not known yet.
+            Blocks for at most timeout_ms if given.
+        """
+        protocol = self._tserial.protocol
+        if protocol.batch_size is None:
+            self.send_structured_signal(self.PRE_QUERY_CAPS, b'')
+            if timeout_ms:
+                protocol.wait_capabilities(timeout_ms)
+        return protocol.batch_size
+
+    @property
+    def batch_size(self):
+        """ in-flight window for send_batch(), 0 if batch upload is disabled or unsupported """
+        if not self.use_batch:
+            return 0
+        return self._tserial.protocol.batch_size or 0
+
+    def send_batch(self, first_seq, records):
+        """send several control points at once
+
+        Args:
+            first_seq (int): sequence number of the first record; records are numbered consecutively
+            records (list): (positions, dwell_ms) for each control point, where positions is either a list of
+                            leaflet extensions or their already encoded payload (see DeliveryProgram.payloads)
+        """
+        if not 0 < len(records) <= 0xFF:
+            raise ValueError('batch must contain 1-255 records, not {}'.format(len(records)))
+        payload = [bytes([len(records)]), first_seq.to_bytes(2, byteorder='big')]
+        for positions, dwell_ms in records:
+            if not isinstance(positions, bytes):
+                positions = hwmodel.encode_positions(positions)
+            if len(positions) != 2*self.nleaflets:
+                raise AttributeError('list of leaflet extensions must be len={} not len={}'.format(self.nleaflets, len(positions)//2))
+            payload.append(positions)
+            payload.append(int(round(dwell_ms)).to_bytes(4, byteorder='big'))
+        self.send_structured_signal(self.PRE_ABSPOS_BATCH, b''.join(payload))
+
+    def flush_batch(self):
+        """drop all batch records queued on the HW"""
+        self.send_structured_signal(self.PRE_FLUSH_BATCH, b'')
 ######################################
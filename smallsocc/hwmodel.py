@@ -0,0 +1,79 @@
+""" hwmodel.py
+
+Host-side mirror of the mechanical constants and behavior hard-coded in the SOC firmware
+(see soc_driver_v2/soc_driver_v2.ino). Keep these in sync with the firmware.
+"""
+
+import struct
+
+NLEAFLETS = 8
+# allowed leaflet extension range (leaflet extension units)
+MIN_EXTENSION = 0
+MAX_EXTENSION = 5360
+
+# serial protocol bytes (#define'd signals for GUI communication)
+MAGIC_BYTES    = b'\xFF\xD7' # use before every signal sent to HW
+PRE_ABSPOS_ONE = b'\xB1'     # use before updating a single leaflet position
+PRE_ABSPOS_ALL = b'\xB2'     # use before updating all leaflet positions
+PRE_CALIBRATE  = b'\xB3'     # send without payload to reset HW encoder position state
+SIG_MOVE_OK    = b'\xA0'     # receive from HW after successful leaflet repositioning
+SIG_HWERROR    = b'\xA1'     # receive from HW after error occurs (at any time)
+
+# optional pipelined-upload extension; firmware without it silently ignores these commands
+PRE_QUERY_CAPS   = b'\xB4' # send without payload; extended HW answers with SIG_CAPS
+PRE_ABSPOS_BATCH = b'\xB5' # count (1B), first seq (2B), then count*(positions, dwell_ms (4B)) records
+PRE_FLUSH_BATCH  = b'\xB6' # send without payload to drop all queued batch records
+SIG_CAPS         = b'\xA2' # followed by one byte: 0x80|max batch records queued on HW
+SIG_MOVE_OK_SEQ  = b'\xA3' # followed by encoded seq: batch record reached its positions, dwell started
+SIG_HWERROR_SEQ  = b'\xA4' # followed by encoded seq: batch record failed, remaining records dropped
+
+def expects_reply(frame):
+    """ True if the firmware answers frame with exactly one SIG_MOVE_OK or SIG_HWERROR """
+    return frame[:len(MAGIC_BYTES)] == MAGIC_BYTES and frame[len(MAGIC_BYTES):len(MAGIC_BYTES)+1] in (PRE_ABSPOS_ALL, PRE_CALIBRATE)
+
+# signals are terminated by b'\x00', so seq numbers are sent as two 7-bit halves with the high bit set
+SEQ_MODULUS = 1<<14
+
+def encode_seq(seq):
+    return bytes([0x80 | (seq>>7)&0x7F, 0x80 | seq&0x7F])
+
+def decode_seq(data):
+    return ((data[0]&0x7F)<<7) | (data[1]&0x7F)
+
+# leaflet extension units -> motor steps (motorN = motorN*5.x in loop())
+STEP_SCALE = (5.2, 5.2, 5.3, 5.3, 5.2, 5.2, 5.3, 5.3)
+
+# opposing leaflet pairs (0-based leaflet index) and the maximum combined travel in motor steps
+# (totalStepsUpper/totalStepsLower)
+COLLISION_PAIRS = (
+    (0, 5, 5200),
+    (1, 4, 5200),
+    (2, 7, 5400),
+    (3, 6, 5400),
+)
+
+# MoveLeavesToPosition() stops stepping a motor once it is within this many counts of its target
+STEP_TOLERANCE = 10
+# each Full/EighthStep*() call holds the step pin high then low for 300us each
+STEP_PERIOD_S = 600e-6
+
+
+_position_structs = {}
+def encode_positions(poslist):
+    """ pack leaflet extensions as big-endian int16 (the PRE_ABSPOS_ALL payload) """
+    n = len(poslist)
+    packer = _position_structs.get(n)
+    if packer is None:
+        packer = _position_structs[n] = struct.Struct('>{:d}h'.format(n))
+    try:
+        return packer.pack(*poslist)
+    except struct.error as e:
+        raise ValueError('leaflet extensions {!s} cannot be encoded: {!s}'.format(list(poslist), e))
+
+def to_steps(poslist):
+    """ convert leaflet extensions to firmware motor steps, truncating like the firmware's int assignment """
+    return [int(pos*scale) for pos, scale in zip(poslist, STEP_SCALE)]
+
+def is_collision_free(steps):
+    """ apply the firmware's collision check to a list of motor steps """
+    return all(steps[a]+steps[b] <= limit for a, b, limit in COLLISION_PAIRS)
@@ -0,0 +1,246 @@
+""" journal.py
+
+Crash-safe record of treatment delivery.
+
+The TreatmentManager appends one fixed-size binary record per delivery event (segment acked by HW,
+beam-on finished, treatment stopped, ...). Records are packed on the delivery thread and handed to a
+JournalWriter thread, which writes and fsyncs them in batches, so journaling never blocks the timing
+loop. Each record carries a CRC32; a record torn by a crash (and everything after it) is ignored when
+the journal is scanned.
+
+The journal holds the most recent treatment only (it is truncated when a treatment starts), so scan()
+is O(records of one plan). scan() reports how far delivery got, and resume_point() maps that onto a
+compiled DeliveryProgram to find the segment to resume from and the beam-on time remaining.
+
+EVENT_MOVE_OK records are stamped with the time beam-on started, so the part of a segment's beam-on
+delivered before a stop or abort is known: resuming gives that segment only the rest of its duration
+(and journals it with EVENT_RESUME, so that a second interruption is accounted for as well). If the app
+died during a beam-on, the time delivered is unknown; that segment is not delivered again.
+"""
+import os
+import zlib
+import time
+import struct
+import logging
+from collections import namedtuple
+from PyQt5.QtCore import QThread, QMutex, QWaitCondition
+
+logger = logging.getLogger(__name__)
+
+# event type, segment, aux (plan id for EVENT_START, batch seq for EVENT_MOVE_OK), crc32, time.time(), value
+RECORD = struct.Struct('<BxxxIIIdd')
+
+EVENT_START     = 1 # segment: start index; value: number of segments
+EVENT_MOVE_OK   = 2 # HW reached the segment's positions, beam-on started (the record's time)
+EVENT_BEAM_DONE = 3 # value: actual beam-on (+ move, when pipelined) duration in ms
+EVENT_SKIP      = 4 # segment has no beam-on time
+EVENT_STOP      = 5
+EVENT_ABORT     = 6
+EVENT_COMPLETE  = 7
+EVENT_RESUME    = 8 # segment: start index; value: beam-on time (ms) it received before this treatment
+
+def default_path(device='default'):
+    return os.path.join(os.path.expanduser('~'), '.smallsocc', 'journal_{}.bin'.format(device))
+
+def pack_record(event, segment, aux=0, value=0.0, t=None):
+    t = time.time() if t is None else t
+    crc = zlib.crc32(RECORD.pack(event, segment, aux, 0, t, value))
+    return RECORD.pack(event, segment, aux, crc, t, value)
+
+def plan_id(program):
+    """ 32-bit fingerprint of a DeliveryProgram (positions and durations) """
+    return zlib.crc32(program.durations.tobytes(), zlib.crc32(b''.join(program.frames)))
+
+
+JournalState = namedtuple('JournalState', ['plan_id', 'nsegments', 'start', 'last_done', 'interrupted',
+                                           'ended', 'completed', 'delivered_ms', 'records', 't_last',
+                                           't_beam_on', 'partial_ms'])
+JournalState.__doc__ = """ summary of the journaled treatment
+
+    last_done:   highest segment whose beam-on finished; start-1 if none
+    interrupted: segment that was acked by HW but whose beam-on never finished, or None
+    ended:       EVENT_STOP/EVENT_ABORT/EVENT_COMPLETE of the last end event, None if the app died mid-treatment
+    t_beam_on:   time.time() the beam-on of interrupted started, until an end event accounts for it
+    partial_ms:  beam-on time segment last_done+1 received before the end event
+    """
+
+ResumePoint = namedtuple('ResumePoint', ['index', 'remaining_ms', 'first_ms', 'partial_ms', 'unknown'])
+ResumePoint.__doc__ = """ where to resume an interrupted treatment
+
+    index:        segment to resume from
+    remaining_ms: beam-on time left, first_ms included
+    first_ms:     beam-on time to deliver for segment index (its duration less partial_ms)
+    partial_ms:   beam-on time segment index already received
+    unknown:      segment whose beam-on was cut short by a crash, for an unknown time; it is not delivered
+                  again (index is past it). None if there is none
+    """
+
+def scan(path):
+    """ read a journal in one pass
+
+    Returns:
+        JournalState of the journaled treatment, or None if there is none
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    state = None
+    records = 0
+    usable = len(data) - len(data) % RECORD.size
+    for event, segment, aux, crc, t, value in RECORD.iter_unpack(memoryview(data)[:usable]):
+        if zlib.crc32(RECORD.pack(event, segment, aux, 0, t, value)) != crc:
+            logger.warning('journal "{}" is corrupt after record {:d}; ignoring the rest'.format(path, records))
+            break
+        records += 1
+        if event == EVENT_START:
+            state = JournalState(aux, int(value), segment, segment-1, None, None, False, 0.0, records, t, None, 0.0)
+            continue
+        if state is None:
+            continue
+        changes = {'records': records, 't_last': t}
+        if event == EVENT_RESUME:
+            if segment == state.last_done+1:
+                changes['partial_ms'] = value
+        elif event == EVENT_MOVE_OK:
+            changes['interrupted'] = segment
+            changes['t_beam_on'] = t
+        elif event == EVENT_BEAM_DONE:
+            # skipped segments need no bookkeeping: resuming at one just skips it again
+            changes['last_done'] = max(state.last_done, segment)
+            if state.interrupted is not None and state.interrupted <= segment:
+                changes['interrupted'] = None
+                changes['t_beam_on'] = None
+            changes['partial_ms'] = 0.0
+            changes['delivered_ms'] = state.delivered_ms + value
+        elif event in (EVENT_STOP, EVENT_ABORT, EVENT_COMPLETE):
+            changes['ended'] = event
+            if event == EVENT_COMPLETE:
+                changes['completed'] = True
+            elif state.t_beam_on is not None and state.interrupted == state.last_done+1:
+                # beam-on of the interrupted segment ran until this record was journaled
+                changes['partial_ms'] = state.partial_ms + 1000*max(0.0, t-state.t_beam_on)
+                changes['delivered_ms'] = state.delivered_ms + 1000*max(0.0, t-state.t_beam_on)
+                changes['t_beam_on'] = None
+        state = state._replace(**changes)
+    return state
+
+def resume_point(state, program):
+    """ where to resume the journaled treatment, if program is the plan it was delivering
+
+    Returns:
+        ResumePoint, or None if there is nothing to resume
+    """
+    if state is None or state.completed or state.plan_id != plan_id(program) or state.nsegments != len(program):
+        return None
+    index = state.last_done+1
+    partial = state.partial_ms
+    unknown = None
+    if state.t_beam_on is not None and state.interrupted == index:
+        # the app died during this beam-on: delivering it again could overdose
+        logger.warning('beam-on of segment #{:d} was interrupted after an unknown time (up to its {:.0f} ms); '
+                       'it will not be delivered again'.format(index+1, program.durations[index]))
+        unknown = index
+        index += 1
+        partial = 0.0
+    if index >= len(program):
+        return None
+    duration = program.durations[index]
+    first = max(0.0, duration-partial) if duration > 0 else duration
+    remaining = max(first, 0) + sum(d for d in program.durations[index+1:] if d > 0)
+    return ResumePoint(index, remaining, first, partial, unknown)
+
+
+class JournalWriter(QThread):
+    """ appends queued records to the journal file, fsyncing at most every sync_interval seconds """
+
+    def __init__(self, path, sync_interval=0.05):
+        super().__init__()
+        self.path = path
+        self.sync_interval = sync_interval
+        self.alive = True
+        self._pending = [] # (record bytes, truncate file first)
+        self._lock = QMutex()
+        self._wait_records = QWaitCondition()
+        self._wait_close = QWaitCondition()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def put(self, record, truncate=False):
+        self._lock.lock()
+        self._pending.append((record, truncate))
+        self._wait_records.wakeAll()
+        self._lock.unlock()
+
+    def close(self):
+        """ write everything still queued and stop """
+        self._lock.lock()
+        self.alive = False
+        self._wait_records.wakeAll()
+        self._wait_close.wakeAll()
+        self._lock.unlock()
+
+    def _write(self, batch):
+        chunk = []
+        try:
+            for record, truncate in batch:
+                if truncate:
+                    if chunk:
+                        os.write(self._fd, b''.join(chunk))
+                        chunk = []
+                    os.ftruncate(self._fd, 0)
+                chunk.append(record)
+            if chunk:
+                os.write(self._fd, b''.join(chunk))
+            os.fsync(self._fd)
+        except OSError:
+            logger.exception('failed to write delivery journal "{}"'.format(self.path))
+
+    def run(self):
+        while True:
+            self._lock.lock()
+            while self.alive and not self._pending:
+                self._wait_records.wait(self._lock)
+            batch, self._pending = self._pending, []
+            alive = self.alive
+            self._lock.unlock()
+            if batch:
+                self._write(batch)
+            if not alive:
+                break
+            # let records accumulate so that one fsync covers many of them
+            self._lock.lock()
+            if self.alive:
+                self._wait_close.wait(self._lock, int(self.sync_interval*1000))
+            self._lock.unlock()
+        os.close(self._fd)
+
+
+class DeliveryJournal():
+    """ journal of one device's deliveries; append methods only queue records and never block on I/O """
+
+    def __init__(self, path, sync_interval=0.05):
+        """
+        Args:
+            sync_interval (float): minimum seconds between fsyncs (records within are batched)
+        """
+        self.path = path
+        self.last_state = scan(path) # treatment journaled before this session
+        if self.last_state is not None and not self.last_state.completed:
+            logger.warning('journal "{}": previous treatment of {:d} segments did not complete (next segment: #{:d})'.format(
+                path, self.last_state.nsegments, self.last_state.last_done+2))
+        self._writer = JournalWriter(path, sync_interval)
+        self._writer.start()
+
+    def begin(self, program, start):
+        """ start journaling a treatment of program from segment start (drops the previous treatment) """
+        self.last_state = None
+        self._writer.put(pack_record(EVENT_START, start, plan_id(program), len(program)), truncate=True)
+
+    def append(self, event, segment, value=0.0, aux=0, t=None):
+        self._writer.put(pack_record(event, segment, aux, value, t))
+
+    def close(self):
+        self._writer.close()
+        self._writer.wait()
@@ -1,5 +1,5 @@
 import logging
-from hardware import HWSOC
+import hwmodel
 from PyQt5.QtCore import pyqtProperty, pyqtSignal, pyqtSlot, Q_ENUMS, QObject
 from PyQt5.QtQml import qmlRegisterType, qmlAttachedPropertiesObject
 from PyQt5.QtQuick import QQuickItem
@@ -22,8 +22,8 @@ class LeafletAssemblyAttached(QObject):
 
 # leaflet type to be registered with QML (must be sub-class of QObject)
 class Leaflet(QQuickItem):
-    _min_ext = 0
-    _max_ext = 5360
+    _min_ext = hwmodel.MIN_EXTENSION
+    _max_ext = hwmodel.MAX_EXTENSION
     next_available = 0
 
     # QML accessible enum defs
@@ -41,8 +41,8 @@ class Leaflet(QQuickItem):
 
     def __init__(self, *args, **kwargs):
         QQuickItem.__init__(self, **kwargs)
-        self._hwsoc = HWSOC()
         self._extension = 0
+        self.constraint = None # callable(value) -> allowed extension, installed by LeafletAssembly
         self._index = Leaflet.next_available
         self._limit_travel = True
         Leaflet.next_available += 1
@@ -87,6 +87,8 @@ class Leaflet(QQuickItem):
         if self.limitTravel:
             if (val < self._min_ext): val = self._min_ext
             elif (val > self._max_ext): val = self._max_ext
+        if self.constraint is not None:
+            val = self.constraint(val)
         self._extension = val
         self.onExtensionChanged.emit(val)
 
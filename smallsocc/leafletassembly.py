@@ -3,7 +3,10 @@
 Collection of controllable leaflets in custom configurations
 """
 import logging
+from functools import partial
 from hardware import HWSOC
+import constraints
+import hwmodel
 from leaflet import Leaflet
 from PyQt5.QtCore import pyqtProperty, pyqtSignal, pyqtSlot, Q_ENUMS, Q_CLASSINFO
 from PyQt5.QtCore import QObject
@@ -19,13 +22,54 @@ class LeafletAssembly(QQuickItem):
     def __init__(self, parent=None):
         QQuickItem.__init__(self, parent)
         self._leaflets = []
-        self._hwsoc = HWSOC()
+        self._device = HWSOC.DEFAULT_DEVICE
+        self._hwsoc_handle = None # bound on first use, so that device can be set from QML first
+        self._enforce_limits = True
         self.hw_linked = False
 
+    deviceChanged = pyqtSignal([str])
+
+    @pyqtProperty(str, notify=deviceChanged)
+    def device(self):
+        """name of the HWSOC device that leaflet positions are published to"""
+        return self._device
+
+    @device.setter
+    def device(self, name):
+        if name != self._device:
+            self._device = name
+            self._hwsoc_handle = None
+            self.deviceChanged.emit(name)
+
+    @property
+    def _hwsoc(self):
+        if self._hwsoc_handle is None:
+            self._hwsoc_handle = HWSOC(device=self._device)
+        return self._hwsoc_handle
+
     def componentComplete(self):
         QQuickItem.componentComplete(self)
+        for ii, leaf in enumerate(self._leaflets):
+            leaf.constraint = partial(self._constrainExtension, ii)
         self.enableHWLink()
 
+    enforceLimitsChanged = pyqtSignal([bool])
+
+    @pyqtProperty(bool, notify=enforceLimitsChanged)
+    def enforceLimits(self):
+        """clamp leaflet changes to the firmware's collision limits (see constraints.py)"""
+        return self._enforce_limits
+
+    @enforceLimits.setter
+    def enforceLimits(self, val):
+        self._enforce_limits = bool(val)
+        self.enforceLimitsChanged.emit(self._enforce_limits)
+
+    def _constrainExtension(self, idx, val):
+        if not self._enforce_limits or len(self._leaflets) != hwmodel.NLEAFLETS:
+            return val
+        return constraints.clamp_extension(idx, val, [lf.extension for lf in self._leaflets])
+
     leafletsChanged = pyqtSignal([QQmlListProperty], arguments=['leaflets'])
 
     @pyqtProperty(QQmlListProperty, notify=leafletsChanged)
@@ -36,8 +80,12 @@ class LeafletAssembly(QQuickItem):
     @pyqtSlot(int)
     def publishToHW(self, index=None):
         poslist = [lf.extension for lf in self._leaflets]
+        violations = constraints.check_plan([poslist]) if len(poslist) == hwmodel.NLEAFLETS else []
+        if violations:
+            logger.error('not publishing leaflet positions to HW: {}'.format('; '.join(constraints.describe(v) for v in violations)))
+            return
         logger.debug('publishing all to HW - [{}]'.format(', '.join(str(x) for x in poslist)))
-        self._hwsoc.set_all_positions(poslist)
+        self._hwsoc.set_all_positions(poslist, coalesce=True)
 
     @pyqtSlot()
     def setCalibration(self):
@@ -60,8 +108,11 @@ class LeafletAssembly(QQuickItem):
     @pyqtSlot()
     def setClosed(self):
         """Move leaflets to 'closed' position"""
+        # retract before extending so that opposing leaflets are not clamped against stale positions
+        for ii, leaf in enumerate(self._leaflets):
+            if ii>=4: leaf.extension = 0
         for ii, leaf in enumerate(self._leaflets):
-                leaf.extension = leaf.max_extension if ii<4 else 0
+            if ii<4: leaf.extension = leaf.max_extension
         self.publishToHW()
 
     @pyqtSlot()
@@ -17,6 +17,10 @@ ApplicationWindow {
   property color color_bgbase: "#F4F4F4"
   color: color_bgbase
   footer: QTimedText {id: "footer_status"; interval: 5000}
+  Connections {
+    target: SequenceListModel
+    onLoadProgress: { footer_status.text = "Loading plan... " + Math.round(100*fraction) + "%"; }
+  }
 
   // global state variables TODO: Replace with application state
   property bool hwsync_on: false
@@ -26,7 +30,7 @@ ApplicationWindow {
   // note: this will also prompt a change in HW positions to match display unless 'false' is passed as argument
   function updateSOCConfig(publishtohw) {
     if (publishtohw === undefined) { publishtohw = true; }
-    if (qsequencelist.lvseq.currentIndex < 0 || SequenceListModel.rowCount() <= 0) {
+    if (qsequencelist.lvseq.currentIndex < 0 || SequenceListModel.size <= 0) {
       leaflet_assembly.reset();
     } else {
       var map = {};
@@ -71,6 +75,24 @@ ApplicationWindow {
 
     // keep SOC Display and HW in sync with currentIndex in listview
     connectUItoHW(true);
+
+    offerRestore();
+  }
+  function offerRestore() {
+    // an earlier session ended with unsaved edits (e.g. crash or power loss)
+    if (!Autosave || !Autosave.recoverable()) { return; }
+    var d = DynamicQML.createDynamicObject(mainwindow, "QMessageDialog.qml", {
+      'title': 'Restore Autosaved Plan?',
+      'text': "The previous session ended with unsaved changes to its plan. Restore the autosaved plan?",
+      'standardButtons': 0x14000 /* StandardButton.Yes | StandardButton.No */
+    })
+    d.onYes.connect( function() {
+      if (!Autosave.restore()) { footer_status.text = "Failed to restore the autosaved plan"; }
+      else { qsequencelist.offerResume(); }
+      d.destroy(); /* cleanup */
+    });
+    d.onNo.connect( function() { Autosave.discard(); d.destroy(); /* cleanup */ });
+    d.open()
   }
 
   StateGroup {
@@ -342,6 +364,7 @@ ApplicationWindow {
                 var msg = "Sequence list loaded from \""+d.path+"\"";
                 footer_status.text = msg;
                 field_json_path.text = d.path;
+                qsequencelist.offerResume();
               }
               d.destroy(); /* cleanup */
             });
@@ -354,7 +377,9 @@ ApplicationWindow {
           onClicked:{
             var d = DynamicQML.createDynamicObject(mainwindow, "QFileDialog.qml", {"intent": "save"});
             d.onAccepted.connect( function() {
-              if (SequenceListModel.writeToJson(d.path)) {
+              var saved = d.path.endsWith(".socplan") ? SequenceListModel.writeToBinary(d.path)
+                                                      : SequenceListModel.writeToJson(d.path);
+              if (saved) {
                 var msg = "Sequence list saved to \""+d.path+"\"";
                 footer_status.text = msg;
                 field_json_path.text = d.path;
@@ -0,0 +1,200 @@
+""" motionmodel.py
+
+Estimated leaflet travel time and whole-plan delivery timeline.
+
+MoveLeavesToPosition() steps every motor that is still out of tolerance once per pass, one after another,
+so a move takes (motor steps beyond tolerance, summed over leaflets) * step period, plus a fixed latency
+for the serial round trip. MotionModel holds these parameters (defaults from hwmodel) and can be fit to
+MOVE_OK latencies recorded by the TreatmentManager. It is the one implementation of this estimate, also
+used by the emulated device to time its moves.
+
+PlanTimeline applies a MotionModel to a whole plan with NumPy and keeps the per-segment and cumulative
+estimates up to date as rows are edited, inserted, removed or moved, recomputing only the moves into the
+rows that changed.
+"""
+import logging
+import numpy as np
+
+import hwmodel
+
+logger = logging.getLogger(__name__)
+
+class MotionModel():
+    """ move time = overhead_s + step_period_s * sum(max(|delta steps| - tolerance, 0)) """
+
+    def __init__(self, step_period_s=hwmodel.STEP_PERIOD_S, tolerance=hwmodel.STEP_TOLERANCE, overhead_s=0.0,
+                 step_scale=hwmodel.STEP_SCALE):
+        """
+        Args:
+            step_period_s (float): time per motor step
+            tolerance (int):       motor steps within which a leaflet counts as in position
+            overhead_s (float):    fixed time per move (serial round trip, ack dispatch)
+            step_scale (tuple):    motor steps per leaflet extension unit, per leaflet
+        """
+        self.step_period_s = step_period_s
+        self.tolerance = tolerance
+        self.overhead_s = overhead_s
+        self.step_scale = np.array(step_scale, dtype=np.float64)
+
+    def __repr__(self):
+        return 'MotionModel(step_period_s={:g}, tolerance={:d}, overhead_s={:g})'.format(
+            self.step_period_s, self.tolerance, self.overhead_s)
+
+    def to_steps(self, positions):
+        """ leaflet extensions (..., nleaflets) -> motor steps, truncated like the firmware """
+        return np.trunc(np.asarray(positions, dtype=np.float64)*self.step_scale).astype(np.int64)
+
+    def step_counts(self, from_steps, to_steps):
+        """ motor steps the firmware takes to travel between motor positions (vectorized over leading axes) """
+        delta = np.abs(np.asarray(to_steps, dtype=np.int64) - np.asarray(from_steps, dtype=np.int64))
+        return np.maximum(delta-self.tolerance, 0).sum(axis=-1)
+
+    def move_time(self, from_steps, to_steps):
+        """ estimated seconds to travel between motor positions (vectorized over leading axes) """
+        return self.overhead_s + self.step_period_s*self.step_counts(from_steps, to_steps)
+
+    def calibrate(self, samples):
+        """ fit step_period_s and overhead_s to recorded moves by least squares
+
+        Args:
+            samples (iterable): (from_steps, to_steps, seconds) per move, e.g. TreatmentManager.move_samples
+
+        Returns:
+            rms residual (s) of the fit, or None if samples do not determine the model (then nothing changes)
+        """
+        samples = list(samples)
+        if len(samples) < 2:
+            return None
+        counts = self.step_counts([s[0] for s in samples], [s[1] for s in samples]).astype(np.float64)
+        seconds = np.array([s[2] for s in samples], dtype=np.float64)
+        if np.ptp(counts) == 0:
+            return None
+        A = np.column_stack((counts, np.ones_like(counts)))
+        (period, overhead), *_ = np.linalg.lstsq(A, seconds, rcond=None)
+        if period <= 0:
+            logger.warning('ignoring motion model fit with non-positive step period ({:g}s)'.format(period))
+            return None
+        self.step_period_s = float(period)
+        self.overhead_s = float(max(overhead, 0.0))
+        rms = float(np.sqrt(np.mean((A.dot((self.step_period_s, self.overhead_s)) - seconds)**2)))
+        logger.info('calibrated {!r} from {:d} moves (rms residual {:.3f}ms)'.format(self, len(samples), 1000*rms))
+        return rms
+
+
+class PlanTimeline():
+    """ per-segment and cumulative delivery time estimates (seconds) of a plan
+
+    A segment with beam-on time <= 0 is skipped during delivery: it takes no time, and the next delivered
+    segment moves from the last delivered one. Delivery starts from fully retracted leaflets.
+    """
+
+    def __init__(self, motion, positions, dwell_s, nleaflets=hwmodel.NLEAFLETS):
+        """
+        Args:
+            positions: leaflet extensions, shape (nsegments, nleaflets)
+            dwell_s:   beam-on time per segment, <=0 for skipped (or undeliverable) segments
+        """
+        self.motion = motion
+        self.nleaflets = nleaflets
+        self._steps = motion.to_steps(np.asarray(positions, dtype=np.float64).reshape(-1, nleaflets))
+        self._dwell = np.asarray(dwell_s, dtype=np.float64).reshape(-1).copy()
+        self._move = np.zeros(len(self._dwell))
+        delivered = np.nonzero(self._dwell > 0)[0]
+        if len(delivered):
+            to_steps = self._steps[delivered]
+            from_steps = np.vstack((np.zeros((1, nleaflets), dtype=np.int64), to_steps[:-1]))
+            self._move[delivered] = motion.move_time(from_steps, to_steps)
+        self._cumulative = np.empty(len(self._dwell))
+        self._valid = 0 # cumulative times are up to date for rows < _valid
+
+    def __len__(self):
+        return len(self._dwell)
+
+    def _prevDelivered(self, row):
+        row -= 1
+        while row >= 0 and self._dwell[row] <= 0:
+            row -= 1
+        return row
+
+    def _nextDelivered(self, row):
+        while row < len(self._dwell) and self._dwell[row] <= 0:
+            row += 1
+        return row
+
+    def _updateMove(self, row):
+        """ recompute the move into row (if it is delivered) """
+        if not 0 <= row < len(self._dwell):
+            return
+        if self._dwell[row] <= 0:
+            self._move[row] = 0
+        else:
+            prev = self._prevDelivered(row)
+            from_steps = self._steps[prev] if prev >= 0 else np.zeros(self.nleaflets, dtype=np.int64)
+            self._move[row] = self.motion.move_time(from_steps, self._steps[row])
+        self._valid = min(self._valid, row)
+
+    def _changed(self, row):
+        """ rows from row on may have a different predecessor """
+        self._updateMove(row)
+        self._updateMove(self._nextDelivered(row+1))
+        self._valid = min(self._valid, row)
+
+    def update(self, row, positions, dwell_s):
+        self._steps[row] = self.motion.to_steps(positions)
+        self._dwell[row] = dwell_s
+        self._changed(row)
+
+    def insert(self, row, positions, dwell_s):
+        """ insert segments before row """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, self.nleaflets)
+        self._insertSteps(row, self.motion.to_steps(positions), dwell_s)
+
+    def _insertSteps(self, row, steps, dwell_s):
+        count = len(steps)
+        self._steps = np.insert(self._steps, row, steps, axis=0)
+        self._dwell = np.insert(self._dwell, row, dwell_s)
+        self._move = np.insert(self._move, row, np.zeros(count))
+        self._cumulative = np.insert(self._cumulative, row, np.zeros(count))
+        for r in range(row, row+count):
+            self._updateMove(r)
+        self._changed(row+count-1)
+
+    def remove(self, row, count=1):
+        self._steps = np.delete(self._steps, np.s_[row:row+count], axis=0)
+        self._dwell = np.delete(self._dwell, np.s_[row:row+count])
+        self._move = np.delete(self._move, np.s_[row:row+count])
+        self._cumulative = np.delete(self._cumulative, np.s_[row:row+count])
+        self._valid = min(self._valid, row)
+        self._updateMove(self._nextDelivered(row))
+
+    def move(self, src, dst):
+        """ move the segment at src so that it ends up at index dst """
+        steps, dwell = self._steps[src:src+1].copy(), self._dwell[src]
+        self.remove(src)
+        self._insertSteps(dst, steps, dwell)
+
+    def moveTimes(self):
+        """ estimated travel time into each segment (read-only view) """
+        v = self._move.view()
+        v.flags.writeable = False
+        return v
+
+    def segmentTimes(self):
+        """ estimated move + beam-on time of each segment """
+        return self._move + np.maximum(self._dwell, 0)
+
+    def cumulativeTimes(self):
+        """ estimated time at which each segment finishes, counted from treatment start (read-only view) """
+        n = len(self._dwell)
+        if self._valid < n:
+            k = self._valid
+            base = self._cumulative[k-1] if k > 0 else 0.0
+            self._cumulative[k:] = base + np.cumsum(self._move[k:] + np.maximum(self._dwell[k:], 0))
+            self._valid = n
+        v = self._cumulative.view()
+        v.flags.writeable = False
+        return v
+
+    def total(self):
+        n = len(self._dwell)
+        return float(self.cumulativeTimes()[-1]) if n else 0.0
@@ -0,0 +1,124 @@
+""" optimizer.py
+
+Segment ordering that minimizes leaflet travel time.
+
+The order of the segments between two pinned segments (or the ends of the optimized range) is an open
+travelling-salesman path with fixed endpoints. It is solved heuristically: nearest-neighbour construction
+followed by 2-opt segment reversals, both vectorized with NumPy over a pairwise move-time matrix computed
+with the MotionModel, which handles thousands of segments in seconds.
+"""
+import time
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def cost_matrix(motion, from_steps, to_steps, block_bytes=1<<26):
+    """ pairwise move time (s) from every row of from_steps to every row of to_steps (float32)
+
+    Computed in row blocks so that the (rows, cols, nleaflets) intermediate stays below block_bytes.
+    """
+    from_steps = np.asarray(from_steps, dtype=np.int64)
+    to_steps = np.asarray(to_steps, dtype=np.int64)
+    out = np.empty((len(from_steps), len(to_steps)), dtype=np.float32)
+    block = max(1, block_bytes // max(1, 8*to_steps.size))
+    for ii in range(0, len(from_steps), block):
+        out[ii:ii+block] = motion.move_time(from_steps[ii:ii+block, None, :], to_steps[None, :, :])
+    return out
+
+def _nearest_neighbour(C, c_start):
+    """ path through all nodes of C, greedily starting from the node closest to the start anchor """
+    m = len(C)
+    path = np.empty(m, dtype=np.intp)
+    visited = np.zeros(m, dtype=bool)
+    cur = int(np.argmin(c_start))
+    for ii in range(m):
+        path[ii] = cur
+        visited[cur] = True
+        if ii < m-1:
+            row = np.where(visited, np.inf, C[cur])
+            cur = int(np.argmin(row))
+    return path
+
+def _two_opt(path, C, c_start, c_end, max_passes=50, deadline=None):
+    """ improve path in place by reversing sub-paths while that shortens it
+
+    c_start[k]/c_end[k] are the costs between node k and the fixed start/end anchors (c_end is 0 for an open end).
+    """
+    m = len(path)
+    for npass in range(max_passes):
+        improved = False
+        for i in range(m-1):
+            p = path
+            j = np.arange(i+1, m)
+            pj = p[j]
+            nxt = np.empty(len(j), dtype=np.float64)  # cost of edges (p[j], p[j+1]) being replaced
+            new_b = np.empty(len(j), dtype=np.float64) # cost of edges (p[i], p[j+1]) replacing them
+            nxt[:-1] = C[pj[:-1], p[j[:-1]+1]]
+            nxt[-1] = c_end[pj[-1]]
+            new_b[:-1] = C[p[i], p[j[:-1]+1]]
+            new_b[-1] = c_end[p[i]]
+            if i == 0:
+                new_a = c_start[pj]
+                old_a = c_start[p[0]]
+            else:
+                new_a = C[p[i-1], pj]
+                old_a = C[p[i-1], p[i]]
+            delta = new_a + new_b - old_a - nxt
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                path[i:j[k]+1] = path[i:j[k]+1][::-1].copy()
+                improved = True
+        if not improved or (deadline is not None and time.perf_counter() > deadline):
+            break
+    return path
+
+def path_cost(path, C, c_start, c_end):
+    if not len(path):
+        return 0.0
+    return float(c_start[path[0]] + C[path[:-1], path[1:]].sum() + c_end[path[-1]])
+
+def optimize_order(motion, steps, pinned, start_steps=None, end_steps=None, max_passes=50, time_limit=None):
+    """ order segments to minimize the summed move time
+
+    Args:
+        steps:       motor steps per segment, shape (n, nleaflets)
+        pinned:      bool per segment; pinned segments keep their index, the others are reordered only
+                     between the pinned segments around them
+        start_steps: position before the first segment (fully retracted if None)
+        end_steps:   position the last segment is followed by, if any
+        time_limit (float): seconds after which 2-opt stops improving
+
+    Returns:
+        order (np.ndarray): permutation of range(n); segment order[k] goes to index k
+    """
+    steps = np.asarray(steps, dtype=np.int64)
+    n = len(steps)
+    order = np.arange(n)
+    if start_steps is None:
+        start_steps = np.zeros(steps.shape[1:], dtype=np.int64)
+    deadline = time.perf_counter()+time_limit if time_limit is not None else None
+    # runs of unpinned segments, each between fixed anchors
+    pinned = np.asarray(pinned, dtype=bool)
+    bounds = np.flatnonzero(np.diff(np.concatenate(([1], pinned.astype(np.int8), [1]))))
+    for first, stop in zip(bounds[::2], bounds[1::2]):
+        m = stop-first
+        if m < 2:
+            continue
+        run = steps[first:stop]
+        anchor_start = steps[first-1] if first > 0 else start_steps
+        C = cost_matrix(motion, run, run)
+        c_start = cost_matrix(motion, anchor_start[None, :], run)[0]
+        if stop < n:
+            c_end = cost_matrix(motion, run, steps[stop][None, :])[:, 0]
+        elif end_steps is not None:
+            c_end = cost_matrix(motion, run, np.asarray(end_steps)[None, :])[:, 0]
+        else:
+            c_end = np.zeros(m, dtype=np.float32)
+        before = path_cost(np.arange(m), C, c_start, c_end)
+        path = _two_opt(_nearest_neighbour(C, c_start), C, c_start, c_end, max_passes, deadline)
+        after = path_cost(path, C, c_start, c_end)
+        logger.debug('segments #{:d}-#{:d}: travel {:.3f}s -> {:.3f}s'.format(first+1, stop, before, after))
+        if after < before:
+            order[first:stop] = first + path
+    return order
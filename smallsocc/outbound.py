@@ -0,0 +1,159 @@
+""" outbound.py
+
+Queue and writer thread for frames sent to the SOC hardware.
+
+Callers (mostly on the GUI thread) only append to an OutboundQueue, which never blocks on the serial port.
+A SerialWriterThread owned by SerialThread drains the queue in FIFO order. Frames queued with
+coalesce=True (interactive leaflet positions) replace a coalescable frame still waiting at the tail of
+the queue, and are held back while the HW is still acting on the previous one, so rapid manipulation
+collapses into a single up-to-date frame instead of a backlog for the firmware to work through.
+All other frames keep strict ordering, and are never held back: a coalescable frame with other frames
+queued behind it is sent without waiting.
+
+The firmware answers frames that move the leaflets (see hwmodel.expects_reply()) with one reply each, in
+order, so the gate counts replies and opens at the reply to the coalescable frame that closed it, not at
+one answering an earlier frame. The same count tells callers which frame a reply answers: put() returns
+the number of the reply that answers the frame, and release() the number of the reply just received.
+"""
+import time
+import logging
+from collections import deque
+from PyQt5.QtCore import QThread, QMutex, QWaitCondition
+
+logger = logging.getLogger(__name__)
+
+class OutboundQueue():
+    """ FIFO of frames awaiting transmission with last-writer-wins collapse of coalescable frames """
+
+    def __init__(self, ack_timeout=5.0, expects_reply=lambda data: True):
+        """
+        Args:
+            ack_timeout (float): seconds to hold coalescable frames while waiting for HW to ack the last one
+            expects_reply (callable): True for frames the HW answers with one reply (see release())
+        """
+        self.ack_timeout = ack_timeout
+        self.expects_reply = expects_reply
+        self.alive = True
+        self.ncoalesced = 0 # frames replaced before reaching the wire
+        self._frames = deque()
+        self._gate_deadline = None # set while a coalescable frame is unacknowledged
+        self._gate_reply = 0       # replies received by the time the coalescable frame is answered
+        self._queued_replies = 0   # replies expected to the frames queued so far
+        self._sent_replies = 0     # replies expected to the frames sent so far
+        self._recvd_replies = 0
+        self._lock = QMutex()
+        self._wait_frame = QWaitCondition()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, data, coalesce=False):
+        """ queue a frame; never blocks on I/O
+
+        Returns:
+            number of the reply that will answer the frame (compare with release()), or None if it expects none
+        """
+        t_queued = time.perf_counter()
+        expects = self.expects_reply(data)
+        self._lock.lock()
+        if coalesce and self._frames and self._frames[-1][1]:
+            # keep the original queue time; the position update has been waiting since then
+            self._queued_replies -= self.expects_reply(self._frames[-1][0])
+            self._frames[-1] = (data, True, self._frames[-1][2])
+            self.ncoalesced += 1
+        else:
+            self._frames.append((data, coalesce, t_queued))
+        self._queued_replies += expects
+        reply = self._queued_replies if expects else None
+        self._wait_frame.wakeAll()
+        self._lock.unlock()
+        return reply
+
+    def release(self):
+        """ HW acknowledged (or rejected) a move; lets the next coalescable frame through if this answered
+        the one that closed the gate
+
+        Returns:
+            number of the reply (see put()), or 0 if it answers no frame
+        """
+        self._lock.lock()
+        # unsolicited replies (e.g. a HWERROR with nothing in flight) answer no frame
+        reply = self._recvd_replies+1 if self._recvd_replies < self._sent_replies else 0
+        self._recvd_replies = min(self._recvd_replies+1, self._sent_replies)
+        if self._gate_deadline is not None and self._recvd_replies >= self._gate_reply:
+            self._gate_deadline = None
+            self._wait_frame.wakeAll()
+        self._lock.unlock()
+        return reply
+
+    def pending_replies(self):
+        """ replies still expected to the frames queued so far """
+        self._lock.lock()
+        n = self._queued_replies - self._recvd_replies
+        self._lock.unlock()
+        return n
+
+    def replies_lost(self):
+        """ frames already sent will not be answered (e.g. the connection was lost); opens the gate """
+        self._lock.lock()
+        self._recvd_replies = self._sent_replies
+        self._gate_deadline = None
+        self._wait_frame.wakeAll()
+        self._lock.unlock()
+
+    def close(self):
+        """ wake and terminate get() """
+        self._lock.lock()
+        self.alive = False
+        self._wait_frame.wakeAll()
+        self._lock.unlock()
+
+    def get(self):
+        """ block until the head frame may be written
+
+        Returns:
+            (bytes of the next frame, perf_counter() time it was queued), or None once close() has been called
+        """
+        self._lock.lock()
+        try:
+            while self.alive:
+                if not self._frames:
+                    self._wait_frame.wait(self._lock)
+                    continue
+                if self._frames[0][1] and len(self._frames) == 1 and self._gate_deadline is not None:
+                    remaining = self._gate_deadline - time.monotonic()
+                    if remaining > 0:
+                        self._wait_frame.wait(self._lock, max(1, int(remaining*1000)))
+                        continue
+                    logger.warning('no response from HW to the previous move; sending next position anyway')
+                    # replies still outstanding are presumed lost (e.g. with the connection)
+                    self._recvd_replies = self._sent_replies
+                    self._gate_deadline = None
+                data, coalesce, t_queued = self._frames.popleft()
+                if self.expects_reply(data):
+                    self._sent_replies += 1
+                if coalesce:
+                    self._gate_deadline = time.monotonic()+self.ack_timeout
+                    self._gate_reply = self._sent_replies
+                return data, t_queued
+            return None
+        finally:
+            self._lock.unlock()
+
+
+class SerialWriterThread(QThread):
+    """ drains an OutboundQueue through a blocking write(data, t_queued) callable """
+    def __init__(self, queue, write):
+        super().__init__()
+        self.queue = queue
+        self._write = write
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            try:
+                self._write(*frame)
+            except Exception:
+                logger.exception('Error while writing to serial device')
@@ -0,0 +1,373 @@
+""" planio.py
+
+Plan file reading and writing for SequenceListModel.
+
+load_json() streams the "SequenceList" array of a plan file: the file is read in chunks and decoded one
+record at a time with json.JSONDecoder.raw_decode(), so the whole document tree never exists at once, and
+records are converted to SequenceStore columns in batches.
+
+Plans can also be stored in a binary container (.socplan) that is opened with mmap and numpy.frombuffer()
+instead of being parsed. Little-endian, version 1:
+
+    header      HEADER: magic, version, nleaflets, nsegments, position and angle sizes (bytes), then
+                (offset, length) of each of the following sections, each aligned to 8 bytes
+    records     nsegments fixed-width records, see record_dtype(): positions (int16, or int32 if a plan
+                needs it), gantry/couch angles (float32, or float64 if float32 would round them),
+                timecode_ms (float64), type (int8)
+    dates       date_created per segment, int64 seconds since the epoch
+    desc index  nsegments+1 uint64 offsets into the description blob
+    desc blob   utf-8 descriptions
+    extras      json {row: {member: value}} of values the records cannot hold (SequenceStore.irregular)
+
+Conversion between the formats is lossless: python smallsocc/planio.py plan.json plan.socplan
+"""
+import os
+import re
+import json
+import mmap
+import struct
+import codecs
+import logging
+import argparse
+from datetime import datetime
+import numpy as np
+
+import hwmodel
+from seqstore import SequenceStore, NUMBER_MEMBERS
+from sequence_members import datetimefmt
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SEPARATOR = re.compile(r'[ \t\n\r]*([,\]])[ \t\n\r]*')
+
+class _Reader():
+    """ text buffer over a (binary or text) file, refilled on demand """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.nread = 0 # bytes (or characters, for text files) read so far
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def fill(self):
+        """ read another chunk, dropping what was consumed; False at end of file """
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        self.nread += len(chunk)
+        if isinstance(chunk, bytes):
+            chunk = self._decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ next character after whitespace, without consuming it ('' at end of file) """
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or not self.fill():
+                return self.buf[self.pos:self.pos+1]
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('expected one of {!r} after {:d} bytes, found {!r}'.format(chars, self.nread, c))
+        self.pos += 1
+        return c
+
+    def value(self, decoder):
+        """ decode the next json value, reading more of the file while it is incomplete """
+        if self.pos >= len(self.buf) or self.buf[self.pos] in ' \t\n\r':
+            self.peek()
+        while True:
+            try:
+                val, end = decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # a number at the very end of the buffer may continue in the next chunk
+            if end == len(self.buf) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return val
+
+    def items(self, decoder):
+        """ yield the values of the array whose '[' was just consumed """
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value(decoder)
+            # separator and the whitespace around it in one step, unless that reaches the end of the buffer
+            m = _SEPARATOR.match(self.buf, self.pos)
+            if m is not None and m.end() < len(self.buf):
+                self.pos = m.end()
+                sep = m.group(1)
+            else:
+                sep = self.expect(',]')
+            if sep == ']':
+                return
+
+def iter_json_array(f, key='SequenceList', chunk_size=1<<20):
+    """ yield the elements of array member key of the json object in f one at a time
+
+    Other members of the top-level object are decoded and discarded.
+
+    Raises:
+        ValueError if f is not a json object or has no array member key
+    """
+    return _iterArray(_Reader(f, chunk_size), key)
+
+def _iterArray(reader, key):
+    decoder = json.JSONDecoder()
+    found = False
+    reader.expect('{')
+    if reader.peek() == '}':
+        raise ValueError('no "{}" member'.format(key))
+    while True:
+        name = reader.value(decoder)
+        reader.expect(':')
+        if name == key:
+            found = True
+            reader.expect('[')
+            yield from reader.items(decoder)
+        else:
+            reader.value(decoder)
+        if reader.expect(',}') == '}':
+            break
+    if not found:
+        raise ValueError('no "{}" member'.format(key))
+
+def load_json(fname, nleaflets=hwmodel.NLEAFLETS, batch_size=4096, progress=None):
+    """ read the SequenceList of plan file fname into a SequenceStore
+
+    Args:
+        batch_size (int):    records converted to columns at once
+        progress (callable): called with the fraction of the file read after every batch
+
+    Raises:
+        ValueError if the file is not a json object with a SequenceList array
+    """
+    size = os.path.getsize(fname)
+    store = SequenceStore(nleaflets)
+    chunks = []
+    with open(fname, 'rb') as f:
+        reader = _Reader(f, 1<<20)
+        batch = []
+        for record in _iterArray(reader, 'SequenceList'):
+            if not isinstance(record, dict):
+                raise ValueError('SequenceList entries must be objects, not {!s}'.format(type(record).__name__))
+            batch.append(record)
+            if len(batch) >= batch_size:
+                chunks.append(store.columns(batch))
+                batch = []
+                if progress is not None and size:
+                    progress(min(reader.nread/size, 1.0))
+        if batch:
+            chunks.append(store.columns(batch))
+    store.extend(chunks)
+    if progress is not None:
+        progress(1.0)
+    logger.debug('read {:d} segments from "{}"'.format(len(store), fname))
+    return store
+
+
+def _dumps(d, indent):
+    """ json text of d as written by save_json(), nested indent levels deep """
+    return json.dumps(d, indent=2, separators=(',', ':'), sort_keys=True).replace('\n', '\n' + '  '*indent)
+
+_encode = json.JSONEncoder(sort_keys=True, separators=(',', ':')).encode
+_escape = json.encoder.encode_basestring_ascii
+
+def _scalar(x):
+    t = type(x)
+    if t is int:
+        return int.__repr__(x)
+    if t is str:
+        return _escape(x)
+    return _encode(x)
+
+def _fragment(d, indent):
+    """ _dumps(d, indent) for a segment's member dict; json's indenting encoder is pure python, so values
+    are encoded one at a time with the C encoder instead """
+    pad = '  '*indent
+    items = []
+    for k in sorted(d):
+        v = d[k]
+        if isinstance(v, list) and v and not any(isinstance(x, (list, dict)) for x in v):
+            text = '[\n' + pad + '    ' + (',\n' + pad + '    ').join(map(_scalar, v)) + '\n' + pad + '  ]'
+        elif isinstance(v, (list, dict)):
+            text = _dumps(v, indent+1)
+        else:
+            text = _scalar(v)
+        items.append(pad + '  ' + _escape(k) + ':' + text)
+    return '{\n' + ',\n'.join(items) + '\n' + pad + '}' if items else '{}'
+
+def save_json(store, fname, fragments=None):
+    """ write the rows of store as a json plan file (the format read by load_json())
+
+    The text is identical to json.dumps() of the whole document with indent=2 and sort_keys, but assembled
+    from per-row fragments. fragments ({row id: (store.edits of the row, text)}) caches them between saves:
+    only rows edited since their fragment was encoded are encoded again, and rows no longer in store are
+    dropped from it.
+    """
+    if fragments is None:
+        fragments = {}
+    ids = store.ids.tolist()
+    edits = store.edits.tolist()
+    memlist = []
+    for row, (rowid, nedits) in enumerate(zip(ids, edits)):
+        cached = fragments.get(rowid)
+        if cached is None or cached[0] != nedits:
+            cached = fragments[rowid] = (nedits, '    ' + _fragment(store.packRow(row), 2))
+        memlist.append(cached[1])
+    if len(fragments) > len(ids):
+        for rowid in fragments.keys() - set(ids):
+            del fragments[rowid]
+
+    # wrap with header
+    metadata = {'generated_on': datetime.now().strftime(datetimefmt)}
+    js = '{\n  "SequenceList":' + ('[\n' + ',\n'.join(memlist) + '\n  ]' if memlist else '[]') \
+        + ',\n  "metadata":' + _dumps(metadata, 1) + '\n}'
+
+    with open(fname, 'w') as f:
+        f.write(js)
+
+## BINARY PLANS
+MAGIC = b'SOCPLAN\x00'
+VERSION = 1
+BINARY_EXT = '.socplan'
+HEADER = struct.Struct('<8sHHIBB2x10Q')
+_SECTIONS = 5 # records, dates, desc index, desc blob, extras
+
+def record_dtype(nleaflets, position_size=2, angle_size=4):
+    return np.dtype([('positions', '<i{:d}'.format(position_size), (nleaflets,)),
+                     ('rot_gantry_deg', '<f{:d}'.format(angle_size)),
+                     ('rot_couch_deg', '<f{:d}'.format(angle_size)),
+                     ('timecode_ms', '<f8'),
+                     ('type', 'i1')])
+
+def is_binary(fname):
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def _fits(values, dtype):
+    """ True if values survive a round trip through dtype unchanged """
+    return np.array_equal(values.astype(dtype).astype(values.dtype), values, equal_nan=values.dtype.kind == 'f')
+
+def save_binary(store, fname):
+    """ write the rows of store as a binary plan file (see the module docstring) """
+    n = len(store)
+    position_size = 2 if _fits(store.positions, np.int16) else 4
+    angle_size = 4 if _fits(store.rot_gantry_deg, np.float32) and _fits(store.rot_couch_deg, np.float32) else 8
+    records = np.zeros(n, dtype=record_dtype(store.nleaflets, position_size, angle_size))
+    records['positions'] = store.positions
+    for k in NUMBER_MEMBERS:
+        records[k] = getattr(store, k)
+    records['type'] = store.type
+
+    extras = {str(row): dict(irr) for row, irr in store.irregularRows()}
+    descriptions = []
+    for row, desc in enumerate(store.description):
+        if isinstance(desc, str):
+            descriptions.append(desc.encode('utf-8'))
+        else:
+            descriptions.append(b'')
+            extras.setdefault(str(row), {})['description'] = desc
+    index = np.zeros(n+1, dtype='<u8')
+    np.cumsum([len(d) for d in descriptions], out=index[1:])
+
+    sections = [records.tobytes(),
+                store.date_created.astype('<i8').tobytes(),
+                index.tobytes(),
+                b''.join(descriptions),
+                json.dumps(extras, sort_keys=True).encode('utf-8') if extras else b'']
+    table = []
+    offset = HEADER.size
+    for data in sections:
+        offset += -offset % 8
+        table += [offset, len(data)]
+        offset += len(data)
+    with open(fname, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, store.nleaflets, n, position_size, angle_size, *table))
+        for data, start in zip(sections, table[::2]):
+            f.write(b'\x00'*(start-f.tell()))
+            f.write(data)
+
+def load_binary(fname, nleaflets=hwmodel.NLEAFLETS):
+    """ open a binary plan file as a SequenceStore
+
+    The file is mapped copy-on-write: number, type and date columns are views of the mapping (float32
+    angles and int16 positions are widened to the store's column types), and edits never reach the file.
+
+    Raises:
+        ValueError if the file is not a binary plan of this version, or was written for other hardware
+    """
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if len(mm) < HEADER.size:
+        raise ValueError('"{}" is not a binary plan'.format(fname))
+    magic, version, file_nleaflets, n, position_size, angle_size, *table = HEADER.unpack_from(mm, 0)
+    if magic != MAGIC:
+        raise ValueError('"{}" is not a binary plan'.format(fname))
+    if version != VERSION:
+        raise ValueError('"{}" is binary plan version {:d}, only version {:d} is supported'.format(fname, version, VERSION))
+    if file_nleaflets != nleaflets:
+        raise ValueError('"{}" is a plan for {:d} leaflets, not {:d}'.format(fname, file_nleaflets, nleaflets))
+    sections = list(zip(table[::2], table[1::2]))
+    if len(mm) < max(start+length for start, length in sections):
+        raise ValueError('"{}" is truncated'.format(fname))
+
+    records = np.frombuffer(mm, dtype=record_dtype(nleaflets, position_size, angle_size), count=n, offset=sections[0][0])
+    positions = records['positions'].astype(np.int32)
+    numbers = {k: records[k] if records[k].dtype == np.float64 else records[k].astype(np.float64) for k in NUMBER_MEMBERS}
+    dates = np.frombuffer(mm, dtype='<i8', count=n, offset=sections[1][0]).view('datetime64[s]')
+    index = np.frombuffer(mm, dtype='<u8', count=n+1, offset=sections[2][0]).tolist()
+    start, length = sections[3]
+    blob = mm[start:start+length]
+    descriptions = [blob[a:b].decode('utf-8') for a, b in zip(index[:-1], index[1:])]
+    irregular = [None]*n
+    start, length = sections[4]
+    if length:
+        for row, irr in json.loads(mm[start:start+length].decode('utf-8')).items():
+            row = int(row)
+            if 'description' in irr:
+                descriptions[row] = irr.pop('description')
+            irregular[row] = irr or None
+    store = SequenceStore.fromColumns(positions, numbers, records['type'], dates, descriptions, irregular, nleaflets)
+    logger.debug('mapped {:d} segments from "{}"'.format(n, fname))
+    return store
+
+def load(fname, nleaflets=hwmodel.NLEAFLETS, progress=None):
+    """ read a json or binary plan file into a SequenceStore """
+    if is_binary(fname):
+        store = load_binary(fname, nleaflets)
+        if progress is not None:
+            progress(1.0)
+        return store
+    return load_json(fname, nleaflets, progress=progress)
+
+def convert(src, dst, nleaflets=hwmodel.NLEAFLETS):
+    """ convert plan file src to dst; dst is binary if it ends in BINARY_EXT, json otherwise """
+    store = load(src, nleaflets)
+    if dst.endswith(BINARY_EXT):
+        save_binary(store, dst)
+    else:
+        save_json(store, dst)
+    return len(store)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='convert treatment plans between json and binary ({}) files'.format(BINARY_EXT))
+    parser.add_argument('src', type=str, help='plan to read (json or binary)')
+    parser.add_argument('dst', type=str, help='file to write; binary if it ends in {}, json otherwise'.format(BINARY_EXT))
+    parser.add_argument('--nleaflets', type=int, default=hwmodel.NLEAFLETS, help='number of leaflets of the plan')
+    args = parser.parse_args()
+    print('converted {:d} segments'.format(convert(args.src, args.dst, args.nleaflets)))
@@ -0,0 +1,173 @@
+""" program.py
+
+Pre-flight compilation of a treatment plan into an immutable, flat delivery program.
+
+The rows of a SequenceListModel may be edited by the GUI at any time, and hold whatever the plan file
+contained (e.g. timecodes stored as strings). compile_program() validates every segment up front and
+copies everything delivery needs into packed arrays and pre-encoded wire frames, so that the
+TreatmentManager never touches the model while a treatment is running.
+"""
+import math
+import logging
+from array import array
+import numpy as np
+
+import hwmodel
+import constraints
+from seqstore import NUMBER_MEMBERS
+from motionmodel import MotionModel
+
+logger = logging.getLogger(__name__)
+
+class ProgramError(ValueError):
+    """ raised by compile_program(); errors holds (row, message) for every problem found """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('plan cannot be delivered: ' + '; '.join('segment #{:d}: {!s}'.format(row+1, msg) for row, msg in errors))
+
+
+class DeliveryProgram():
+    """ read-only, array-backed delivery plan (see compile_program()) """
+    __slots__ = ('nleaflets', 'positions', 'durations', 'rot_gantry_deg', 'rot_couch_deg', 'frames', 'payloads',
+                 'stationary', 'warnings', 'motion')
+
+    def __init__(self, nleaflets, positions, durations, rot_gantry_deg, rot_couch_deg, frames, payloads, stationary=None,
+                 warnings=(), motion=None):
+        """
+        Args:
+            positions (array('h')):  leaflet extensions, nleaflets per segment (row-major)
+            durations (array('d')):  beam-on time (ms) per segment; <=0 marks a segment that is skipped
+            frames (tuple):          complete PRE_ABSPOS_ALL frame per segment
+            payloads (tuple):        encoded positions per segment (PRE_ABSPOS_BATCH records)
+            stationary (array('b')): 1 where a delivered segment has the positions of the previous delivered
+                                     segment, so that the leaflets do not move
+            motion (MotionModel):    move time estimates for the delivery (not modified while the program is used)
+        """
+        if stationary is None:
+            stationary = array('b', bytes(len(durations)))
+        setattr_ = super().__setattr__
+        setattr_('nleaflets', nleaflets)
+        setattr_('positions', memoryview(positions).toreadonly())
+        setattr_('durations', memoryview(durations).toreadonly())
+        setattr_('rot_gantry_deg', memoryview(rot_gantry_deg).toreadonly())
+        setattr_('rot_couch_deg', memoryview(rot_couch_deg).toreadonly())
+        setattr_('frames', tuple(frames))
+        setattr_('payloads', tuple(payloads))
+        setattr_('stationary', memoryview(stationary).toreadonly())
+        setattr_('warnings', tuple(warnings))
+        setattr_('motion', motion if motion is not None else MotionModel())
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DeliveryProgram is immutable')
+
+    def __len__(self):
+        return len(self.durations)
+
+    def segment_positions(self, idx):
+        """ leaflet extensions of segment idx """
+        return tuple(self.positions[idx*self.nleaflets:(idx+1)*self.nleaflets])
+
+    def segment_steps(self, idx):
+        """ motor steps of segment idx """
+        return hwmodel.to_steps(self.segment_positions(idx))
+
+
+def _to_number(value, name, row, warnings):
+    """ coerce a numeric plan field; strings are accepted with a warning as long as they parse """
+    if isinstance(value, bool):
+        raise ValueError('{} must be a number, not {!r}'.format(name, value))
+    if isinstance(value, (int, float)):
+        number = float(value)
+    else:
+        try:
+            number = float(str(value).strip())
+        except ValueError:
+            raise ValueError('{} must be a number, not {!r}'.format(name, value))
+        warnings.append((row, '{} given as text {!r}, using {:g}'.format(name, value, number)))
+    if not math.isfinite(number):
+        raise ValueError('{} must be finite, not {!r}'.format(name, value))
+    return number
+
+def coercion_warnings(store):
+    """ (row, message) for every numeric field of a SequenceStore that compile_program() accepts as text
+
+    compile_program() returns these on DeliveryProgram.warnings without logging them, since a plan is compiled
+    for every treatment; this lets them be reported once, e.g. when the plan is loaded.
+    """
+    warnings = []
+    for row, irregular in store.irregularRows():
+        for name in NUMBER_MEMBERS:
+            if name in irregular:
+                try:
+                    _to_number(irregular[name], name, row, warnings)
+                except ValueError:
+                    pass # an error, reported by compile_program()
+    return warnings
+
+def compile_program(store, nleaflets=hwmodel.NLEAFLETS, min_ext=hwmodel.MIN_EXTENSION, max_ext=hwmodel.MAX_EXTENSION,
+                    motion=None):
+    """ validate the rows of a SequenceStore and flatten them into a DeliveryProgram
+
+    Checks leaflet count, integer extensions within [min_ext, max_ext], the firmware collision limits, and
+    numeric timecodes and angles.
+
+    Args:
+        motion (MotionModel): move time estimates handed to the delivery; must not be modified afterwards
+
+    Raises:
+        ProgramError listing every invalid segment
+    """
+    n = len(store)
+    errors = {}     # row -> first problem found
+    warnings = []
+    numbers = {name: getattr(store, name) for name in NUMBER_MEMBERS}
+    # values the columns could not hold as given
+    for row, irregular in store.irregularRows():
+        try:
+            if 'extension_list' in irregular:
+                ext = irregular['extension_list']
+                if len(ext) != nleaflets:
+                    raise ValueError('extension_list must be len={} not len={}'.format(nleaflets, len(ext)))
+                for ii, pos in enumerate(ext):
+                    if isinstance(pos, bool) or not isinstance(pos, (int, np.integer)):
+                        raise ValueError('extension of leaflet #{:d} must be an integer, not {!r}'.format(ii+1, pos))
+                raise ValueError('extension_list {!s} cannot be encoded'.format(ext))
+            for name in NUMBER_MEMBERS:
+                if name in irregular:
+                    _to_number(irregular[name], name, row, warnings)
+        except ValueError as e:
+            errors.setdefault(row, str(e))
+    if store.nleaflets != nleaflets:
+        for row in range(n):
+            errors.setdefault(row, 'extension_list must be len={} not len={}'.format(nleaflets, store.nleaflets))
+    for name, column in numbers.items():
+        for row in np.flatnonzero(~np.isfinite(column)).tolist():
+            errors.setdefault(row, '{} must be finite, not {!r}'.format(name, store.get(row, name)))
+
+    # travel range and firmware collision limits for the whole plan at once
+    ok = np.ones(n, dtype=bool)
+    ok[list(errors)] = False
+    rows = np.flatnonzero(ok)
+    if len(rows) and store.nleaflets == nleaflets:
+        for v in constraints.check_plan(store.positions[rows], min_ext, max_ext):
+            errors.setdefault(int(rows[v.row]), constraints.describe(v, min_ext, max_ext))
+    if errors:
+        raise ProgramError(sorted(errors.items()))
+
+    # wire encoding of every segment at once
+    encoded = store.positions.astype('>i2')
+    payloads = [row.tobytes() for row in encoded]
+    prefix = hwmodel.MAGIC_BYTES + hwmodel.PRE_ABSPOS_ALL
+    frames = [prefix + payload for payload in payloads]
+    positions = array('h', store.positions.astype(np.int16).tobytes())
+    durations = array('d', numbers['timecode_ms'].tobytes())
+    gantry = array('d', numbers['rot_gantry_deg'].tobytes())
+    couch = array('d', numbers['rot_couch_deg'].tobytes())
+    # zero-motion transitions need no HW round trip
+    stationary = array('b', bytes(n))
+    previous = None
+    for idx, payload in enumerate(payloads):
+        if durations[idx] > 0:
+            stationary[idx] = payload == previous
+            previous = payload
+    return DeliveryProgram(nleaflets, positions, durations, gantry, couch, frames, payloads, stationary, warnings, motion)
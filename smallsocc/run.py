@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""run.py
+
+headless plan delivery for scripted QA runs: smallsocc-run plan.json
+
+Loads a plan, delivers it to the hardware with the TreatmentManager on a QCoreApplication event loop (no
+QML/OpenGL, no display needed) and prints the result, including per-segment timing, as JSON.
+
+Exit status: 0 if the plan was delivered completely, 1 if it was invalid or delivery aborted, 2 on timeout.
+"""
+import sys
+import os
+import time
+import json
+import signal
+signal.signal(signal.SIGINT, signal.SIG_DFL) # allow ctrl-c kill
+import argparse
+import logging
+
+from PyQt5.QtCore import QCoreApplication, QEventLoop, QTimer
+
+FILE_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, FILE_DIR)
+
+import soclog
+import hwmodel
+from version import VERSION_FULL
+from program import ProgramError
+from sequence import SequenceListModel
+from scheduler import summarize_timing
+from hardware import HWSOC
+from treatmentmanager import TreatmentManager
+from journal import DeliveryJournal, resume_point
+
+logger = logging.getLogger(__name__)
+
+def check_plan(model, nleaflets=hwmodel.NLEAFLETS):
+    """ compile the plan without touching the hardware
+
+    Returns:
+        (DeliveryProgram or None, list of {'segment', 'error'})
+    """
+    try:
+        return model.compileProgram(nleaflets), []
+    except ProgramError as e:
+        return None, [{'segment': row, 'error': msg} for row, msg in e.errors]
+
+def wait_moves_done(hwsoc, timeout):
+    """ run a local event loop until the HW answered every move queued so far, e.g. the initial move of HWSOC
+
+    Returns:
+        True if it did within timeout (seconds)
+    """
+    protocol = hwsoc.tserialinterface.protocol
+    loop = QEventLoop()
+    check = lambda *args: hwsoc.moves_pending() or loop.quit()
+    # connected before checking, so that a reply arriving in between still ends the loop
+    protocol.sigRecvdMoveOK.connect(check)
+    protocol.sigRecvdHWError.connect(check)
+    QTimer.singleShot(int(timeout*1000), loop.quit)
+    if hwsoc.moves_pending():
+        loop.exec_()
+    protocol.sigRecvdMoveOK.disconnect(check)
+    protocol.sigRecvdHWError.disconnect(check)
+    return not hwsoc.moves_pending()
+
+def deliver(app, model, hwsoc, start=0, timeout=None, use_deadlines=False, journal=None, first_ms=None, stop_timeout=2.0,
+            ready_timeout=10.0):
+    """ deliver model to hwsoc on the running QCoreApplication app and wait for the treatment to end
+
+    Args:
+        first_ms (float): beam-on time (ms) left for segment start when resuming; None for its full duration
+        stop_timeout (float): seconds to wait for the treatment to stop after timeout
+        ready_timeout (float): seconds to wait for the HW to finish moves queued before the treatment
+
+    Returns:
+        dict with 'status' ('completed', 'aborted' or 'timeout'), 'last_segment', 'elapsed_s' and 'report'
+    """
+    # the HW acts on frames in order: the first segment would wait behind the initial move of hwsoc
+    if not wait_moves_done(hwsoc, ready_timeout):
+        logger.warning('HW did not finish its previous moves within {:g}s; starting anyway'.format(ready_timeout))
+    tm = TreatmentManager(model, device=hwsoc.device, journal=journal)
+    tm.use_deadlines = use_deadlines
+    result = {'status': 'timeout', 'last_segment': None, 'elapsed_s': None, 'report': []}
+
+    def ended(status, idx):
+        if result['status'] == 'timeout':
+            result['status'] = status
+            result['last_segment'] = idx
+            result['elapsed_s'] = time.perf_counter()-t_start
+            app.quit()
+    tm.onTimingReport.connect(lambda report: result.__setitem__('report', report))
+    tm.onTreatmentCompleted.connect(lambda idx: ended('completed', idx))
+    tm.onTreatmentAborted.connect(lambda idx: ended('aborted', idx))
+    if timeout:
+        QTimer.singleShot(int(timeout*1000), app.quit)
+
+    t_start = time.perf_counter()
+    if first_ms is None:
+        tm.startTreatment.emit(start)
+    else:
+        tm.resumeTreatment.emit(start, first_ms)
+    app.exec_()
+    if result['status'] == 'timeout':
+        # the worker must handle the stop (tell the HW, journal it) before its thread is quit
+        loop = QEventLoop()
+        tm.onTreatmentStopped.connect(loop.quit)
+        tm.onTreatmentAborted.connect(loop.quit)
+        QTimer.singleShot(int(stop_timeout*1000), loop.quit)
+        tm.stopTreatment.emit()
+        loop.exec_()
+        result['last_segment'] = tm.mark
+        result['elapsed_s'] = time.perf_counter()-t_start
+    tm.thread.quit()
+    tm.thread.wait()
+    return result
+
+def start_run():
+    parser = argparse.ArgumentParser(description='SmallSOCC v{!s} - deliver a treatment plan without the GUI'.format(VERSION_FULL),
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('plan', type=str, help='plan to deliver (json or binary .socplan)')
+    parser.add_argument('-L', '--loglevel', type=str, choices=sorted([*logging._nameToLevel.keys()], key=lambda x: logging._nameToLevel[x], reverse=True), default='WARNING', help='set the loglevel')
+    parser.add_argument('--logconf', type=str, default=os.path.join(FILE_DIR, 'logging.conf.json'), help='path to log configuration')
+    parser.add_argument('--port', type=str, default=None, help='serial port path to open instead of discovering devices')
+    parser.add_argument('--check', action='store_true', help='only validate the plan, do not connect to the hardware')
+    parser.add_argument('--start', type=int, default=0, help='segment to start delivery at')
+    parser.add_argument('--resume', action='store_true', help='start where the journaled delivery of this plan was interrupted')
+    parser.add_argument('--journal', type=str, default='', help='delivery journal for crash recovery (empty to disable)')
+    parser.add_argument('--deadlines', action='store_true', help='time beam-on against absolute deadlines')
+    parser.add_argument('--emulator-batch', type=int, default=0, help='batch records the emulated device advertises when no HW is found (0: stock firmware)')
+    parser.add_argument('--no-batch', action='store_true', help='send one frame per segment even if the HW supports batches')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds to wait for delivery to end')
+    parser.add_argument('-o', '--output', type=str, default=None, help='write the result to this file instead of stdout')
+    args = parser.parse_args()
+
+    # initialize logger; logs go to stderr so that stdout only carries the result
+    soclog.init_logging(level=logging._nameToLevel.get(args.loglevel, None), config_path=args.logconf)
+    _logs_to_stderr()
+
+    app = QCoreApplication(sys.argv[:1])
+
+    result = {'plan': os.path.abspath(args.plan), 'status': 'invalid', 'errors': []}
+    model = SequenceListModel()
+    if not os.path.isfile(args.plan) or not model.readFromJson(args.plan):
+        result['errors'].append({'segment': None, 'error': 'failed to read plan'})
+        return _finish(result, args.output)
+    program, result['errors'] = check_plan(model)
+    result['segments'] = len(model)
+    if program is not None:
+        result['planned_beam_on_ms'] = sum(d for d in program.durations if d > 0)
+    if result['errors'] or args.check:
+        result['status'] = 'invalid' if result['errors'] else 'valid'
+        return _finish(result, args.output)
+
+    deliveryjournal = DeliveryJournal(args.journal) if args.journal else None
+    start = args.start
+    first_ms = None
+    if args.resume:
+        point = resume_point(deliveryjournal.last_state, program) if deliveryjournal is not None else None
+        if point is None:
+            result['errors'].append({'segment': None, 'error': 'nothing to resume from the journal'})
+            return _finish(result, args.output)
+        start, first_ms = point.index, point.first_ms
+        result['resume'] = point._asdict()
+
+    hwsoc = HWSOC(hwmodel.NLEAFLETS, PORT=args.port, emulator_batch=args.emulator_batch)
+    hwsoc.use_batch = not args.no_batch
+    try:
+        outcome = deliver(app, model, hwsoc, start, args.timeout, args.deadlines, deliveryjournal, first_ms)
+        result.update({'device': hwsoc.device,
+                       'emulated': hwsoc.tserialinterface.emulator is not None,
+                       'mode': 'batch' if hwsoc.batch_size else 'per-frame',
+                       'start': start,
+                       'status': outcome['status'],
+                       'last_segment': outcome['last_segment'],
+                       'elapsed_s': outcome['elapsed_s'],
+                       'timing': summarize_timing(outcome['report']),
+                       'report': outcome['report']})
+    finally:
+        HWSOC.close_all()
+        if deliveryjournal is not None:
+            deliveryjournal.close()
+    return _finish(result, args.output)
+
+def _logs_to_stderr():
+    loggers = [logging.getLogger()] + [l for l in logging.Logger.manager.loggerDict.values() if isinstance(l, logging.Logger)]
+    for l in loggers:
+        for handler in l.handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                handler.setStream(sys.stderr)
+
+def _finish(result, output):
+    text = json.dumps(result, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return {'completed': 0, 'valid': 0, 'timeout': 2}.get(result['status'], 1)
+
+if __name__ == '__main__':
+    sys.exit(start_run())
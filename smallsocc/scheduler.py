@@ -0,0 +1,83 @@
+""" scheduler.py
+
+Absolute-deadline timing for treatment delivery.
+
+Re-arming a relative timer each time a segment starts lets event-loop and wakeup latencies accumulate
+over a plan. DeadlineTimer instead fires at an absolute time.perf_counter() deadline: it sleeps on a
+precise QTimer until shortly before the deadline, then spins for the remainder. The spin window adapts
+to the wakeup overshoot observed on this machine, so the event loop stays idle for all but the last
+millisecond or two of each segment.
+"""
+import time
+import logging
+from PyQt5.QtCore import Qt, QObject, QTimer, pyqtSignal, pyqtSlot
+
+logger = logging.getLogger(__name__)
+
+MIN_SPIN_S = 0.0005
+MAX_SPIN_S = 0.005
+
+class DeadlineTimer(QObject):
+    """ single-shot timer firing at an absolute perf_counter() deadline (sub-millisecond accuracy) """
+    timeout = pyqtSignal()
+
+    def __init__(self, parent=None, spin_s=0.002):
+        """
+        Args:
+            spin_s (float): initial busy-wait window before the deadline; adapted to observed overshoot
+        """
+        super().__init__(parent)
+        self.spin_s = spin_s
+        self._overshoot = spin_s/2 # running average of how late the QTimer wakes
+        self._deadline = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._wake)
+
+    def start(self, deadline):
+        """ fire timeout at perf_counter() == deadline (immediately if it already passed) """
+        self._deadline = deadline
+        remaining = deadline - time.perf_counter() - self.spin_s
+        self._timer.start(max(0, int(remaining*1000)))
+
+    def stop(self):
+        self._timer.stop()
+        self._deadline = None
+
+    def isActive(self):
+        return self._deadline is not None
+
+    @pyqtSlot()
+    def _wake(self):
+        if self._deadline is None:
+            return
+        late = time.perf_counter() - (self._deadline - self.spin_s)
+        self._overshoot = 0.9*self._overshoot + 0.1*max(0.0, late)
+        self.spin_s = min(max(2*self._overshoot, MIN_SPIN_S), MAX_SPIN_S)
+        while time.perf_counter() < self._deadline:
+            time.sleep(0) # yield the GIL to the serial threads while spinning
+        self._deadline = None
+        self.timeout.emit()
+
+
+def timing_record(index, planned_ms, actual_s, start_s):
+    """ one entry of a delivery timing report """
+    actual_ms = actual_s*1000
+    return {'index':      index,
+            'planned_ms': planned_ms,
+            'actual_ms':  actual_ms,
+            'error_ms':   actual_ms-planned_ms,
+            'start_s':    start_s}
+
+def summarize_timing(report):
+    """ absolute error statistics (ms) over a timing report """
+    if not report:
+        return {'count': 0, 'mean_abs_error_ms': None, 'p50_abs_error_ms': None, 'max_abs_error_ms': None,
+                'total_error_ms': None}
+    errors = sorted(abs(r['error_ms']) for r in report)
+    return {'count':             len(report),
+            'mean_abs_error_ms': sum(errors)/len(errors),
+            'p50_abs_error_ms':  errors[len(errors)//2],
+            'max_abs_error_ms':  errors[-1],
+            'total_error_ms':    sum(r['error_ms'] for r in report)}
@@ -0,0 +1,423 @@
+""" seqstore.py
+
+Columnar storage for the rows of a SequenceListModel.
+
+Each SequenceItem member is a column: NumPy arrays for leaflet positions, angles, beam-on time, type and
+creation date, and a plain list for descriptions. A row costs about a hundred bytes instead of a QObject
+with its own deep copy of the member schema.
+
+Values the columns cannot hold (an extension_list of the wrong length, numbers given as text, ...) are kept
+as given in a per-row "irregular" dict, so that they are written back unchanged and compile_program() can
+report them exactly like before.
+"""
+import math
+import logging
+import functools
+from datetime import datetime
+import numpy as np
+
+import hwmodel
+from sequence_members import _sequenceitem_public_members, SequenceItemType, datetimefmt
+
+logger = logging.getLogger(__name__)
+
+NUMBER_MEMBERS = ('rot_gantry_deg', 'rot_couch_deg', 'timecode_ms')
+MEMBERS = tuple(_sequenceitem_public_members.keys())
+PERSISTENT_MEMBERS = tuple(k for k, v in _sequenceitem_public_members.items() if not v.volatile)
+_TYPES = {e.name: e.value for e in SequenceItemType}
+_PERSISTENT_SET = frozenset(PERSISTENT_MEMBERS)
+
+_INT32 = np.iinfo(np.int32)
+
+def _datetime64(dt):
+    return np.datetime64(dt.replace(microsecond=0), 's')
+
+@functools.lru_cache(maxsize=1024)
+def _parse_date_string(val):
+    return datetime.strptime(val, datetimefmt)
+
+def parse_date(val):
+    """ date_created value -> datetime (strings are memoized: plans reuse a handful of dates) """
+    if isinstance(val, datetime):
+        return val
+    try:
+        if isinstance(val, str):
+            return _parse_date_string(val)
+        return datetime.strptime(val, datetimefmt)
+    except Exception:
+        raise RuntimeError('string: "{}" couldn\'t be mapped to a valid "datetime"'.format(val))
+
+def parse_type(val):
+    if isinstance(val, SequenceItemType):
+        return val
+    try:
+        return SequenceItemType[str(val)]
+    except Exception:
+        raise RuntimeError('string: "{}" couldn\'t be mapped to a valid "SequenceItemType"'.format(val))
+
+def parse_number(val):
+    """ (column value, irregular): numbers are stored as is; anything else is kept as given, with the
+    column holding its parsed value (or nan) """
+    if isinstance(val, (int, float, np.integer, np.floating)) and not isinstance(val, bool):
+        return float(val), False
+    try:
+        return float(str(val).strip()), True
+    except ValueError:
+        return math.nan, True
+
+def parse_positions(val, nleaflets):
+    """ (column row, irregular value or None) for an extension_list
+
+    Raises:
+        if the entries cannot be converted to int (the value is then dropped, like SequenceItem did)
+    """
+    ext = [int(p) for p in val]
+    if len(ext) != nleaflets or any(not _INT32.min <= p <= _INT32.max for p in ext):
+        return None, ext
+    return ext, None
+
+
+class SequenceStore():
+    """ column-oriented rows of SequenceItem member values """
+
+    def __init__(self, nleaflets=hwmodel.NLEAFLETS):
+        self.nleaflets = nleaflets
+        self.positions = np.zeros((0, nleaflets), dtype=np.int32)
+        self.rot_gantry_deg = np.zeros(0)
+        self.rot_couch_deg = np.zeros(0)
+        self.timecode_ms = np.zeros(0)
+        self.type = np.zeros(0, dtype=np.int8)
+        self.date_created = np.zeros(0, dtype='datetime64[s]')
+        self.description = []
+        self.unsaved = np.zeros(0, dtype=bool)
+        self.irregular = [] # per row: None, or {member name: value as given} for values the columns cannot hold
+        self.ids = np.zeros(0, dtype=np.int64) # stable row ids, kept through moves and reorders
+        self.edits = np.zeros(0, dtype=np.int64) # per row: number of set() calls, to validate caches of row data
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self.description)
+
+    ## CONSTRUCTION
+    def columns(self, records):
+        """ convert member dicts (as written by packDict()/writeToJson()) into column chunks
+
+        Records holding only persistent members are converted a column at a time with NumPy; a column falls
+        back to row-by-row conversion if any of its values is not a plain number (or list of numbers).
+        """
+        if all(record.keys() <= _PERSISTENT_SET for record in records):
+            return self._bulkColumns(records)
+        return self._rowColumns(records)
+
+    def _bulkColumns(self, records):
+        n = len(records)
+        irregular = [None]*n
+        def keep(row, k, v):
+            if irregular[row] is None:
+                irregular[row] = {}
+            irregular[row][k] = v
+
+        default = [0]*self.nleaflets
+        try:
+            ext = np.array([record.get('extension_list', default) for record in records])
+        except ValueError: # ragged
+            ext = None
+        if ext is not None and ext.shape == (n, self.nleaflets) and ext.dtype.kind in 'iuf' \
+                and np.isfinite(ext).all() and (ext >= _INT32.min).all() and (ext <= _INT32.max).all():
+            positions = np.trunc(ext).astype(np.int32)
+        else:
+            positions = np.zeros((n, self.nleaflets), dtype=np.int32)
+            for row, record in enumerate(records):
+                try:
+                    row_ext, irr = parse_positions(record.get('extension_list', default), self.nleaflets)
+                except Exception:
+                    logger.warning('failed to set SequenceItem property: extension_list')
+                    continue
+                if irr is None:
+                    positions[row] = row_ext
+                else:
+                    keep(row, 'extension_list', irr)
+
+        numbers = {}
+        for k in NUMBER_MEMBERS:
+            values = [record.get(k, 0) for record in records]
+            column = np.array(values) if values else np.zeros(0)
+            if column.dtype.kind in 'iuf':
+                numbers[k] = column.astype(np.float64)
+                continue
+            numbers[k] = np.zeros(n)
+            for row, v in enumerate(values):
+                numbers[k][row], irr = parse_number(v)
+                if irr:
+                    keep(row, k, v)
+
+        types = np.full(n, SequenceItemType.Auto.value, dtype=np.int8)
+        dates = np.empty(n, dtype='datetime64[s]')
+        descriptions = [record.get('description', '') for record in records]
+        date_cache = {}
+        now = None
+        for row, record in enumerate(records):
+            if 'type' in record:
+                try:
+                    types[row] = _TYPES[record['type']]
+                except (KeyError, TypeError):
+                    try:
+                        types[row] = parse_type(record['type']).value
+                    except Exception:
+                        logger.warning('failed to set SequenceItem property: type')
+            try:
+                date = record['date_created']
+                try:
+                    dates[row] = date_cache[date]
+                except (KeyError, TypeError):
+                    dates[row] = date_cache[date] = _datetime64(parse_date(date))
+            except Exception:
+                if 'date_created' in record:
+                    logger.warning('failed to set SequenceItem property: date_created')
+                now = now or datetime.now()
+                dates[row] = _datetime64(now)
+        return positions, numbers, types, dates, descriptions, irregular
+
+    def _rowColumns(self, records):
+        n = len(records)
+        positions = np.zeros((n, self.nleaflets), dtype=np.int32)
+        numbers = {k: np.zeros(n) for k in NUMBER_MEMBERS}
+        types = np.full(n, SequenceItemType.Auto.value, dtype=np.int8)
+        dates = np.empty(n, dtype='datetime64[s]')
+        descriptions = ['']*n
+        irregular = [None]*n
+        now = None
+        for row, record in enumerate(records):
+            extra = {}
+            date = None
+            for k, v in record.items():
+                try:
+                    if k in ('rot_gantry_rad', 'rot_couch_rad'):
+                        k, v = k.replace('rad', 'deg'), v*180/math.pi
+                    if k == 'extension_list':
+                        ext, irr = parse_positions(v, self.nleaflets)
+                        if irr is None:
+                            positions[row] = ext
+                        else:
+                            extra[k] = irr
+                    elif k in numbers:
+                        numbers[k][row], irr = parse_number(v)
+                        if irr:
+                            extra[k] = v
+                    elif k == 'description':
+                        descriptions[row] = v
+                    elif k == 'date_created':
+                        date = parse_date(v)
+                    elif k == 'type':
+                        types[row] = parse_type(v).value
+                    elif k not in MEMBERS:
+                        logger.error('"{!s}" is not a property of SequenceItem'.format(k))
+                except Exception:
+                    logger.warning('failed to set SequenceItem property: {!s}'.format(k))
+            if date is None:
+                date = now = now or datetime.now()
+            dates[row] = _datetime64(date)
+            if extra:
+                irregular[row] = extra
+        return positions, numbers, types, dates, descriptions, irregular
+
+    def insert(self, row, records):
+        """ insert rows built from member dicts before row """
+        self.insertColumns(row, *self.columns(records))
+
+    def insertColumns(self, row, positions, numbers, types, dates, descriptions, irregular, unsaved=False):
+        n = len(descriptions)
+        self.positions = np.insert(self.positions, row, positions, axis=0)
+        for k in NUMBER_MEMBERS:
+            setattr(self, k, np.insert(getattr(self, k), row, numbers[k]))
+        self.type = np.insert(self.type, row, types)
+        self.date_created = np.insert(self.date_created, row, dates)
+        self.unsaved = np.insert(self.unsaved, row, np.full(n, unsaved))
+        self.ids = np.insert(self.ids, row, np.arange(self._next_id, self._next_id+n))
+        self.edits = np.insert(self.edits, row, np.zeros(n, dtype=np.int64))
+        self._next_id += n
+        self.description[row:row] = descriptions
+        self.irregular[row:row] = irregular
+
+    def extend(self, chunks):
+        """ append the rows of column chunks returned by columns(), copying the existing columns only once """
+        chunks = list(chunks)
+        if not chunks:
+            return
+        positions, numbers, types, dates, descriptions, irregular = zip(*chunks)
+        self.insertColumns(len(self), np.concatenate(positions),
+                           {k: np.concatenate([c[k] for c in numbers]) for k in NUMBER_MEMBERS},
+                           np.concatenate(types), np.concatenate(dates),
+                           [d for c in descriptions for d in c], [i for c in irregular for i in c])
+
+    @classmethod
+    def fromColumns(cls, positions, numbers, types, dates, descriptions, irregular, nleaflets=hwmodel.NLEAFLETS):
+        """ rows holding the given columns as they are (no copies are made) """
+        self = cls(nleaflets)
+        n = len(descriptions)
+        self.positions = positions
+        for k in NUMBER_MEMBERS:
+            setattr(self, k, numbers[k])
+        self.type = types
+        self.date_created = dates
+        self.description = list(descriptions)
+        self.irregular = list(irregular)
+        self.unsaved = np.zeros(n, dtype=bool)
+        self.ids = np.arange(n, dtype=np.int64)
+        self.edits = np.zeros(n, dtype=np.int64)
+        self._next_id = n
+        return self
+
+    @classmethod
+    def fromRecords(cls, records, nleaflets=hwmodel.NLEAFLETS):
+        self = cls(nleaflets)
+        self.insert(0, list(records))
+        return self
+
+    @classmethod
+    def fromItems(cls, items, nleaflets=hwmodel.NLEAFLETS):
+        """ rows holding the member values of SequenceItems """
+        return cls.fromRecords([{k: m.value for k, m in item._members.items() if not m.volatile} for item in items], nleaflets)
+
+    def copy(self):
+        """ independent copy of all rows (e.g. to hand a snapshot to another thread) """
+        other = SequenceStore.fromColumns(self.positions.copy(), {k: getattr(self, k).copy() for k in NUMBER_MEMBERS},
+                                          self.type.copy(), self.date_created.copy(), self.description,
+                                          [dict(irr) if irr else None for irr in self.irregular], self.nleaflets)
+        other.unsaved = self.unsaved.copy()
+        other.ids = self.ids.copy()
+        other.edits = self.edits.copy()
+        other._next_id = self._next_id
+        return other
+
+    ## STRUCTURE
+    def remove(self, row, count=1):
+        rows = np.s_[row:row+count]
+        self.positions = np.delete(self.positions, rows, axis=0)
+        for k in NUMBER_MEMBERS:
+            setattr(self, k, np.delete(getattr(self, k), rows))
+        self.type = np.delete(self.type, rows)
+        self.date_created = np.delete(self.date_created, rows)
+        self.unsaved = np.delete(self.unsaved, rows)
+        self.ids = np.delete(self.ids, rows)
+        self.edits = np.delete(self.edits, rows)
+        del self.description[rows]
+        del self.irregular[rows]
+
+    def permute(self, order):
+        """ reorder rows so that row order[k] ends up at row k (rows missing from order are dropped) """
+        order = np.asarray(order, dtype=np.intp)
+        self.positions = self.positions[order]
+        for k in NUMBER_MEMBERS:
+            setattr(self, k, getattr(self, k)[order])
+        self.type = self.type[order]
+        self.date_created = self.date_created[order]
+        self.unsaved = self.unsaved[order]
+        self.ids = self.ids[order]
+        self.edits = self.edits[order]
+        self.description = [self.description[k] for k in order]
+        self.irregular = [self.irregular[k] for k in order]
+
+    def move(self, src, dst):
+        """ move row src so that it ends up at row dst """
+        order = list(range(len(self)))
+        order.insert(dst, order.pop(src))
+        self.permute(order)
+
+    ## ROW ACCESS
+    def rowOf(self, rowid):
+        """ current row of the row with id rowid, or None if it was removed """
+        rows = np.flatnonzero(self.ids == rowid)
+        return int(rows[0]) if len(rows) else None
+
+    def irregularRows(self):
+        """ (row, {member name: value as given}) of every row holding values the columns cannot """
+        return [(row, irr) for row, irr in enumerate(self.irregular) if irr]
+
+    def get(self, row, key):
+        """ member value of row, like NamedMember.value """
+        irr = self.irregular[row]
+        if irr and key in irr:
+            return irr[key]
+        if key == 'extension_list':
+            return self.positions[row].tolist()
+        if key in NUMBER_MEMBERS:
+            v = float(getattr(self, key)[row])
+            return int(v) if v.is_integer() else v
+        if key == 'description':
+            return self.description[row]
+        if key == 'date_created':
+            return self.date_created[row].item()
+        if key == 'type':
+            return SequenceItemType(int(self.type[row]))
+        if key == 'is_unsaved':
+            return bool(self.unsaved[row])
+        raise KeyError(key)
+
+    def getBasic(self, row, key):
+        """ member value of row, like NamedMember.basicvalue """
+        v = self.get(row, key)
+        if key == 'date_created' and isinstance(v, datetime):
+            return v.strftime(datetimefmt)
+        if key == 'type' and isinstance(v, SequenceItemType):
+            return v.name
+        return v
+
+    def rowDict(self, row, members=MEMBERS):
+        return {k: self.getBasic(row, k) for k in members}
+
+    def set(self, row, key, val):
+        """ set a member of row (marks the row unsaved)
+
+        Raises:
+            KeyError for unknown members, RuntimeError/ValueError for values the member does not accept
+        """
+        if key not in MEMBERS:
+            raise KeyError(key)
+        irr = self.irregular[row] or {}
+        irr.pop(key, None)
+        if key == 'extension_list':
+            ext = list(val)
+            if all(isinstance(p, (int, np.integer)) or (isinstance(p, float) and p.is_integer()) for p in ext) \
+                    and not any(isinstance(p, bool) for p in ext):
+                ext, extra = parse_positions(ext, self.nleaflets)
+            else:
+                extra = ext
+            if extra is None:
+                self.positions[row] = ext
+            else:
+                irr[key] = extra
+        elif key in NUMBER_MEMBERS:
+            getattr(self, key)[row], extra = parse_number(val)
+            if extra:
+                irr[key] = val
+        elif key == 'description':
+            self.description[row] = val
+        elif key == 'date_created':
+            self.date_created[row] = _datetime64(parse_date(val))
+        elif key == 'type':
+            self.type[row] = parse_type(val).value
+        elif key == 'is_unsaved':
+            self.unsaved[row] = bool(val)
+        self.irregular[row] = irr or None
+        if key != 'is_unsaved':
+            self.unsaved[row] = True
+            self.edits[row] += 1
+
+    def regularPositions(self, first=0, stop=None):
+        """ bool mask of rows first..stop-1 whose extension_list is held in positions """
+        irregular = self.irregular[first:stop]
+        mask = np.ones(len(irregular), dtype=bool)
+        for row, irr in enumerate(irregular):
+            if irr and 'extension_list' in irr:
+                mask[row] = False
+        return mask
+
+    def packRow(self, row):
+        """ persistent member values of row, as written to json """
+        return {k: self.getBasic(row, k) for k in PERSISTENT_MEMBERS}
+
+    def nbytes(self):
+        """ approximate memory held by the columns """
+        return (self.positions.nbytes + sum(getattr(self, k).nbytes for k in NUMBER_MEMBERS) + self.type.nbytes
+                + self.date_created.nbytes + self.unsaved.nbytes + self.ids.nbytes + self.edits.nbytes + 16*len(self))
@@ -11,14 +11,20 @@ import os
 import math
 from enum import Enum, unique
 import copy
-import json
-import json_serializer
+from collections import OrderedDict
+import hwmodel
+import constraints
+from program import compile_program, coercion_warnings
+from seqstore import SequenceStore, MEMBERS, PERSISTENT_MEMBERS
+import planio
+from motionmodel import MotionModel, PlanTimeline
+from optimizer import optimize_order
+import numpy as np
 import logging
-from datetime import datetime
 from PyQt5 import QtCore, QtQml
 from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, pyqtProperty
 from PyQt5.QtQml import qmlRegisterType
-from sequence_members import _sequenceitem_public_members, SequenceItemType, datetimefmt
+from sequence_members import _sequenceitem_public_members, SequenceItemType
 
 logger = logging.getLogger(__name__)
 
@@ -165,19 +171,31 @@ class SequenceItem(QtCore.QObject):
 class SequenceListModel(QtCore.QAbstractListModel):
     """ Model for manipulating an ordered list of SequenceItems from QML ListView
 
-    NOTE: anytime a new SequenceItem() instance is added to this collection, you MUST set the parent of the
-          SequenceItem QObject to "self" of this class. Otherwise, when handing these instances to qml through
-          self.getItem(), python will garbage collect the SequenceItem instance and qml will throw an error
+    Rows are held column-wise in a SequenceStore rather than as one SequenceItem QObject each, and handed to
+    the view fetch_batch rows at a time (canFetchMore()/fetchMore()) as it scrolls. getItem() creates a
+    SequenceItem proxy for a row on demand; edits made through it are written back to the row. Only the
+    proxy_cache_size most recently requested proxies are kept, older ones are deleted (deleteLater()).
     """
+    fetch_batch = 256      # rows handed to the view per fetchMore()
+    proxy_cache_size = 256 # SequenceItem proxies kept by getItem()
 
     ## CONSTRUCTORS
     def __init__(self, *args, **kwargs):
         """ initialize from dictionary if kwarg 'elements=[]' is provided """
         QtCore.QAbstractListModel.__init__(self, None)
         try:
-            self._items = kwargs['elements']
+            self._store = SequenceStore.fromItems(kwargs['elements'])
         except:
-            self._items = []
+            self._store = SequenceStore()
+        self.motion_model = MotionModel()
+        self._timeline = None # PlanTimeline, built on first use
+        self._proposed_order = None # (order, revision it applies to) from proposeOrder()
+        self._revision = 0 # bumped by every edit of the plan
+        self._json_fragments = {} # row id -> (edits, json text) cache for writeToJson()
+        self._saved_revision = 0 # _revision when the plan was last loaded or saved
+        self._proxies = OrderedDict() # row id -> SequenceItem proxy from getItem(), least recently used first
+        self._syncing = False # True while proxies are being updated from their rows
+        self._fetched = min(len(self._store), self.fetch_batch) # rows the view has been told about
 
     @classmethod
     def fromJson(cls, fname):
@@ -185,56 +203,262 @@ class SequenceListModel(QtCore.QAbstractListModel):
         self.readFromJson(fname)
         return self
 
+    loadProgress = pyqtSignal(float, arguments=['fraction'])
+    def _loadProgress(self, fraction):
+        self.loadProgress.emit(fraction)
+        # let qml repaint while the plan is read
+        QtCore.QCoreApplication.processEvents(QtCore.QEventLoop.ExcludeUserInputEvents)
+
     @pyqtSlot(str, result=bool)
     def readFromJson(self, fname):
-        """ Constructor from json file of SequenceItems """
-        with open(fname, 'r') as f:
-            d = json.load(f)
-
+        """ Constructor from a plan file: json (streamed, see planio.load_json()) or binary (planio.load_binary()) """
         try:
-            seqitems = []
-            for itemdict in d['SequenceList']:
-                seqitems.append(SequenceItem(**itemdict, parent=self))
+            store = planio.load(fname, progress=self._loadProgress)
         except Exception as e:
             logger.exception('Error in {}.readFromJson(): failed to read SequenceList from file "{}"'.format(self, fname))
             return False
 
+        self.loadStore(store, loaded=True)
+        for row, msg in self.constraintViolations() + coercion_warnings(store):
+            logger.warning('"{}" segment #{:d}: {!s}'.format(fname, row+1, msg))
+        return True
+
+    def loadStore(self, store, loaded=False):
+        """ replace all rows with those of a SequenceStore (one model reset)
+
+        Args:
+            loaded (bool): store holds a plan file as read, so the plan is unmodified (planEdited reports 'load')
+        """
         self.beginResetModel()
-        self._items = seqitems
+        self._dropProxies()
+        self._store = store
+        self._json_fragments = {}
+        self._fetched = min(len(store), self.fetch_batch)
+        self._timeline = None
+        self._proposed_order = None
+        self._revision += 1
+        if loaded:
+            self._saved_revision = self._revision
         self.endResetModel();
-        self.sizeChanged.emit(self.rowCount())
-        return True
+        self.sizeChanged.emit(len(self))
+        self.timelineChanged.emit()
+        self.planEdited.emit('load' if loaded else 'reset', 0, 0)
+
+    # every change of the plan: op ('set', 'insert', 'remove', 'move', 'reset' or 'load' of a plan file), row,
+    # and the number of rows inserted/removed or the destination row of a move
+    planEdited = pyqtSignal(str, int, int)
+
+    @pyqtSlot(result=bool)
+    def isModified(self):
+        """ True if the plan changed since it was last loaded or saved """
+        return self._revision != self._saved_revision
 
     @pyqtSlot(str, result=bool)
     def writeToJson(self, fname: str):
-        """ write all member vars to json for later recall """
-        try:
-            memlist = []
-            for mem in self._items:
-                memlist.append(mem.packDict())
+        """ write all member vars to json for later recall; only rows edited since the last save are encoded """
+        return self._write(lambda store, fname: planio.save_json(store, fname, self._json_fragments), fname)
+
+    @pyqtSlot(str, result=bool)
+    def writeToBinary(self, fname: str):
+        """ write all member vars to a binary plan file (see planio), which readFromJson() opens without parsing """
+        return self._write(planio.save_binary, fname)
 
-            # wrap with header
-            d = {'metadata': {'generated_on': datetime.now().strftime(datetimefmt)},
-                 'SequenceList': memlist }
+    def _write(self, save, fname):
+        try:
+            save(self._store, fname)
+        except Exception as e:
+            logger.exception(e)
+            return False
+        self._saved_revision = self._revision
+        self._markSaved()
+        return True
 
-            #  js = json_serializer.to_json(d)
-            js = json.dumps(d, indent=2, separators=(',', ':'), sort_keys=True)
+    def _markSaved(self):
+        """ clear is_unsaved of the dirty rows, with a single dataChanged over the range they span """
+        dirty = np.flatnonzero(self._store.unsaved)
+        if not len(dirty):
+            return
+        self._store.unsaved[dirty] = False
+        if self._proxies:
+            for row in dirty.tolist():
+                self._syncProxy(row)
+        first, last = int(dirty[0]), min(int(dirty[-1]), self._fetched-1)
+        if first <= last:
+            self.dataChanged.emit(self.createIndex(first, 0), self.createIndex(last, 0),
+                                  [SequenceUserRoles.is_unsaved.value])
+
+    def constraintViolations(self):
+        """ check the leaflet positions of all items against the firmware's travel and collision limits
+
+        Returns:
+            list of (row, message) for every violation
+        """
+        rows = np.flatnonzero(self._store.regularPositions())
+        if not len(rows):
+            return []
+        positions = self._store.positions[rows]
+        return [(int(rows[v.row]), constraints.describe(v)) for v in constraints.check_plan(positions)]
 
-            with open(fname, 'w') as f:
-                f.write(js)
+    def compileProgram(self, nleaflets=hwmodel.NLEAFLETS):
+        """ validate all items and compile them into an immutable DeliveryProgram for the TreatmentManager
 
-            for idx, mem in enumerate(self._items):
-                mem.setUnmodified()
-                self.redrawItemDelegate(idx)
+        Raises:
+            program.ProgramError listing every item that cannot be delivered
+        """
+        return compile_program(self._store, nleaflets, motion=self.motion_model)
+
+    def _timelineRows(self, first=0, stop=None):
+        """ (leaflet extensions, beam-on seconds) of rows first..stop-1 for the PlanTimeline; undeliverable
+        rows count as skipped """
+        store = self._store
+        rows = np.s_[first:stop]
+        regular = store.regularPositions(first, stop)
+        positions = np.where(regular[:, None], store.positions[rows], 0).astype(np.float64)
+        dwell_s = store.timecode_ms[rows]*0.001
+        dwell_s = np.where(regular & np.isfinite(dwell_s), dwell_s, 0.0)
+        return positions, dwell_s
+
+    def timeline(self):
+        """ PlanTimeline estimating the delivery time of every item with motion_model """
+        if self._timeline is None:
+            self._timeline = PlanTimeline(self.motion_model, *self._timelineRows())
+        return self._timeline
+
+    def setMotionModel(self, motion_model):
+        self.motion_model = motion_model
+        self._timeline = None
+        self.timelineChanged.emit()
+
+    @pyqtSlot(list)
+    def calibrateMotionModel(self, samples):
+        """ fit motion_model to recorded moves (see MotionModel.calibrate()) and update the timeline """
+        # fit a copy and replace motion_model: the DeliveryProgram of a running treatment holds the current one
+        motion_model = copy.copy(self.motion_model)
+        rms = motion_model.calibrate(samples)
+        if rms is not None:
+            self.setMotionModel(motion_model)
+        return rms
+
+    timelineChanged = pyqtSignal()
+    @pyqtProperty(float, notify=timelineChanged)
+    def estimatedDuration(self):
+        """ estimated time (s) to deliver the whole plan, leaflet travel included """
+        return self.timeline().total()
+
+    @pyqtSlot(int, result=float)
+    def estimatedSegmentTime(self, row: int):
+        """ estimated travel plus beam-on time (s) of the item at row """
+        return float(self.timeline().segmentTimes()[row])
+
+    @pyqtSlot(int, result=float)
+    def estimatedElapsedTime(self, row: int):
+        """ estimated time (s) from treatment start until the item at row is finished """
+        return float(self.timeline().cumulativeTimes()[row])
+
+    def planOrder(self, first=0, last=None, pinned_types=(SequenceItemType.Manual,), time_limit=None):
+        """ reorder items first..last (inclusive) to minimize leaflet travel; items of pinned_types, and
+        items that cannot be delivered, keep their index
+
+        Returns:
+            (order, predicted seconds saved): order is a permutation of all rows for applyOrder()
+        """
+        n = len(self._store)
+        last = n-1 if last is None or last < 0 else min(last, n-1)
+        positions, dwell = self._timelineRows()
+        pinned = np.ones(n, dtype=bool)
+        rows = np.s_[max(first, 0):last+1]
+        pinned[rows] = ~(dwell[rows] > 0) | np.isin(self._store.type[rows], [t.value for t in pinned_types])
+        if n == 0 or pinned.all():
+            return np.arange(n), 0.0
+        order = optimize_order(self.motion_model, self.motion_model.to_steps(positions), pinned, time_limit=time_limit)
+        before = self.timeline().total()
+        after = PlanTimeline(self.motion_model, positions[order], dwell[order]).total()
+        if after >= before:
+            return np.arange(n), 0.0
+        return order, before-after
+
+    def applyOrder(self, order):
+        """ rearrange items so that item order[k] ends up at row k (one model reset) """
+        if sorted(order) != list(range(len(self._store))):
+            raise ValueError('order must be a permutation of all {:d} rows'.format(len(self._store)))
+        self.beginResetModel()
+        self._store.permute(order)
+        self._timeline = None
+        self._proposed_order = None
+        self._revision += 1
+        self.endResetModel()
+        self.timelineChanged.emit()
+        self.planEdited.emit('reset', 0, 0)
+
+    @pyqtSlot(result=float)
+    @pyqtSlot(int, int, result=float)
+    def proposeOrder(self, first=0, last=-1):
+        """ compute a travel-minimizing order (see planOrder()) to apply with applyProposedOrder()
+
+        Returns:
+            predicted time saved (s)
+        """
+        order, saved = self.planOrder(first, last)
+        self._proposed_order = (order, self._revision) if saved > 0 else None
+        return float(saved)
 
-        except Exception as e:
-            logger.exception(e)
+    @pyqtSlot(result=bool)
+    def applyProposedOrder(self):
+        if self._proposed_order is None:
             return False
+        order, revision = self._proposed_order
+        if revision != self._revision:
+            logger.warning('plan changed since the reorder was proposed; not applying it')
+            self._proposed_order = None
+            return False
+        self.applyOrder(order.tolist())
         return True
 
+    @pyqtSlot(result=int)
+    def mergeStationary(self):
+        """ collapse runs of consecutive items with identical leaflet positions into the first item of each
+        run, which gets the summed beam-on time (the other items' gantry/couch annotations are dropped); runs
+        do not extend across skipped items or items of a different type
+
+        Returns:
+            number of items removed
+        """
+        store = self._store
+        n = len(store)
+        positions, dwell = self._timelineRows()
+        delivered = dwell > 0
+        merge = np.zeros(n, dtype=bool)
+        merge[1:] = delivered[1:] & delivered[:-1] & (store.type[1:] == store.type[:-1]) \
+                    & (positions[1:] == positions[:-1]).all(axis=1)
+        removed = int(merge.sum())
+        if not removed:
+            return 0
+        run = np.cumsum(~merge)-1
+        heads = np.flatnonzero(~merge)
+        totals = np.bincount(run, weights=np.where(delivered, store.timecode_ms, 0.0))
+        sizes = np.bincount(run)
+        self.beginResetModel()
+        for r in np.flatnonzero(sizes > 1):
+            total_ms = float(totals[r])
+            store.set(int(heads[r]), 'timecode_ms', int(total_ms) if total_ms.is_integer() else total_ms)
+        store.permute(heads)
+        self._fetched = min(self._fetched, len(store))
+        self._timeline = None
+        self._proposed_order = None
+        self._revision += 1
+        self.endResetModel()
+        self._syncProxies()
+        self.sizeChanged.emit(len(self))
+        self.timelineChanged.emit()
+        self.planEdited.emit('reset', 0, 0)
+        logger.info('merged {:d} segments into the segments with identical leaflet positions before them'.format(removed))
+        return removed
+
     def redrawItemDelegate(self, idx):
         try:
             if isinstance(idx, int):
+                if idx >= self._fetched:
+                    return
                 modelindex = self.createIndex(idx, 0)
             else:
                 modelindex = idx
@@ -244,7 +468,7 @@ class SequenceListModel(QtCore.QAbstractListModel):
 
     ## METHODS
     def __len__(self):
-        return len(self._items)
+        return len(self._store)
 
     # Virtual Base Method
     sizeChanged = pyqtSignal([int])
@@ -254,15 +478,93 @@ class SequenceListModel(QtCore.QAbstractListModel):
 
     @pyqtSlot(result=int)
     def rowCount(self, parent=QtCore.QModelIndex()):
-        return self.__len__()
+        """ rows fetched by the view so far (see fetchMore()); len() is the size of the plan """
+        return self._fetched
 
+    # Virtual Base Method
+    @pyqtSlot(result=bool)
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return self._fetched < len(self._store)
+
+    # Virtual Base Method
+    @pyqtSlot()
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        """ hand the next fetch_batch rows to the view """
+        count = min(self.fetch_batch, len(self._store)-self._fetched)
+        if count <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self._fetched, self._fetched+count-1)
+        self._fetched += count
+        self.endInsertRows()
+
+    @pyqtSlot(int)
+    def fetchThrough(self, row: int):
+        """ hand rows to the view until row is among them (e.g. before selecting it) """
+        stop = min(row+1, len(self._store))
+        if stop <= self._fetched:
+            return
+        # whole batches, so that the view fetches in the same steps as when it is scrolled
+        stop = min(self._fetched + -(-(stop-self._fetched)//self.fetch_batch)*self.fetch_batch, len(self._store))
+        self.beginInsertRows(QtCore.QModelIndex(), self._fetched, stop-1)
+        self._fetched = stop
+        self.endInsertRows()
 
     @pyqtSlot(int, result=SequenceItem)
     def getItem(self, index: int):
-        """ Returns QObject """
-        if index >= self.rowCount():
+        """ Returns QObject proxy of the row; valid until it is evicted from the proxy cache """
+        if not 0 <= index < len(self):
             return None
-        return self._items[index]
+        rowid = int(self._store.ids[index])
+        proxy = self._proxies.get(rowid)
+        if proxy is not None:
+            self._proxies.move_to_end(rowid)
+            return proxy
+        proxy = SequenceItem(parent=self, **{k: self._store.get(index, k) for k in PERSISTENT_MEMBERS})
+        proxy._members['is_unsaved'].value = self._store.get(index, 'is_unsaved')
+        proxy.onMemberDataChanged.connect(lambda rowid=rowid: self._proxyChanged(rowid))
+        self._proxies[rowid] = proxy
+        while len(self._proxies) > self.proxy_cache_size:
+            self._dropProxy(next(iter(self._proxies)))
+        return proxy
+
+    def _proxyChanged(self, rowid):
+        """ write edits made through a proxy from getItem() back to its row """
+        proxy = self._proxies.get(rowid)
+        row = self._store.rowOf(rowid)
+        if self._syncing or proxy is None or row is None:
+            return
+        self.setData(row, {k: m.value for k, m in proxy._members.items() if not m.volatile})
+
+    def _syncProxy(self, row):
+        """ update the proxy of row (if any) after the row was changed through the model """
+        proxy = self._proxies.get(int(self._store.ids[row]))
+        if proxy is None:
+            return
+        self._syncing = True
+        try:
+            for k in MEMBERS:
+                proxy._members[k].value = self._store.get(row, k)
+            proxy.onMemberDataChanged.emit()
+        finally:
+            self._syncing = False
+
+    def _syncProxies(self):
+        """ update all proxies after bulk changes, dropping those whose rows were removed """
+        for rowid in list(self._proxies):
+            row = self._store.rowOf(rowid)
+            if row is None:
+                self._dropProxy(rowid)
+            else:
+                self._syncProxy(row)
+
+    def _dropProxy(self, rowid):
+        proxy = self._proxies.pop(rowid)
+        proxy.onMemberDataChanged.disconnect()
+        proxy.deleteLater()
+
+    def _dropProxies(self):
+        for rowid in list(self._proxies):
+            self._dropProxy(rowid)
 
     # Virtual Base Method
     @pyqtSlot(QtCore.QModelIndex, int, result=QtCore.QVariant)
@@ -283,14 +585,12 @@ class SequenceListModel(QtCore.QAbstractListModel):
         elif isinstance(role, int):
             rolename = roleInt2Name(role)
 
-        if index.row() > self.rowCount(): return False
+        if index.row() >= len(self): return False
         if role == Qt.DisplayRole or role == Qt.EditRole:
-            return self._items[index.row()].get()
+            return QtCore.QVariant(self._store.rowDict(index.row()))
         if Qt.UserRole <= role < Qt.UserRole+len(SequenceUserRoles.__members__):
             logger.debug2('accessing delegate data role: {}:{}'.format(role, rolename))
-            sequenceitem = self._items[index.row()]
-            val = sequenceitem._members[rolename].basicvalue
-            return val
+            return self._store.getBasic(index.row(), rolename)
         return None
 
     # Virtual Base Method
@@ -311,59 +611,102 @@ class SequenceListModel(QtCore.QAbstractListModel):
     def insertRows(self, row: int=-1, count: int=1, parent=QtCore.QModelIndex()):
         """ insert default constructed objects at row """
         if count < 1: return False
-        if self.rowCount() <= 0:
+        if len(self) <= 0:
             row = 0
-        elif row < 0:
+        elif row < 0 or row > len(self):
             # add to end of list
-            row = self.rowCount()
-        self.beginInsertRows(parent, row, row+count-1)
-        for i in range(count):
-            self._items.insert(row+i, SequenceItem(parent=self, type=SequenceItemType.Manual))
-        self.endInsertRows()
-        self.sizeChanged.emit(self.rowCount())
+            row = len(self)
+        # rows past those fetched by the view are only shown once it fetches them
+        visible = row <= self._fetched
+        if visible:
+            self.beginInsertRows(parent, row, row+count-1)
+        self._store.insert(row, [{'type': SequenceItemType.Manual} for i in range(count)])
+        if self._timeline is not None:
+            self._timeline.insert(row, *self._timelineRows(row, row+count))
+        self._revision += 1
+        if visible:
+            self._fetched += count
+            self.endInsertRows()
+        self.sizeChanged.emit(len(self))
+        self.timelineChanged.emit()
+        self.planEdited.emit('insert', row, count)
         return True
 
     # Virtual Base Method
     @pyqtSlot(int, int, result=bool)
     def removeRows(self, row: int, count: int, parent=QtCore.QModelIndex()):
         """ remove a number of rows from model """
-        if self.rowCount() <= 0 or row < 0 or count < 1:
+        if len(self) <= 0 or row < 0 or count < 1 or row >= len(self):
             return False
-        self.beginRemoveRows(QtCore.QModelIndex(), row, row+count-1)
-        del self._items[row:row+count]
-        self.endRemoveRows()
-        if self.rowCount() <=0:
+        count = min(count, len(self)-row)
+        visible = min(row+count, self._fetched) - row
+        if visible > 0:
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row+visible-1)
+        for rowid in self._store.ids[row:row+count].tolist():
+            if rowid in self._proxies:
+                self._dropProxy(rowid)
+        self._store.remove(row, count)
+        if self._timeline is not None:
+            self._timeline.remove(row, count)
+        self._revision += 1
+        if visible > 0:
+            self._fetched -= visible
+            self.endRemoveRows()
+        if len(self) <=0:
             self.beginResetModel()
             self.endResetModel();
-        self.sizeChanged.emit(self.rowCount())
+        self.sizeChanged.emit(len(self))
+        self.timelineChanged.emit()
+        self.planEdited.emit('remove', row, count)
         return True
 
     @pyqtSlot()
     def clear(self):
-        self.removeRows(0, self.rowCount())
+        self.removeRows(0, len(self))
 
     # Virtual Base Method
     @pyqtSlot(int, int, int, result=bool)
     def moveRows(self, sourceRow: int, count: int, destinationChild: int):
         """ Move sourceRow->sourceRow+count to destinationChild and trigger view refresh """
-        if (sourceRow < 0 or self.rowCount() <= sourceRow) \
-        or (destinationChild < 0 or self.rowCount() <= destinationChild):
+        if (sourceRow < 0 or len(self) <= sourceRow) \
+        or (destinationChild < 0 or len(self) <= destinationChild):
             return False
         if count > 1:
             raise NotImplementedError('{} is not yet implemented for count > 1'.format(__name__))
 
-        # see http://doc.qt.io/qt-5/qabstractitemmodel.html#beginMoveRows for explanation
-        if (destinationChild < sourceRow):
-            destIndex = destinationChild
-        elif (sourceRow<=destinationChild<=(sourceRow+count-1)):
-            destIndex = destinationChild-(sourceRow+count-1)-1+sourceRow
-        else:
-            destIndex = destinationChild+1
-        self.beginMoveRows(QtCore.QModelIndex(), sourceRow, sourceRow+count-1, QtCore.QModelIndex(), destIndex)
+        # the view only knows the rows fetched so far: a row moved out of (into) them is removed from
+        # (inserted into) the view, and a move among rows it has not fetched is not shown at all
+        src_visible = sourceRow < self._fetched
+        dst_visible = destinationChild < self._fetched
+        if src_visible and dst_visible:
+            # see http://doc.qt.io/qt-5/qabstractitemmodel.html#beginMoveRows for explanation
+            if (destinationChild < sourceRow):
+                destIndex = destinationChild
+            elif (sourceRow<=destinationChild<=(sourceRow+count-1)):
+                destIndex = destinationChild-(sourceRow+count-1)-1+sourceRow
+            else:
+                destIndex = destinationChild+1
+            self.beginMoveRows(QtCore.QModelIndex(), sourceRow, sourceRow+count-1, QtCore.QModelIndex(), destIndex)
+        elif src_visible:
+            self.beginRemoveRows(QtCore.QModelIndex(), sourceRow, sourceRow+count-1)
+        elif dst_visible:
+            self.beginInsertRows(QtCore.QModelIndex(), destinationChild, destinationChild+count-1)
         for i in range(count):
-            self._items.insert(destinationChild, self._items.pop(sourceRow+i))
+            self._store.move(sourceRow+i, destinationChild)
+            if self._timeline is not None:
+                self._timeline.move(sourceRow+i, destinationChild)
             logger.debug2('moving from {} to {}'.format(sourceRow, destinationChild))
-        self.endMoveRows()
+        self._revision += 1
+        if src_visible and dst_visible:
+            self.endMoveRows()
+        elif src_visible:
+            self._fetched -= count
+            self.endRemoveRows()
+        elif dst_visible:
+            self._fetched += count
+            self.endInsertRows()
+        self.timelineChanged.emit()
+        self.planEdited.emit('move', sourceRow, destinationChild)
         return True
 
     # Virtual Base Method
@@ -388,17 +731,22 @@ class SequenceListModel(QtCore.QAbstractListModel):
 
         logger.debug2("setting data at row {} to {} using role {}: {}".format(index.row(), value, role, rolename))
 
+        row = index.row()
         if role == Qt.EditRole and isinstance(value, SequenceItem):
-            self._items[index.row()] = value
-            self.dataChanged.emit(index, index)
-        elif isinstance(value, dict):
-            for k, v in value.items():
-                self._items[index.row()][k] = v
-        elif Qt.UserRole <= role < Qt.UserRole+len(SequenceUserRoles.__members__):
-            self._items[index.row()][rolename] = value
-        else:
-            return False
+            value = {k: m.value for k, m in value._members.items() if not m.volatile}
+        elif not isinstance(value, dict):
+            if not Qt.UserRole <= role < Qt.UserRole+len(SequenceUserRoles.__members__):
+                return False
+            value = {rolename: value}
+        for k, v in value.items():
+            self._store.set(row, k, v)
+        if self._timeline is not None:
+            self._timeline.update(row, *(x[0] for x in self._timelineRows(row, row+1)))
+        self._revision += 1
+        self._syncProxy(row)
         self.redrawItemDelegate(index)
+        self.timelineChanged.emit()
+        self.planEdited.emit('set', row, 0)
         return True
 
     # Virtual Base Method
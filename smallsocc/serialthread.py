@@ -1,11 +1,25 @@
+import os
 import logging
 import time
+import select
+import selectors
+from collections import deque
 import serial
-from serial.tools import list_ports
+from serial.tools import list_ports, list_ports_common
 from PyQt5.QtCore import QThread, QMutex, pyqtSignal, pyqtSlot, QWaitCondition
 
+import hwmodel
+from emulator import EmulatedDevice
+from outbound import OutboundQueue, SerialWriterThread
+from devwatch import DeviceWatcher
+from telemetry import SerialTelemetry
+
 logger = logging.getLogger(__name__)
 
+READ_CHUNK = 65536 # max bytes drained from the port per wakeup
+RECONNECT_BACKOFF_MIN = 0.05 # seconds between reconnect attempts while no device is present...
+RECONNECT_BACKOFF_MAX = 2.0  # ...doubling up to this limit
+
 def device_info(portinfo):
     return "deviceid=\"{}:{}\" on port=\"{!s}\" :: {} {} ({})".format(
         portinfo.vid, portinfo.pid, portinfo.name, portinfo.manufacturer, portinfo.product, portinfo.description
@@ -23,10 +37,15 @@ class SerialThread(QThread):
     the gui interface
     The protocol handles serial signals once the connection has been made
     """
-    _wait_connection_made  = QWaitCondition()
+    sigReconnected = pyqtSignal([float]) # reconnect latency in seconds
+
+    def __init__(self, protocol_factory, HID=None, BAUD=None, PORT=None, emulator_batch=0):
+        """ Initialize thread
 
-    def __init__(self, protocol_factory, HID=None, BAUD=None):
-        """ Initialize thread """
+        Args:
+            PORT (str): open this serial port path directly instead of discovering devices
+            emulator_batch (int): batch_size of the EmulatedDevice used in EMULATOR_MODE
+        """
         super(SerialThread, self).__init__()
         self.daemon = True
         self.serial = None
@@ -34,15 +53,32 @@ class SerialThread(QThread):
         self.alive = True
         self._lock = QMutex()
         self._lock_connection = QMutex()
+        self._wait_connection_made = QWaitCondition()
         self.protocol = None
         self.USB_HID = HID
+        self.PORT = PORT
         self.BAUD = BAUD if BAUD else 115200
+        # self-pipe used to wake the reader from select() on stop()
+        self._cancel_r, self._cancel_w = os.pipe() if os.name == 'posix' else (None, None)
         self.EMULATOR_MODE = False
+        self.emulator = None
+        self.emulator_batch = emulator_batch
         self.initialized = False
+        # frames are written from a dedicated thread so that callers never block on the port
+        self.telemetry = SerialTelemetry()
+        self.outbound = OutboundQueue(expects_reply=hwmodel.expects_reply)
+        self._writer = SerialWriterThread(self.outbound, self._write_now)
+        # reconnect state
+        self._last_device = None # ListPortInfo of the last successfully opened device
+        self._devwatch = None
+        self._t_disconnected = None
+        self.reconnect_latencies = deque(maxlen=100) # seconds from connection loss to reconnection
 
-        self.start()
         self._lock_connection.lock()
-        self._wait_connection_made.wait(self._lock_connection)
+        self.start()
+        # the reader may finish connecting before we get here; wait on the flag, not just the wakeup
+        while not self.initialized:
+            self._wait_connection_made.wait(self._lock_connection)
         self._lock_connection.unlock()
 
     def _activate_emulator_mode(self):
@@ -50,17 +86,60 @@ class SerialThread(QThread):
         try: self.serial.close()
         except: pass
         self.serial = None
+        self.emulator = EmulatedDevice(self.protocol, batch_size=self.emulator_batch)
         logger.warning('EMULATOR MODE ACTIVATED')
 
     def _deactivate_emulator_mode(self):
         self.EMULATOR_MODE = False
+        if self.emulator:
+            self.emulator.stop()
+            self.emulator = None
         logger.warning('EMULATOR MODE DEACTIVATED')
 
+    def _last_device_ports(self):
+        """candidate ports for the last good device: its old path, if still present, without re-enumerating"""
+        dev = self._last_device
+        if dev is not None and os.path.exists(dev.device):
+            return [dev]
+        return []
+
+    def _prefer_last_device(self, portlist):
+        """order ports so that ones matching the last good device's VID/PID/serial number come first"""
+        dev = self._last_device
+        if dev is None or dev.vid is None:
+            return portlist
+        same = lambda p: (p.vid, p.pid, p.serial_number) == (dev.vid, dev.pid, dev.serial_number)
+        return sorted(portlist, key=lambda p: not same(p))
+
+    def _open_first(self, portlist):
+        """open the first port in portlist that accepts a connection"""
+        for p in portlist:
+            PORT = p.device
+            try:
+                # reads block (in select() or in the driver) rather than polling
+                # exclusive: with several devices, each port must end up with exactly one SerialThread
+                self.serial = serial.Serial(PORT, self.BAUD, timeout=None, writeTimeout=0, exclusive=True)
+                logger.info("Connected to serial device ({!s})".format(device_info(p)))
+                self._last_device = p
+                if not hasattr(self.serial, 'cancel_read'):
+                    self.serial.timeout = 1
+                return True
+            except serial.serialutil.SerialException:
+                continue
+        return False
+
     def _init_hw(self):
         """Search for available serial devices"""
+        # retry the last good device first, without re-enumerating all ports
+        if self._open_first(self._last_device_ports()):
+            return
+
         portlist = []
+        if self.PORT:
+            portlist.append(list_ports_common.ListPortInfo(self.PORT))
+
         # try to exactly match by HID
-        if self.USB_HID:
+        elif self.USB_HID:
             match = list_ports.grep(self.USB_HID)
             try: portlist.append(next(match))
             except StopIteration:
@@ -74,17 +153,9 @@ class SerialThread(QThread):
                 # TODO: this may be an imperfect check for a valid device
                 if p.vid is None:
                     portlist.remove(p)
+            portlist = self._prefer_last_device(portlist)
 
-        for p in portlist:
-            PORT = p.device
-            try:
-                self.serial = serial.Serial(PORT, self.BAUD, timeout=0, writeTimeout=0)
-                logger.info("Connected to serial device ({!s})".format(device_info(p)))
-                if not hasattr(self.serial, 'cancel_read'):
-                    self.serial.timeout = 1
-                break
-            except serial.serialutil.SerialException:
-                continue
+        self._open_first(portlist)
 
         if self.serial is None:
             if not portlist:
@@ -96,20 +167,46 @@ class SerialThread(QThread):
                 self._activate_emulator_mode()
 
 
+    def _wait_for_device(self, timeout):
+        """sleep until a device node appears in /dev, stop() is called or timeout (seconds) elapses"""
+        if self._devwatch is None:
+            self._devwatch = DeviceWatcher.create()
+        fds = [fd for fd in (self._cancel_r, self._devwatch and self._devwatch.fileno()) if fd is not None]
+        if not fds:
+            time.sleep(timeout)
+            return
+        ready, _, _ = select.select(fds, [], [], timeout)
+        if self._devwatch and self._devwatch.fileno() in ready:
+            self._devwatch.drain()
+
     def _ensure_serial_connection(self):
         logger.warning("Attempting to connect to hardware...")
-        while not self.serial or not (self.serial.writable() and self.serial.readable()) :
+        backoff = RECONNECT_BACKOFF_MIN
+        while self.alive and (not self.serial or not (self.serial.writable() and self.serial.readable())):
             self._init_hw()
             if self.serial:
                 logger.warning("Hardware connection successful")
+                if self._t_disconnected is not None:
+                    latency = time.monotonic() - self._t_disconnected
+                    self._t_disconnected = None
+                    self.reconnect_latencies.append(latency)
+                    self.telemetry.reconnected(latency)
+                    logger.warning("Reconnected after {:.0f}ms".format(latency*1000))
+                    self.sigReconnected.emit(latency)
                 self._wait_connection_made.wakeAll()
                 break
-            time.sleep(1)
+            # retry as soon as a device node shows up, backing off while nothing changes
+            self._wait_for_device(backoff)
+            backoff = min(2*backoff, RECONNECT_BACKOFF_MAX)
 
     def stop(self):
         """Stop the reader thread"""
         self.alive = False
-        if self.serial and hasattr(self.serial, 'cancel_read'):
+        if self.emulator:
+            self.emulator.stop()
+        if self._cancel_w is not None:
+            os.write(self._cancel_w, b'\x00')
+        elif self.serial and hasattr(self.serial, 'cancel_read'):
             try:
                 self.serial.cancel_read()
             except Exception as e:
@@ -118,57 +215,130 @@ class SerialThread(QThread):
     def run(self):
         """threaded serial loop"""
         self.protocol = self.protocol_factory()
+        if hasattr(self.protocol, 'telemetry'):
+            self.protocol.telemetry = self.telemetry
+        # the HW response to a move opens the gate for the next coalesced position frame
+        if hasattr(self.protocol, 'outbound'):
+            self.protocol.outbound = self.outbound
+        self._writer.start()
         self._init_hw()
+        self._lock_connection.lock()
         self.initialized = True
         self._wait_connection_made.wakeAll()
+        self._lock_connection.unlock()
 
         while self.alive: # lifetime of thread
             if self.EMULATOR_MODE:
+                # blocks (sleeping while idle) until stop() is called
+                self.emulator.serve()
                 continue
 
             # Check if serial connection is active and restart if not (blocking)
             self._ensure_serial_connection()
 
-            # Read Loop
-            while self.alive and self.serial and self.serial.readable():
-                self._lock.lock()
+            self._read_loop()
+
+    def _read_select(self, selector):
+        """block in the kernel until the port or the cancel pipe is readable, then drain the port"""
+        for key, events in selector.select():
+            if key.fd == self._cancel_r:
+                os.read(self._cancel_r, 512)
+                return b''
+        data = os.read(self.serial.fileno(), READ_CHUNK)
+        if not data:
+            raise serial.SerialException('device reports readiness to read but returned no data (device disconnected?)')
+        return data
+
+    def _read_blocking(self, selector=None):
+        """fallback for platforms without selectable ports: blocking driver read, interrupted by cancel_read()"""
+        return self.serial.read(self.serial.in_waiting or 1)
+
+    def _read_loop(self):
+        """dispatch received data to the protocol until the port fails or stop() is called"""
+        selector = None
+        read = self._read_blocking
+        if self._cancel_r is not None and hasattr(self.serial, 'fileno'):
+            selector = selectors.DefaultSelector()
+            selector.register(self.serial.fileno(), selectors.EVENT_READ)
+            selector.register(self._cancel_r, selectors.EVENT_READ)
+            read = self._read_select
+
+        try:
+            # reads do not take self._lock; it only serializes write() against close()
+            while self.alive and self.serial:
                 try:
-                    # read all that is there or wait for one byte (blocking)
-                    data = self.serial.read(self.serial.in_waiting or 1)
-                    if data:
-                        # make a separated try-except for called user code
-                        try:
-                            self.protocol.data_received(data)
-                        except Exception as err:
-                            logger.exception("Error in Protocol.data_received()")
+                    data = read(selector)
                 except Exception as err:
                     # probably some I/O problem such as disconnected USB serial
                     # adapters -> exit
-                    self.protocol.connection_lost(err)
+                    if self.alive:
+                        self._t_disconnected = time.monotonic()
+                        self.outbound.replies_lost()
+                        self.protocol.connection_lost(err)
                     self.serial = None
-                self._lock.unlock()
+                    break
+                if data:
+                    # make a separated try-except for called user code
+                    try:
+                        self.protocol.data_received(data)
+                    except Exception as err:
+                        logger.exception("Error in Protocol.data_received()")
+        finally:
+            if selector:
+                selector.close()
+
 
+    def write(self, data, coalesce=False):
+        """Queue data for the writer thread (never blocks on the port)
 
-    def write(self, data):
+        Args:
+            coalesce (bool): data may be replaced by a later coalescable frame that is queued before it is sent
+
+        Returns:
+            number of the HW reply that answers data (see OutboundQueue.put()), or None
+        """
+        return self.outbound.put(data, coalesce)
+
+    def _write_now(self, data, t_queued=None):
         """Thread safe writing (uses lock)"""
         if self.EMULATOR_MODE:
-            self.protocol.sigRecvdMoveOK.emit()
+            self.emulator.write(data)
+            self.telemetry.frame_written(data, t_queued)
             return
 
         # Check if serial connection is active and error if not
         if not self.serial or not self.serial.writable():
+            if hwmodel.expects_reply(data):
+                self.outbound.release() # the frame is answered by the HWERROR below
             self.protocol.sigRecvdHWError.emit()
         else:
             self._lock.lock()
             self.serial.write(data)
             self._lock.unlock()
+            self.telemetry.frame_written(data, t_queued)
 
     def close(self):
-        """Close the serial port and exit reader thread (uses lock)"""
-        # use the lock to let finish writing/reading
+        """Close the serial port and exit reader and writer threads (uses lock)"""
+        # stop the writer first; it takes the lock for every write
+        self.outbound.close()
+        if QThread.currentThread() is not self._writer:
+            self._writer.wait()
+        # use the lock to let finish writing
         self._lock.lock()
         # first stop reading, so that closing can be done on idle port
         self.stop()
+        if QThread.currentThread() is not self:
+            self.wait()
+            if self._cancel_r is not None:
+                os.close(self._cancel_r)
+                os.close(self._cancel_w)
+                self._cancel_r = self._cancel_w = None
+            if self._devwatch is not None:
+                self._devwatch.close()
+                self._devwatch = None
+        if self.EMULATOR_MODE:
+            self._lock.unlock()
+            return
         try:
             self.serial.close()
         except Exception as e:
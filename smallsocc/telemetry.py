@@ -0,0 +1,206 @@
+""" telemetry.py
+
+Fixed-memory timing statistics for the serial link to the SOC hardware.
+
+SerialTelemetry timestamps every frame as it is written to the port and every signal as it is decoded,
+matching acks to the commands that caused them (the firmware answers commands strictly in order). Round
+trip times, time spent in the outbound queue and time for acks to reach the TreatmentManager are kept
+in log-bucketed histograms so that slow deliveries can be attributed to mechanics, serial transport or
+the host event loop.
+"""
+import csv
+import json
+import math
+import time
+import bisect
+import logging
+from collections import deque
+from PyQt5.QtCore import QObject, QMutex, QVariant, pyqtSlot
+
+import hwmodel
+
+logger = logging.getLogger(__name__)
+
+class LatencyHistogram():
+    """ log-spaced histogram over [min_s, max_s] with buckets_per_decade resolution; memory does not grow
+    with the number of samples """
+
+    def __init__(self, min_s=1e-6, max_s=100.0, buckets_per_decade=20):
+        nbuckets = int(round(math.log10(max_s/min_s)*buckets_per_decade))
+        self.edges = [min_s * 10**(ii/buckets_per_decade) for ii in range(nbuckets+1)]
+        # counts[ii] holds samples in (edges[ii-1], edges[ii]]; counts[-1] those above edges[-1]
+        self.reset()
+
+    def reset(self):
+        self.counts = [0]*(len(self.edges)+1)
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.edges, seconds)] += 1
+        self.n += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min: self.min = seconds
+        if self.max is None or seconds > self.max: self.max = seconds
+
+    def percentile(self, p):
+        """ upper bucket edge below which p percent of the samples fall (clamped to the observed range) """
+        if not self.n:
+            return None
+        target = p/100*self.n
+        cumulative = 0
+        for ii, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= target:
+                edge = self.edges[ii] if ii < len(self.edges) else self.max
+                return min(max(edge, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.n,
+                'mean':  self.total/self.n if self.n else None,
+                'min':   self.min,
+                'p50':   self.percentile(50),
+                'p95':   self.percentile(95),
+                'p99':   self.percentile(99),
+                'max':   self.max}
+
+
+class SerialTelemetry(QObject):
+    """ counters and latency histograms for one serial link; all methods are thread safe """
+    HISTOGRAMS = [
+        'rtt_move',      # PRE_ABSPOS_ALL written -> SIG_MOVE_OK decoded (serial + mechanics)
+        'rtt_calibrate', # PRE_CALIBRATE written -> SIG_MOVE_OK decoded
+        'rtt_batch',     # PRE_ABSPOS_BATCH written -> SIG_MOVE_OK_SEQ decoded for each record
+        'rtt_hwerror',   # any acked command written -> SIG_HWERROR(_SEQ) decoded
+        'queue_wait',    # frame queued by caller -> written to port
+        'ack_dispatch',  # ack decoded on serial thread -> handled by TreatmentManager (host event loop)
+        'reconnect',     # connection lost -> port reopened
+    ]
+    COUNTERS = ['bytes_in', 'bytes_out', 'frames_out', 'signals_in', 'unmatched_signals', 'reconnects']
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._lock = QMutex()
+        self.histograms = {name: LatencyHistogram() for name in self.HISTOGRAMS}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self._pending = deque()   # (histogram name, time written) for commands awaiting an ack, in order
+        self._pending_seq = {}    # batch seq -> time written
+        self.last_ack_time = None # perf_counter() when the most recent ack was decoded
+
+    def _record(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def record(self, name, seconds):
+        """ add a sample to one of the named histograms """
+        self._lock.lock()
+        self._record(name, seconds)
+        self._lock.unlock()
+
+    def frame_written(self, data, t_queued=None):
+        """ called by the serial writer right after data went out on the wire """
+        now = time.perf_counter()
+        self._lock.lock()
+        self.counters['bytes_out'] += len(data)
+        self.counters['frames_out'] += 1
+        if t_queued is not None:
+            self._record('queue_wait', now-t_queued)
+        if data[:2] == hwmodel.MAGIC_BYTES:
+            pre = data[2:3]
+            if pre == hwmodel.PRE_ABSPOS_ALL:
+                self._pending.append(('rtt_move', now))
+            elif pre == hwmodel.PRE_CALIBRATE:
+                self._pending.append(('rtt_calibrate', now))
+            elif pre == hwmodel.PRE_ABSPOS_BATCH and len(data) >= 6:
+                first_seq = int.from_bytes(data[4:6], byteorder='big')
+                for ii in range(data[3]):
+                    self._pending_seq[(first_seq+ii) % hwmodel.SEQ_MODULUS] = now
+            elif pre == hwmodel.PRE_FLUSH_BATCH:
+                self._pending_seq.clear()
+        self._lock.unlock()
+
+    def bytes_received(self, nbytes):
+        self._lock.lock()
+        self.counters['bytes_in'] += nbytes
+        self._lock.unlock()
+
+    def signal_received(self, sig, seq=None):
+        """ called by the protocol for every decoded SIG_* signal """
+        now = time.perf_counter()
+        self._lock.lock()
+        self.counters['signals_in'] += 1
+        self.last_ack_time = now
+        t_sent = None
+        if seq is not None:
+            t_sent = self._pending_seq.pop(seq, None)
+            name = 'rtt_batch'
+            if sig == hwmodel.SIG_HWERROR_SEQ:
+                name = 'rtt_hwerror'
+                self._pending_seq.clear()
+        elif self._pending:
+            name, t_sent = self._pending.popleft()
+            if sig == hwmodel.SIG_HWERROR:
+                name = 'rtt_hwerror'
+        if t_sent is None:
+            self.counters['unmatched_signals'] += 1
+        else:
+            self._record(name, now-t_sent)
+        self._lock.unlock()
+
+    def connection_lost(self):
+        """ commands in flight will never be acked """
+        self._lock.lock()
+        self._pending.clear()
+        self._pending_seq.clear()
+        self._lock.unlock()
+
+    def reconnected(self, latency):
+        self._lock.lock()
+        self.counters['reconnects'] += 1
+        self._record('reconnect', latency)
+        self._lock.unlock()
+
+    @pyqtSlot()
+    def reset(self):
+        self._lock.lock()
+        for hist in self.histograms.values():
+            hist.reset()
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self._lock.unlock()
+
+    def snapshot(self):
+        """ dict of all counters and histogram summaries (times in seconds) """
+        self._lock.lock()
+        d = {'counters': dict(self.counters),
+             'histograms': {name: hist.summary() for name, hist in self.histograms.items()}}
+        self._lock.unlock()
+        return d
+
+    @pyqtSlot(result=QVariant)
+    def summary(self):
+        """ snapshot() for QML """
+        return QVariant(self.snapshot())
+
+    @pyqtSlot(str, result=bool)
+    def dump(self, fname):
+        """ write snapshot() to fname as csv (if it ends with .csv) or json """
+        d = self.snapshot()
+        d['generated_on'] = time.strftime('%Y %b %d %H:%M:%S')
+        try:
+            with open(fname, 'w', newline='') as f:
+                if fname.lower().endswith('.csv'):
+                    fields = ['name', 'count', 'mean', 'min', 'p50', 'p95', 'p99', 'max']
+                    writer = csv.DictWriter(f, fieldnames=fields)
+                    writer.writeheader()
+                    for name, summary in d['histograms'].items():
+                        writer.writerow(dict(summary, name=name))
+                    for name, value in d['counters'].items():
+                        writer.writerow({'name': name, 'count': value})
+                else:
+                    json.dump(d, f, indent=2, sort_keys=True)
+        except Exception:
+            logger.exception('failed to write telemetry to "{}"'.format(fname))
+            return False
+        return True
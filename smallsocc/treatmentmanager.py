@@ -1,9 +1,13 @@
 import time
 import logging
-from PyQt5.QtCore import QThread, QMutex, QWaitCondition, \
-                         QObject, pyqtSignal, pyqtSlot, pyqtProperty, QCoreApplication
-import sequence
+from collections import deque
+from PyQt5.QtCore import Qt, QThread, QMutex, QWaitCondition, QTimer, \
+                         QObject, QVariant, pyqtSignal, pyqtSlot, pyqtProperty
+from program import ProgramError
 from hardware import HWSOC
+from scheduler import DeadlineTimer, timing_record, summarize_timing
+import journal
+import hwmodel
 
 logger = logging.getLogger(__name__)
 
@@ -15,13 +19,15 @@ class TreatmentManagerProxy(QObject):
     onTreatmentCompleted = pyqtSignal(int)
     onTreatmentAdvance   = pyqtSignal(int)
     onTreatmentSkip      = pyqtSignal(int, float)
+    onTimingReport       = pyqtSignal(list)
 
     # cross-thread control via signals
     startTreatment   = pyqtSignal([int])
+    resumeTreatment  = pyqtSignal(int, float)
     stopTreatment    = pyqtSignal()
     restartTreatment = pyqtSignal()
     abortTreatment   = pyqtSignal()
-    setHWOK          = pyqtSignal()
+    setHWOK          = pyqtSignal([int])
 
     onStepsChanged = pyqtSignal([int])
     @pyqtProperty(int, notify=onStepsChanged)
@@ -34,6 +40,7 @@ class TreatmentManagerProxy(QObject):
         self.tm = tm
         # tie signals together to mediate connection between QML and separate threaded worker (TreatmentManager)
         self.startTreatment.connect(tm.startTreatment)
+        self.resumeTreatment.connect(tm.resumeTreatment)
         self.stopTreatment.connect(tm.stopTreatment)
         self.restartTreatment.connect(tm.restartTreatment)
         self.abortTreatment.connect(tm.abortTreatment)
@@ -44,17 +51,67 @@ class TreatmentManagerProxy(QObject):
         tm.onTreatmentCompleted.connect(self.onTreatmentCompleted)
         tm.onTreatmentAdvance.connect(self.onTreatmentAdvance)
         tm.onTreatmentSkip.connect(self.onTreatmentSkip)
+        tm.onTimingReport.connect(self.onTimingReport)
         tm.onStepsChanged.connect(self.onStepsChanged)
 
+    @pyqtSlot(result=QVariant)
+    def resumePoint(self):
+        return self.tm.resumePoint()
+
 class TreatmentManager(QObject):
-    def __init__(self, sequencelistmodel, parent=None, *args):
+    """Delivers a SequenceListModel to a HWSOC device from a worker thread
+
+    Delivery is a state machine driven entirely by the worker's event loop (HW acks, a beam-on timer and
+    control signals), so that an idle or dwelling treatment uses no CPU and stop/abort take effect as
+    soon as they are received.
+    """
+    class DeliveryState:
+        Idle, Moving, AwaitingAck, BeamOn, Advancing = range(5)
+
+    def __init__(self, sequencelistmodel, parent=None, *args, device=None, journal=None):
+        """
+        Args:
+            device (str): name of the (already initialized) HWSOC device that this manager delivers to
+            journal (DeliveryJournal): optional crash-safe record of delivery progress
+        """
         super().__init__(parent=parent, *args)
 
         self.seqlist = sequencelistmodel
-        self._hwsoc = HWSOC()
+        self._hwsoc = HWSOC(device=device)
         self.mark = 0
         self._steps = 0
-        self._sequence_cache = None
+        self._program = None    # DeliveryProgram compiled from seqlist when the treatment starts
+        self._next_seq = 0      # sequence number of the next batch record
+        # delivery state machine (only touched on the worker thread)
+        self._state = self.DeliveryState.Idle
+        self._duration = 0      # beam-on time (ms) of the segment being moved to
+        self._window = 0        # batch records allowed in flight; 0 for one frame per segment
+        self._inflight = deque() # (seq, segment index) sent but not yet acked
+        self._nextidx = 0       # next segment to upload in pipelined mode
+        self._resume = None     # (segment, beam-on ms) replacing the duration of the first segment when resuming
+        # beam-on timing; moved to the worker thread along with self
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._beamOnElapsed)
+        # opt-in: time beam-on against absolute deadlines anchored at each move ack instead
+        self.use_deadlines = False
+        self._deadline_timer = DeadlineTimer(self)
+        self._deadline_timer.timeout.connect(self._beamOnElapsed)
+        # per-segment timing report of the current delivery
+        self.timing_report = []
+        self._t_start = 0.0     # perf_counter() at treatment start
+        self._t_sent = 0.0      # perf_counter() when the current move was sent
+        self._reply = None      # number of the SIG_MOVE_OK that answers the current move (see OutboundQueue.put())
+        self._t_anchor = 0.0    # perf_counter() when the current beam-on started
+        self._t_beam_end = 0.0  # perf_counter() when the current beam-on is due to end
+        self._last_ack = None   # (segment index, perf_counter()) of the previous seq ack
+        # observed moves for calibrating the motion model (see SequenceListModel.calibrateMotionModel())
+        self.move_samples = deque(maxlen=4096) # (from motor steps, to motor steps, seconds)
+        self._hw_steps = None   # motor steps of the segment the HW last moved to in this treatment
+        # crash recovery
+        self.journal = journal
+        self._journaling = False # a treatment was begun in the journal and has not ended yet
 
         # thread locks
         self.lock_running = QMutex()
@@ -68,10 +125,20 @@ class TreatmentManager(QObject):
         self.state_waitinghwok = False
 
         self.startTreatment.connect(self._startTreatment)
+        self.resumeTreatment.connect(self._resumeTreatment)
         self.stopTreatment.connect(self._stopTreatment)
         self.restartTreatment.connect(self._restartTreatment)
         self.abortTreatment.connect(self._abortTreatment)
         self.setHWOK.connect(self._sethwok)
+        self.setHWOKSeq.connect(self._sethwokseq)
+
+        # HW responses of the bound device
+        protocol = self._hwsoc.tserialinterface.protocol
+        protocol.sigRecvdMoveOK.connect(self.setHWOK)
+        protocol.sigRecvdMoveOKSeq.connect(self.setHWOKSeq)
+        protocol.sigRecvdHWError.connect(self.abortTreatment)
+        # refine the plan's delivery time estimates with the moves observed (the model lives on the GUI thread)
+        self.onMoveSamples.connect(self.seqlist.calibrateMotionModel)
 
         # create QThread and move this object to it
         self.thread = QThread()
@@ -84,14 +151,27 @@ class TreatmentManager(QObject):
     onTreatmentCompleted = pyqtSignal(int)
     onTreatmentAdvance   = pyqtSignal(int)
     onTreatmentSkip      = pyqtSignal(int, float)
+    onTimingReport       = pyqtSignal(list) # per-segment planned vs. actual duration, after each delivery
+    onMoveSamples        = pyqtSignal(list) # move_samples, after each delivery that stopped or completed
 
     # cross-thread control via signals
     startTreatment   = pyqtSignal([int])
+    resumeTreatment  = pyqtSignal(int, float) # start index, beam-on time (ms) left for that segment
     stopTreatment    = pyqtSignal()
     restartTreatment = pyqtSignal()
     abortTreatment   = pyqtSignal()
-    setHWOK          = pyqtSignal()
+    setHWOK          = pyqtSignal([int])
+    setHWOKSeq       = pyqtSignal([int])
 
+    @pyqtProperty(str, constant=True)
+    def device(self):
+        return self._hwsoc.device
+
+    onStateChanged = pyqtSignal([int])
+    @pyqtProperty(int, notify=onStateChanged)
+    def state(self):
+        """current DeliveryState"""
+        return self._state
 
     onStepsChanged = pyqtSignal([int])
     @pyqtProperty(int, notify=onStepsChanged)
@@ -136,77 +216,314 @@ class TreatmentManager(QObject):
         self.lock_running.unlock()
 
 
-    def deliverAll(self):
-        while self.mark < len(self._sequence_cache) and self.running:
-            duration = self.deliverOne()
-
-            # advance to next segment?
-            if self.running:
-                if self.mark < len(self.seqlist)-1:
-                    self.mark += 1
-                    self.steps += 1
-                    #  if duration >= 1000:
-                        #  self.onTreatmentAdvance.emit(self.mark) # only updates UI
-                    self.onTreatmentAdvance.emit(self.mark) # only updates UI
-                else:
-                    self._stopTreatment()
-                    self.state_paused = False
-                    self.onTreatmentCompleted.emit(self.mark) #update ui
-
-    def deliverOne(self):
-        """Run timer for a single beam"""
-        seg = self._sequence_cache[self.mark]
-        extension_list = seg._members['extension_list'].value
-        duration = float(seg._members['timecode_ms'].value)
-        if duration <= 0:
-            self.waitinghwok = True
+    def _setState(self, state):
+        if state != self._state:
+            self._state = state
+            self.onStateChanged.emit(state)
+
+    def _journal(self, event, segment, value=0.0, aux=0, t=None):
+        if self._journaling:
+            self.journal.append(event, segment, value, aux, t)
+            if event in (journal.EVENT_STOP, journal.EVENT_ABORT, journal.EVENT_COMPLETE):
+                self._journaling = False
+
+    def resumePoint(self):
+        """where to resume the journaled treatment that did not complete, if the model still holds its plan
+
+        Returns:
+            dict with the fields of journal.ResumePoint, or {} if there is nothing to resume
+        """
+        state = self.journal.last_state if self.journal is not None else None
+        if state is None or state.completed:
+            return {}
+        try:
+            program = self.seqlist.compileProgram(self._hwsoc.nleaflets)
+        except ProgramError:
+            return {}
+        point = journal.resume_point(state, program)
+        if point is None:
+            return {}
+        return point._asdict()
+
+    def _segmentDuration(self, idx):
+        if self._resume is not None and idx == self._resume[0]:
+            return self._resume[1]
+        return self._program.durations[idx]
+
+    @staticmethod
+    def _wallTime(t):
+        """ time.time() of perf_counter() value t, for journal records """
+        return time.time() - (time.perf_counter()-t)
+
+    def _advanceMark(self):
+        """Advancing: move to the next segment, or complete the treatment after the last one
+
+        Returns:
+            True if there is a next segment to deliver
+        """
+        self._setState(self.DeliveryState.Advancing)
+        if self.mark < len(self._program)-1:
+            self.mark += 1
+            self.steps += 1
+            self.onTreatmentAdvance.emit(self.mark) # only updates UI
+            return True
+        self._completeTreatment()
+        return False
+
+    def _completeTreatment(self):
+        self._journal(journal.EVENT_COMPLETE, self.mark)
+        self._stopTreatment()
+        self.state_paused = False
+        self.onTreatmentCompleted.emit(self.mark) #update ui
+
+    def _deliverSegment(self):
+        """Moving: send the positions of the segment at mark; the MOVE_OK ack starts its beam-on time"""
+        while self.running:
+            duration = self._segmentDuration(self.mark)
+            if duration > 0:
+                self._duration = duration
+                if self._hw_steps is not None and self._program.stationary[self.mark]:
+                    # the HW already holds these positions: no move, and no ack to wait for
+                    anchor = self._t_beam_end if self.use_deadlines else time.perf_counter()
+                    self._journal(journal.EVENT_MOVE_OK, self.mark, t=self._wallTime(anchor))
+                    self._beamOn(duration, anchor)
+                    return
+                self.waitinghwok = True
+                self._setState(self.DeliveryState.Moving)
+                self._t_sent = time.perf_counter()
+                self._reply = self._hwsoc.send_positions_frame(self._program.frames[self.mark])
+                return
+            self._journal(journal.EVENT_SKIP, self.mark)
             self.onTreatmentSkip.emit(self.mark, duration)
+            if not self._advanceMark():
+                return
+
+    def _ackTime(self, not_before):
+        """ when the most recent ack was decoded on the serial thread, so that event-loop latency on the
+        way to this worker does not add to the segment (falls back to now) """
+        t_ack = self._hwsoc.telemetry.last_ack_time
+        if t_ack is None or t_ack < not_before:
+            return time.perf_counter()
+        return t_ack
+
+    def _beamOn(self, duration, anchor):
+        """BeamOn: hold the current positions for duration (ms) counted from anchor (perf_counter())"""
+        self._setState(self.DeliveryState.BeamOn)
+        self._t_anchor = anchor
+        self._t_beam_end = anchor + duration*0.001
+        if self.use_deadlines:
+            self._deadline_timer.start(anchor + duration*0.001)
         else:
-            self.waitinghwok = True
-            self._hwsoc.set_all_positions(extension_list)
-            while self.waitinghwok:
-                # spin event loop until hwok signal is recieved after delivery of prev. segment
-                QCoreApplication.processEvents()
-
-            t1 = time.perf_counter()
-            while (time.perf_counter()-t1) < duration*0.001:
-                # catch signals every 250ms while delivering
-                if (time.perf_counter()-t1)%0.25:
-                    QCoreApplication.processEvents()
-                if not self.state_running:
-                    # early exit from UI
-                    break
-        return duration
-
-    def _sethwok(self):
+            self._timer.start(max(0, int(round(duration))))
+
+    @pyqtSlot()
+    def _beamOnElapsed(self):
+        if self._state != self.DeliveryState.BeamOn or not self.running:
+            return
+        now = time.perf_counter()
+        self.timing_report.append(timing_record(self.mark, self._segmentDuration(self.mark),
+                                                now-self._t_anchor, self._t_anchor-self._t_start))
+        self._journal(journal.EVENT_BEAM_DONE, self.mark, 1000*(now-self._t_anchor))
+        if self._window:
+            # the HW dwelled on the final pipelined segment; any after it have no beam-on time
+            self._setState(self.DeliveryState.Advancing)
+            last = len(self._program)-1
+            self._reachSegment(last)
+            if self._segmentDuration(last) <= 0:
+                self._journal(journal.EVENT_SKIP, last)
+                self.onTreatmentSkip.emit(last, self._segmentDuration(last))
+            self._completeTreatment()
+        elif self._advanceMark():
+            self._deliverSegment()
+
+    def _topUpBatch(self):
+        """keep at most window batch records in flight on the HW"""
+        records = []
+        while self._nextidx < len(self._program) and len(self._inflight) < self._window:
+            duration = self._segmentDuration(self._nextidx)
+            # segments without beam-on time are not uploaded, see _reachSegment()
+            if duration > 0:
+                if not records:
+                    first_seq = self._next_seq
+                records.append((self._program.payloads[self._nextidx], duration))
+                self._inflight.append((self._next_seq, self._nextidx))
+                self._next_seq = (self._next_seq+1) % hwmodel.SEQ_MODULUS
+            self._nextidx += 1
+        if records:
+            self._hwsoc.send_batch(first_seq, records)
+
+    def _reachSegment(self, idx):
+        """pipelined: the HW got to segment idx; signal the segments on the way the same as _deliverSegment()
+        and _advanceMark() do"""
+        while self.mark < idx:
+            duration = self._segmentDuration(self.mark)
+            if duration <= 0:
+                self._journal(journal.EVENT_SKIP, self.mark)
+                self.onTreatmentSkip.emit(self.mark, duration)
+            self.mark += 1
+            self.steps += 1
+            self.onTreatmentAdvance.emit(self.mark) # only updates UI
+
+    def _deliverPipelined(self):
+        """AwaitingAck: upload segments ahead of the HW in batches and match sequence-numbered acks to
+        segments. The HW dwells for each segment's duration after acking it."""
+        self._setState(self.DeliveryState.AwaitingAck)
+        self._inflight.clear()
+        self._nextidx = self.mark
+        self._topUpBatch()
+        self._checkPipelineDone()
+
+    def _checkPipelineDone(self):
+        if self._inflight or self._nextidx < len(self._program):
+            return
+        # HW is dwelling on the final segment
+        duration = self._segmentDuration(self.mark)
+        anchor = self._last_ack[1] if self._last_ack else time.perf_counter()
+        self._beamOn(duration if duration > 0 else 0, anchor)
+
+    def _record_ack_dispatch(self):
+        """ time for the most recent ack to travel from the serial thread to this worker """
+        telemetry = self._hwsoc.telemetry
+        if telemetry.last_ack_time is not None:
+            telemetry.record('ack_dispatch', time.perf_counter()-telemetry.last_ack_time)
+
+    @pyqtSlot(int)
+    def _sethwok(self, reply):
+        self._record_ack_dispatch()
+        if self._state == self.DeliveryState.Moving and self.running:
+            if reply != self._reply:
+                # e.g. the initial move of the HW, still in progress when the treatment started
+                logger.debug('ignoring MOVE_OK #{:d} while waiting for #{!s}'.format(reply, self._reply))
+                return
+            self.waitinghwok = False
+            t_ack = self._ackTime(self._t_sent)
+            self._journal(journal.EVENT_MOVE_OK, self.mark, t=self._wallTime(t_ack))
+            steps = self._program.segment_steps(self.mark)
+            if self._hw_steps is not None:
+                self.move_samples.append((self._hw_steps, steps, t_ack-self._t_sent))
+            self._hw_steps = steps
+            self._beamOn(self._duration, t_ack)
+
+    @pyqtSlot(int)
+    def _sethwokseq(self, seq):
+        self._record_ack_dispatch()
+        if self._state != self.DeliveryState.AwaitingAck or not self.running:
+            return
+        if not any(s == seq for s, _ in self._inflight):
+            logger.debug('ignoring stale ack for seq {}'.format(seq))
+            return
+        while self._inflight[0][0] != seq:
+            logger.warning('missed ack for seq {}'.format(self._inflight.popleft()[0]))
+        _, idx = self._inflight.popleft()
+        t_ack = self._ackTime(self._t_start)
+        if self._last_ack is not None:
+            # the HW dwelled on the previous segment, then moved to this one
+            previdx, t_prev = self._last_ack
+            from_steps, to_steps = self._program.segment_steps(previdx), self._program.segment_steps(idx)
+            planned = self._segmentDuration(previdx) + 1000*self._program.motion.move_time(from_steps, to_steps)
+            self.move_samples.append((from_steps, to_steps, t_ack-t_prev-0.001*self._segmentDuration(previdx)))
+            self.timing_report.append(timing_record(previdx, planned, t_ack-t_prev, t_prev-self._t_start))
+            self._journal(journal.EVENT_BEAM_DONE, previdx, 1000*(t_ack-t_prev))
+        self._journal(journal.EVENT_MOVE_OK, idx, aux=seq, t=self._wallTime(t_ack))
+        self._last_ack = (idx, t_ack)
+        self._reachSegment(idx)
+        self._topUpBatch()
+        self._checkPipelineDone()
+
+    def _cancelDelivery(self):
+        """back to Idle; drops whatever the HW still has queued"""
+        self._timer.stop()
+        self._deadline_timer.stop()
+        if self._window and self._state in (self.DeliveryState.AwaitingAck, self.DeliveryState.BeamOn):
+            self._hwsoc.flush_batch()
+        self._inflight.clear()
         self.waitinghwok = False
+        self._setState(self.DeliveryState.Idle)
+
+    @pyqtSlot(int, float)
+    def _resumeTreatment(self, index, first_ms):
+        """Start the treatment at index, delivering only first_ms of that segment's beam-on time"""
+        self._startTreatment(index, first_ms)
 
     @pyqtSlot(int)
-    def _startTreatment(self, index):
+    def _startTreatment(self, index, first_ms=None):
         """Start the treatment at specified index"""
+        self._cancelDelivery()
         self.mark = index
-        self._sequence_cache = self.seqlist._items.copy()
+        self._resume = None
+        try:
+            # later edits to the model do not affect a running treatment
+            self._program = self.seqlist.compileProgram(self._hwsoc.nleaflets)
+        except ProgramError as e:
+            for row, msg in e.errors:
+                logger.error('Cannot deliver segment #{:d}: {!s}'.format(row+1, msg))
+            self._abortTreatment()
+            return
+        if not 0 <= self.mark < len(self._program):
+            logger.error('Cannot start treatment at segment #{:d} of {:d}'.format(self.mark+1, len(self._program)))
+            self._abortTreatment()
+            return
+        self.timing_report = []
+        self._last_ack = None
+        self._hw_steps = None
+        if self.journal is not None:
+            self.journal.begin(self._program, self.mark)
+            self._journaling = True
+        if first_ms is not None:
+            duration = self._program.durations[self.mark]
+            first_ms = min(first_ms, duration)
+            self._resume = (self.mark, first_ms)
+            self._journal(journal.EVENT_RESUME, self.mark, max(0.0, duration-first_ms))
+        self._t_start = time.perf_counter()
         if not self.state_paused:
             self.steps = 1
         self.running = True
         self.onTreatmentStarted.emit()
         logger.debug("Treatment started")
-        self.deliverAll()
+        if self._hwsoc.use_batch:
+            # unknown again after a reconnect: ask without waiting, later treatments use the answer
+            self._hwsoc.query_capabilities()
+        self._window = self._hwsoc.batch_size
+        if self._window > 0:
+            self._deliverPipelined()
+        else:
+            self._deliverSegment()
+
+    def _reportTiming(self):
+        if not self.timing_report:
+            return
+        summary = summarize_timing(self.timing_report)
+        logger.info('segment timing ({} mode): {:d} segments, mean |error| {:.3f}ms, max |error| {:.3f}ms'.format(
+            'deadline' if self.use_deadlines else 'relative', summary['count'],
+            summary['mean_abs_error_ms'], summary['max_abs_error_ms']))
+        self.onTimingReport.emit(self.timing_report)
+        self.timing_report = []
 
+    @pyqtSlot()
     def _stopTreatment(self):
         self.state_paused = True
         self.running = False
+        self._cancelDelivery()
+        self._journal(journal.EVENT_STOP, self.mark)
+        self._reportTiming()
+        if self.move_samples:
+            self.onMoveSamples.emit(list(self.move_samples))
         self.onTreatmentStopped.emit(self.mark)
         logger.debug("Treatment stopped")
 
+    @pyqtSlot()
     def _restartTreatment(self):
         self.steps = 0
         self.state_paused = False
         self._startTreatment(0)
         logger.debug("Treatment restarted")
 
+    @pyqtSlot()
     def _abortTreatment(self):
         self.running = False
         self.state_paused = False
+        self._cancelDelivery()
+        self._journal(journal.EVENT_ABORT, self.mark)
+        self._reportTiming()
         self.onTreatmentAborted.emit(self.mark)
         logger.debug("Treatment aborted")